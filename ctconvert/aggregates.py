@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Count the trials in the CSV by sponsor, sponsor type, phase and
+status as their rows are built.
+
+The tracker and dashboards want these totals after every run, and
+computing them while converting saves scanning the whole CSV again.
+`Aggregates` keeps a counter of the `METRICS` flags set, and of the
+trials, for each value of each of the `DIMENSIONS`. Counters from
+several workers are summed by `merge_stats`, and `write_csv` writes
+the result as one row per dimension and value.
+
+As with `rules.RulePlan`, one instance can be shared between threads:
+its counters are updated under a lock, and rows added by a thread
+within `uncounted` are not counted.
+
+"""
+import contextlib
+import csv
+import threading
+from collections import Counter
+
+DIMENSIONS = ["sponsor", "sponsor_type", "phase", "study_status"]
+METRICS = [
+    "act_flag",
+    "included_pact_flag",
+    "results_due",
+    "has_results",
+    "pending_results",
+    "has_certificate",
+    "late_cert",
+]
+HEADERS = ["dimension", "value", "trials"] + METRICS
+
+
+class Aggregates(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    @contextlib.contextmanager
+    def uncounted(self):
+        """Don't count the rows this thread adds within this block"""
+        self.local.uncounted = True
+        try:
+            yield
+        finally:
+            self.local.uncounted = False
+
+    def reset(self):
+        self.counts = {dimension: {} for dimension in DIMENSIONS}
+
+    def add(self, row):
+        """Count one CSV row (a dict or `TrialRecord`)"""
+        if getattr(self.local, "uncounted", False):
+            return
+        flags = ["trials"] + [metric for metric in METRICS if row[metric]]
+        with self.lock:
+            for dimension in DIMENSIONS:
+                # None is written to the CSV as an empty string
+                value = row[dimension] or ""
+                counts = self.counts[dimension].get(value)
+                if counts is None:
+                    counts = self.counts[dimension][value] = Counter()
+                counts.update(flags)
+
+    def stats(self):
+        with self.lock:
+            return {
+                dimension: {value: dict(counts) for value, counts in values.items()}
+                for dimension, values in self.counts.items()
+            }
+
+
+def merge_stats(stats_list):
+    """Sum a list of `Aggregates.stats()` dicts, e.g. from each worker"""
+    merged = {dimension: {} for dimension in DIMENSIONS}
+    for stats in stats_list:
+        for dimension, values in stats.items():
+            for value, counts in values.items():
+                merged[dimension].setdefault(value, Counter()).update(counts)
+    return {
+        dimension: {value: dict(counts) for value, counts in values.items()}
+        for dimension, values in merged.items()
+    }
+
+
+def write_csv(path, stats):
+    """Write merged stats to `path`, a row for each dimension and value"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS)
+        for dimension in DIMENSIONS:
+            for value, counts in sorted(stats[dimension].items()):
+                writer.writerow(
+                    [dimension, value] + [counts.get(name, 0) for name in HEADERS[2:]]
+                )
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""A local, content-addressed cache for large downloads such as
+AllPublicXML.zip.
+
+Each cached file is stored under the SHA-256 of its content. An index
+records, per URL, the validators (ETag and Last-Modified) the server
+sent with the current entry. These are replayed as conditional request
+headers, so an unchanged archive costs one round trip plus a local
+integrity check instead of a full download.
+
+"""
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+INDEX_NAME = "index.json"
+OBJECTS_DIR = "objects"
+MAX_ENTRIES = 3
+CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArchiveCache(object):
+    def __init__(self, cache_dir, max_entries=MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, OBJECTS_DIR)
+        self.index_path = os.path.join(cache_dir, INDEX_NAME)
+        self.max_entries = max_entries
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256)
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def is_valid(self, entry):
+        """Return True if the object for `entry` exists and its content
+        still hashes to the recorded digest.
+
+        """
+        path = self.object_path(entry["sha256"])
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        return sha256_file(path) == entry["sha256"]
+
+    def fetch(self, url, destination):
+        """Place the current content of `url` at `destination`, reusing
+        the cached copy if the server reports it unchanged.
+
+        Returns True if the cached copy was reused.
+
+        """
+        index = self.read_index()
+        entry = index.get(url)
+        if entry and not self.is_valid(entry):
+            logger.warning("Discarding corrupt cache entry for %s", url)
+            entry = None
+
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not entry:
+                raise
+            logger.info("%s not modified; using cached copy", url)
+            reused = True
+        else:
+            with response:
+                entry = self.store(response)
+            entry["etag"] = response.headers.get("ETag")
+            entry["last_modified"] = response.headers.get("Last-Modified")
+            reused = False
+
+        entry["checked"] = email.utils.formatdate(usegmt=True)
+        index[url] = entry
+        self.write_index(index)
+        self.evict(index)
+        self.link(self.object_path(entry["sha256"]), destination)
+        return reused
+
+    def store(self, response):
+        """Stream `response` into the cache, returning an index entry
+        for it.
+
+        """
+        logger.info("Downloading %s into cache", response.geturl())
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            sha256 = digest.hexdigest()
+            os.replace(tmp_path, self.object_path(sha256))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return {"sha256": sha256, "size": size}
+
+    def evict(self, index):
+        """Delete all but the `max_entries` most recently used objects,
+        never deleting one that the index currently points to.
+
+        """
+        in_use = {entry["sha256"] for entry in index.values()}
+        objects = sorted(
+            (os.path.join(self.objects_dir, name) for name in os.listdir(self.objects_dir)),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for path in objects[self.max_entries :]:
+            if os.path.basename(path) not in in_use:
+                logger.info("Evicting %s from cache", path)
+                os.remove(path)
+
+    def link(self, source, destination):
+        # Touch so eviction treats this as recently used
+        os.utime(source, (time.time(), time.time()))
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Random access to single trials in AllPublicXML.zip (or a zip of the
+API v2 JSON export; see `ctgov_v2`).
+
+Opening the archive with `zipfile` means reading a central directory
+of hundreds of thousands of entries. Instead, the first time an
+archive is used we write a sidecar index next to it, or in another
+directory if given one (e.g. when the archive's is read-only). It
+holds one
+fixed-width record per trial, sorted by NCT id, giving the offset and
+size of the member in the zip. A lookup is then a binary search over
+the memory-mapped index plus one read of the member's bytes.
+
+"""
+import logging
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+
+import ctgov_v2
+
+INDEX_SUFFIX = ".idx"
+MAGIC = b"CTIDX001"
+# magic, archive size, archive mtime (ns), number of records
+HEADER = struct.Struct("<8sQQQ")
+# nct_id, local header offset, compressed size, size, CRC-32, compression
+RECORD = struct.Struct("<11sQQQIH")
+LOCAL_HEADER = struct.Struct("<4s5HI2I2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+logger = logging.getLogger(__name__)
+
+
+def nct_id_from_name(name):
+    """Return the NCT id of a member such as `NCT0123xxxx/NCT01234567.xml`
+    (or `NCT01234567.json`), or None for anything else.
+
+    """
+    base, suffix = os.path.splitext(os.path.basename(name))
+    if not base.startswith("NCT") or suffix not in (".xml", ctgov_v2.SUFFIX):
+        return None
+    return base
+
+
+def index_path(zip_path, index_dir=None):
+    """Where the index of `zip_path` is kept: next to it, or in
+    `index_dir`
+
+    """
+    if index_dir is None:
+        return zip_path + INDEX_SUFFIX
+    return os.path.join(index_dir, os.path.basename(zip_path) + INDEX_SUFFIX)
+
+
+def archive_signature(zip_path):
+    stat = os.stat(zip_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_index(zip_path, path):
+    """Write the index for the archive at `zip_path` to `path`"""
+    logger.info("Indexing %s", zip_path)
+    records = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        for info in archive.infolist():
+            nct_id = nct_id_from_name(info.filename)
+            if nct_id and len(nct_id) == 11 and nct_id not in records:
+                records[nct_id] = (
+                    info.header_offset,
+                    info.compress_size,
+                    info.file_size,
+                    info.CRC,
+                    info.compress_type,
+                )
+    size, mtime_ns = archive_signature(zip_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, size, mtime_ns, len(records)))
+        for nct_id in sorted(records):
+            f.write(RECORD.pack(nct_id.encode("ascii"), *records[nct_id]))
+    os.replace(tmp_path, path)
+
+
+class ArchiveIndex(object):
+    """Look up and read trials from an archive by NCT id. The index,
+    next to the archive or in `index_dir`, is built if it is missing or
+    was built for a different archive.
+
+    """
+
+    def __init__(self, zip_path, index_dir=None):
+        self.zip_path = zip_path
+        self.index_path = index_path(zip_path, index_dir)
+        if not self.index_is_current():
+            if index_dir is not None:
+                os.makedirs(index_dir, exist_ok=True)
+            build_index(zip_path, self.index_path)
+        with open(self.index_path, "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, _, self.count = HEADER.unpack_from(self.index, 0)
+        self.archive = open(zip_path, "rb")
+
+    def index_is_current(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                magic, size, mtime_ns, _ = HEADER.unpack(f.read(HEADER.size))
+        except (IOError, struct.error):
+            return False
+        return magic == MAGIC and (size, mtime_ns) == archive_signature(self.zip_path)
+
+    def close(self):
+        self.index.close()
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def find(self, nct_id):
+        """Return `(offset, compress_size, file_size, crc, compress_type)`
+        for `nct_id`, or None if it is not in the archive.
+
+        """
+        key = nct_id.encode("ascii")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * RECORD.size
+            if self.index[offset : offset + 11] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            record = RECORD.unpack_from(self.index, HEADER.size + lo * RECORD.size)
+            if record[0] == key:
+                return record[1:]
+        return None
+
+    def __contains__(self, nct_id):
+        return self.find(nct_id) is not None
+
+    def read(self, nct_id):
+        """Return the XML (or v2 JSON) of `nct_id`, or raise KeyError"""
+        return self.read_member(nct_id)[1]
+
+    def read_member(self, nct_id):
+        """Return the name and content of the member of `nct_id`, or
+        raise KeyError
+
+        """
+        record = self.find(nct_id)
+        if record is None:
+            raise KeyError(nct_id)
+        header_offset, compress_size, file_size, crc, compress_type = record
+        # Positional reads keep this safe to share between threads
+        fd = self.archive.fileno()
+        header = os.pread(fd, LOCAL_HEADER.size, header_offset)
+        fields = LOCAL_HEADER.unpack(header)
+        if fields[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile("Bad local header for {}".format(nct_id))
+        name_length, extra_length = fields[-2:]
+        name = os.pread(fd, name_length, header_offset + LOCAL_HEADER.size)
+        data_offset = header_offset + LOCAL_HEADER.size + name_length + extra_length
+        name = name.decode("utf-8")
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # Rare enough that going through the central directory will do
+            with zipfile.ZipFile(self.zip_path) as archive:
+                return name, archive.read(name)
+        data = os.pread(fd, compress_size, data_offset)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        if len(data) != file_size or zlib.crc32(data) != crc:
+            raise zipfile.BadZipFile("Bad CRC-32 for {}".format(nct_id))
+        return name, data
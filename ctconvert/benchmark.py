@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Compare the throughput and memory use of the executors.
+
+    python ctconvert/benchmark.py AllPublicXML.zip --processes 8
+
+converts the same archive with each executor (see `executors`) and
+prints, for each, the trials and megabytes of XML converted per
+second, the CPU time used, and the peak memory of the whole run
+(this process plus its workers, sampled while converting) and of its
+largest worker.
+
+Logging is set up as in a real run (see `log_pipeline`), writing to a
+temporary file, so its cost is part of the results. Each run reports
+how many records it wrote; compare `--log-levels INFO DEBUG` to see
+what verbose logging costs.
+
+Each run happens in a fresh interpreter, so that one executor's
+memory doesn't count against the next. Results are not written
+anywhere unless `--output` is given, which saves them as JSON.
+
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date
+
+import convert_data
+import log_pipeline
+from executors import EXECUTORS, SERIAL
+from worker_pool import peak_rss_mb, rss_mb
+
+SAMPLE_INTERVAL = 0.05
+STAGES = ["csv", "json"]
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+
+class MemorySampler(threading.Thread):
+    """Record the peak total RSS of this process and its children"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        pids = [os.getpid()] + [p.pid for p in multiprocessing.active_children()]
+        self.peak_mb = max(self.peak_mb, sum(rss_mb(pid) or 0 for pid in pids))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def worker_for(stage):
+    if stage == "json":
+        return convert_data.convert_one_file_to_json
+    convert_data.set_fda_reg_dict()
+    return functools.partial(
+        convert_data.convert_one_file_to_csv,
+        thresholds=convert_data.AsOf(date.today()),
+        included_only=False,
+    )
+
+
+def run_once(archive, executor, processes, stage, log_level):
+    """Convert `archive` with `executor` in this process, logging at
+    `log_level`, and return its measurements.
+
+    """
+    with zipfile.ZipFile(archive) as enormous_zipfile:
+        xml_bytes = sum(
+            info.file_size
+            for info in enormous_zipfile.infolist()
+            if convert_data.is_trial_member(info.filename)
+        )
+    if executor == SERIAL:
+        processes = 1
+    worker = worker_for(stage)
+    log_file = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+    log_file.close()
+    log_pipeline.configure(log_level, path=log_file.name)
+    sampler = MemorySampler()
+    sampler.start()
+    cpu_started = os.times()
+    started = time.perf_counter()
+    trials = 0
+    for _ in convert_data.stream(worker, archive, processes, executor=executor):
+        trials += 1
+    # Writing out the queued records is part of the cost
+    log_pipeline.shutdown()
+    seconds = time.perf_counter() - started
+    sampler.stop()
+    with open(log_file.name, "rb") as f:
+        log_records = sum(1 for _ in f)
+    log_bytes = os.path.getsize(log_file.name)
+    os.remove(log_file.name)
+    cpu = os.times()
+    cpu_seconds = sum(cpu[:4]) - sum(cpu_started[:4])
+    children = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return {
+        "executor": executor,
+        "processes": processes,
+        "stage": stage,
+        "log_level": log_level,
+        "trials": trials,
+        "seconds": round(seconds, 3),
+        "trials_per_second": round(trials / seconds, 1),
+        "mb_per_second": round(xml_bytes / (1024 * 1024) / seconds, 2),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "peak_rss_mb": round(sampler.peak_mb, 1),
+        "peak_worker_rss_mb": round(children, 1) if children else None,
+        "log_records": log_records,
+        "log_mb": round(log_bytes / (1024 * 1024), 3),
+    }
+
+
+def run_in_subprocess(archive, executor, processes, stage, log_level):
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            __file__,
+            archive,
+            "--run",
+            executor,
+            "--processes",
+            str(processes),
+            "--stage",
+            stage,
+            "--log-levels",
+            log_level,
+        ]
+    )
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def summarise(runs):
+    """Return the median speed and the highest memory use of the runs
+    of each executor at each log level.
+
+    """
+    summary = []
+    configurations = sorted(
+        {(run["executor"], run["log_level"]) for run in runs},
+        key=lambda c: (EXECUTORS.index(c[0]), LOG_LEVELS.index(c[1])),
+    )
+    for executor, log_level in configurations:
+        mine = [
+            run
+            for run in runs
+            if run["executor"] == executor and run["log_level"] == log_level
+        ]
+        seconds = statistics.median(run["seconds"] for run in mine)
+        summary.append(
+            {
+                "executor": executor,
+                "log_level": log_level,
+                "runs": len(mine),
+                "seconds": seconds,
+                "trials_per_second": round(mine[0]["trials"] / seconds, 1),
+                "cpu_seconds": statistics.median(run["cpu_seconds"] for run in mine),
+                "peak_rss_mb": max(run["peak_rss_mb"] for run in mine),
+                "peak_worker_rss_mb": max(
+                    run["peak_worker_rss_mb"] or 0 for run in mine
+                )
+                or None,
+                "log_records": max(run["log_records"] for run in mine),
+            }
+        )
+    return summary
+
+
+def print_table(summary):
+    columns = [
+        "executor",
+        "log_level",
+        "runs",
+        "seconds",
+        "trials_per_second",
+        "cpu_seconds",
+        "peak_rss_mb",
+        "peak_worker_rss_mb",
+        "log_records",
+    ]
+    rows = [columns] + [[str(row[c]) for c in columns] for row in summary]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("archive", help="A zip archive of CT.gov XML")
+    parser.add_argument(
+        "--executors",
+        nargs="+",
+        choices=EXECUTORS,
+        default=EXECUTORS,
+        help="The executors to compare",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Workers per executor (serial always uses one)",
+    )
+    parser.add_argument(
+        "--stage", choices=STAGES, default="csv", help="The conversion to time"
+    )
+    parser.add_argument(
+        "--log-levels",
+        nargs="+",
+        choices=LOG_LEVELS,
+        default=[log_pipeline.DEFAULT_LEVEL],
+        help="The log levels to run each executor at",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each executor")
+    parser.add_argument("--output", help="Also save every run as JSON here")
+    parser.add_argument("--run", choices=EXECUTORS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        result = run_once(
+            args.archive, args.run, args.processes, args.stage, args.log_levels[0]
+        )
+        print(json.dumps(result))
+        return
+    runs = []
+    for _ in range(args.repeat):
+        # Interleave executors, so that none benefits from a warmer cache
+        for executor in args.executors:
+            for log_level in args.log_levels:
+                runs.append(
+                    run_in_subprocess(
+                        args.archive, executor, args.processes, args.stage, log_level
+                    )
+                )
+    summary = summarise(runs)
+    print_table(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "runs": runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import json
 import string
 import subprocess
 import tempfile
@@ -11,11 +12,16 @@ from google.cloud import bigquery as gcbq
 from google.cloud import storage as gcs
 from google.cloud.exceptions import Conflict, NotFound
 
+from storage import PARTITION_KEY, partitioned_name
+
 PROJECT = "ebmdatalab"
 BQ_LOCATION = "EU"
 BQ_DEFAULT_TABLE_EXPIRATION_MS = None
 DATASET_NAME = "clinicaltrials"
 
+NEWLINE_DELIMITED_JSON = "NEWLINE_DELIMITED_JSON"
+PARQUET = "PARQUET"
+
 
 class StorageClient(object):
     """A dumb proxy for gcs.Client"""
@@ -105,7 +111,59 @@ class Client(object):
                 "csvOptions": {"fieldDelimiter": "þ"},
             },
         }
+        self.create_table_from_resource(resource)
+        return self.get_table(table_name, gcs_client)
+
+    def create_partitioned_external_table(
+        self,
+        table_name,
+        storage_prefix,
+        source_format=NEWLINE_DELIMITED_JSON,
+        schema=None,
+        compression=None,
+    ):
+        """Create an external table over every daily export laid out
+        under `storage_prefix` by `storage.partitioned_name`. Its
+        `snapshot_date` column comes from the paths, and queries must
+        filter on it, so they only read the days they ask for.
+
+        """
+        resource = external_table_resource(
+            self.project_name, table_name, storage_prefix, source_format, schema
+        )
+        if compression:
+            resource["externalDataConfiguration"]["compression"] = compression.upper()
+        self.create_table_from_resource(resource)
+        return self.get_table(table_name)
+
+    def load_partition(
+        self,
+        table_name,
+        storage_prefix,
+        day,
+        source_format=NEWLINE_DELIMITED_JSON,
+        schema=None,
+    ):
+        """Load the export for `day` under `storage_prefix` into its
+        partition of a native table partitioned by `snapshot_date`,
+        creating the table if need be and replacing that day if it was
+        loaded before.
+
+        """
+        self.run_job(
+            partition_load_configuration(
+                self.project_name,
+                self.dataset_name,
+                table_name,
+                storage_prefix,
+                day,
+                source_format,
+                schema,
+            )
+        )
+        return self.get_table(table_name)
 
+    def create_table_from_resource(self, resource):
         path = "/projects/{}/datasets/{}/tables".format(
             self.project_name, self.dataset_name
         )
@@ -121,7 +179,43 @@ class Client(object):
             self.gcbq_client._connection.api_request(
                 method="POST", path=path, data=resource
             )
-        return self.get_table(table_name, gcs_client)
+
+    def run_job(self, configuration, timeout_s=3600):
+        """Run a job described by a REST `configuration` resource, and
+        wait for it to finish.
+
+        """
+        job_id = gen_job_name()
+        api_request = self.gcbq_client._connection.api_request
+        api_request(
+            method="POST",
+            path="/projects/{}/jobs".format(self.project_name),
+            data={
+                "jobReference": {
+                    "projectId": self.project_name,
+                    "jobId": job_id,
+                    "location": BQ_LOCATION,
+                },
+                "configuration": configuration,
+            },
+        )
+        t0 = time.time()
+        while True:
+            job = api_request(
+                method="GET",
+                path="/projects/{}/jobs/{}".format(self.project_name, job_id),
+                query_params={"location": BQ_LOCATION},
+            )
+            if job["status"]["state"] == "DONE":
+                break
+            if time.time() - t0 > timeout_s:
+                msg = "Timeout waiting for job {} after {} second".format(
+                    job_id, timeout_s
+                )
+                raise TimeoutError(msg)
+            time.sleep(1)
+        if "errorResult" in job["status"]:
+            raise JobError(job["status"].get("errors"))
 
     def create_table_with_view(self, table_name, sql, legacy):
         assert "{project}" in sql
@@ -209,8 +303,17 @@ class Table(object):
 
         wait_for_job(job)
 
-    def insert_rows_from_storage(self, gcs_path, **options):
+    def insert_rows_from_storage(self, gcs_path, schema_path=None, **options):
+        """Load the file at `gcs_path`. With `schema_path`, it is loaded
+        as lines of JSON with the schema in that file (as written by
+        `convert_data.write_raw_json_schema`).
+
+        """
         default_options = {"write_disposition": "WRITE_TRUNCATE"}
+        if schema_path is not None:
+            default_options.update(
+                source_format=NEWLINE_DELIMITED_JSON, schema=read_schema(schema_path)
+            )
 
         gcs_uri = "gs://{}/{}".format(self.project_name, gcs_path)
 
@@ -322,6 +425,75 @@ class JobError(Exception):
     pass
 
 
+def format_options(source_format, schema=None):
+    """Return the parts of a table or load configuration that say how
+    to read files of `source_format`. Without a `schema`, JSON schemas
+    are autodetected; Parquet files describe themselves.
+
+    """
+    options = {"sourceFormat": source_format}
+    if source_format == PARQUET:
+        return options
+    if schema is None:
+        options["autodetect"] = True
+    else:
+        options["schema"] = {"fields": schema}
+        options["ignoreUnknownValues"] = True
+    return options
+
+
+def hive_partitioning_options(project, storage_prefix):
+    return {
+        "mode": "CUSTOM",
+        "sourceUriPrefix": "gs://{}/{}{{{}:DATE}}".format(
+            project, storage_prefix, PARTITION_KEY
+        ),
+    }
+
+
+def external_table_resource(
+    project, table_name, storage_prefix, source_format, schema=None
+):
+    config = format_options(source_format, schema)
+    config["sourceUris"] = ["gs://{}/{}*".format(project, storage_prefix)]
+    config["hivePartitioningOptions"] = dict(
+        hive_partitioning_options(project, storage_prefix),
+        requirePartitionFilter=True,
+    )
+    return {
+        "tableReference": {"tableId": table_name},
+        "externalDataConfiguration": config,
+    }
+
+
+def partition_load_configuration(
+    project, dataset_name, table_name, storage_prefix, day, source_format, schema=None
+):
+    load = format_options(source_format, schema)
+    load.update(
+        {
+            "sourceUris": [
+                "gs://{}/{}".format(project, partitioned_name(storage_prefix, day, "*"))
+            ],
+            "destinationTable": {
+                "projectId": project,
+                "datasetId": dataset_name,
+                # A partition decorator, so only that day is replaced
+                "tableId": "{}${}".format(table_name, day.strftime("%Y%m%d")),
+            },
+            "hivePartitioningOptions": hive_partitioning_options(
+                project, storage_prefix
+            ),
+            "timePartitioning": {"type": "DAY", "field": PARTITION_KEY},
+            "createDisposition": "CREATE_IF_NEEDED",
+            "writeDisposition": "WRITE_TRUNCATE",
+            # The shape of the JSON drifts; new fields widen the table
+            "schemaUpdateOptions": ["ALLOW_FIELD_ADDITION"],
+        }
+    )
+    return {"load": load}
+
+
 def set_options(thing, options, default_options=None):
     if default_options is not None:
         merge_options(options, default_options)
@@ -361,6 +533,24 @@ def build_schema(*fields):
     return [gcbq.SchemaField(*field) for field in fields]
 
 
+def schema_fields(fields):
+    """Convert fields as they appear in a schema file to SchemaFields"""
+    return [
+        gcbq.SchemaField(
+            field["name"],
+            field["type"],
+            mode=field.get("mode", "NULLABLE"),
+            fields=schema_fields(field.get("fields", [])),
+        )
+        for field in fields
+    ]
+
+
+def read_schema(path):
+    with open(path) as f:
+        return schema_fields(json.load(f))
+
+
 class InterpolationDict(dict):
     def __missing__(self, key):
         return "{" + key + "}"
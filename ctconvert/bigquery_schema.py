@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Infer a BigQuery schema for the raw JSON while it is written.
+
+xmltodict makes an element that occurs once a value and one that
+occurs several times a list, and an element with attributes an object
+(with its text under "text") but one without a string. So the same
+field takes different shapes in different trials, which BigQuery
+won't load under any one schema.
+
+A `SchemaBuilder` merges the shapes of the trials it sees into the
+widest: a field that is ever a list is REPEATED, and one that is ever
+an object is a RECORD. Scalars of different types are STRINGs, except
+that INTEGERs and FLOATs are FLOATs. `add` returns each trial in the
+shape of the schema as it stands, wrapping a lone value in a list and
+a scalar in `{"text": ...}`, writing scalars in STRING fields as
+strings, and dropping nulls from lists (which BigQuery rejects).
+
+Each worker has its own builder, started from the schema of the
+previous run, and `merge_reports` combines them. A trial written
+before its builder widened one of its fields no longer fits the final
+schema, so each builder also records the shape in which it first
+wrote each field. Once the schema has settled, the trials nearly
+always fit it as written; when they don't, `conform_file` rewrites
+the output to fit.
+
+"""
+import json
+import os
+import threading
+from collections import defaultdict
+
+from compressed_output import open_input, open_output
+
+STRING = "STRING"
+INTEGER = "INTEGER"
+FLOAT = "FLOAT"
+BOOLEAN = "BOOLEAN"
+RECORD = "RECORD"
+NULLABLE = "NULLABLE"
+REPEATED = "REPEATED"
+# The key of the text of an element with attributes
+TEXT = "text"
+
+
+def scalar_type(value):
+    if isinstance(value, bool):
+        return BOOLEAN
+    if isinstance(value, int):
+        return INTEGER
+    if isinstance(value, float):
+        return FLOAT
+    return STRING
+
+
+def widen(type_, other):
+    """Return the narrowest type that fits both `type_` and `other`"""
+    if type_ is None or type_ == other:
+        return other
+    if other is None:
+        return type_
+    if RECORD in (type_, other):
+        return RECORD
+    if {type_, other} == {INTEGER, FLOAT}:
+        return FLOAT
+    return STRING
+
+
+def new_field():
+    return {"type": None, "repeated": False, "fields": {}}
+
+
+def shape(field):
+    return (field["type"], field["repeated"])
+
+
+class SchemaBuilder(object):
+    def __init__(self, schema=None):
+        """Start from `schema`, a BigQuery schema as it appears in a
+        schema file, if given.
+
+        """
+        self.fields = from_bigquery(schema or [])
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        """Widen the schema to fit `record`, a dict, and return the
+        record in the shape of the schema as it now stands.
+
+        """
+        with self.lock:
+            return self.add_record(self.fields, record)
+
+    def add_record(self, fields, record):
+        conformed = {}
+        for key, value in record.items():
+            field = fields.get(key)
+            if field is None:
+                field = fields[key] = new_field()
+            conformed[key] = self.add_value(field, value)
+        return conformed
+
+    def add_value(self, field, value):
+        if value is None:
+            return None
+        if isinstance(value, list):
+            field["repeated"] = True
+            items = [item for item in value if item is not None]
+        else:
+            items = [value]
+        for item in items:
+            field["type"] = widen(
+                field["type"], RECORD if isinstance(item, dict) else scalar_type(item)
+            )
+        if field["type"] == STRING:
+            items = [i if isinstance(i, str) else json.dumps(i) for i in items]
+        elif field["type"] == RECORD:
+            items = [
+                self.add_record(
+                    field["fields"], item if isinstance(item, dict) else {TEXT: item}
+                )
+                for item in items
+            ]
+        if "written" not in field:
+            # The shape in which this field was first written
+            field["written"] = shape(field)
+        if field["repeated"]:
+            return items
+        return items[0] if items else None
+
+    def report(self):
+        return {"fields": self.fields, "written": dict(written_shapes(self.fields))}
+
+
+def written_shapes(fields, prefix=""):
+    """Yield `(path, shape)` for each field written, where `path` is
+    its name and those of its parents joined by dots.
+
+    """
+    for name, field in fields.items():
+        if "written" in field:
+            yield prefix + name, field["written"]
+        yield from written_shapes(field["fields"], prefix + name + ".")
+
+
+def from_bigquery(schema):
+    return {
+        f["name"]: {
+            "type": f["type"],
+            "repeated": f.get("mode") == REPEATED,
+            "fields": from_bigquery(f.get("fields", [])),
+        }
+        for f in schema
+    }
+
+
+def to_bigquery(fields):
+    """Return `fields` as a BigQuery schema, as in a schema file"""
+    schema = []
+    for name, field in fields.items():
+        entry = {
+            "name": name,
+            # Fields only ever seen empty might as well be strings
+            "type": field["type"] or STRING,
+            "mode": REPEATED if field["repeated"] else NULLABLE,
+        }
+        if field["type"] == RECORD:
+            entry["fields"] = to_bigquery(field["fields"]) or [
+                {"name": TEXT, "type": STRING, "mode": NULLABLE}
+            ]
+        schema.append(entry)
+    return schema
+
+
+def merge(target, fields):
+    """Widen `target` to fit `fields` as well"""
+    for name, field in fields.items():
+        mine = target.setdefault(name, new_field())
+        mine["type"] = widen(mine["type"], field["type"])
+        mine["repeated"] = mine["repeated"] or field["repeated"]
+        merge(mine["fields"], field["fields"])
+    return target
+
+
+def merge_reports(seed, reports):
+    """Combine the reports of each worker's builder, and the `seed`
+    schema they started from, into `(fields, written)`, where
+    `written` maps each field's path to the shapes it was written in.
+
+    """
+    fields = from_bigquery(seed or [])
+    written = defaultdict(set)
+    for report in reports:
+        merge(fields, report["fields"])
+        for path, (type_, repeated) in report["written"].items():
+            written[path].add((type_, repeated))
+    return fields, written
+
+
+def field_at(fields, path):
+    *parents, name = path.split(".")
+    for parent in parents:
+        fields = fields[parent]["fields"]
+    return fields[name]
+
+
+def conforms(fields, written):
+    """Whether everything written in the shapes `written` fits
+    `fields`
+
+    """
+    return all(
+        shapes == {shape(field_at(fields, path))} for path, shapes in written.items()
+    )
+
+
+def conform_file(path, fields, compression=None):
+    """Rewrite the lines of JSON at `path` in the shape of `fields`,
+    widening them to fit, until every line fits. Return the final
+    fields.
+
+    """
+    while True:
+        builder = SchemaBuilder()
+        # A copy without the shapes in which fields were written so far
+        builder.fields = merge({}, fields)
+        tmp_path = path + ".tmp"
+        with open_input(path) as source, open_output(tmp_path, compression) as target:
+            for line in source:
+                target.write(json.dumps(builder.add(json.loads(line))) + "\n")
+        os.replace(tmp_path, path)
+        fields = builder.fields
+        written = {name: {shape} for name, shape in written_shapes(fields)}
+        if conforms(fields, written):
+            return fields
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Compare today's raw trial JSON with the previous run's, and record
+only what changed.
+
+Each run leaves behind a hash index: a CSV of `nct_id` and the SHA-1
+of that trial's content, leaving out what changes with every dump
+(`PER_DUMP_FIELDS`) so that only real changes count. The next run reads it back and writes a
+change log of newline-delimited JSON, one line per added, modified or
+removed trial:
+
+    {"nct_id": "NCT...", "change": "modified", "record": {...}}
+
+`record` is the trial's new content, or null for removals. Replaying
+the change logs on top of the most recent full snapshot reproduces the
+JSON for any day.
+
+"""
+import csv
+import hashlib
+import json
+
+from compressed_output import open_input
+
+ADDED = "added"
+MODIFIED = "modified"
+REMOVED = "removed"
+
+# Paths to fields which differ in every dump whether or not the trial
+# changed, e.g. "ClinicalTrials.gov processed this data on March 12, 2018"
+PER_DUMP_FIELDS = [("clinical_study", "required_header", "download_date")]
+
+
+def nct_id_of(record):
+    """Return the NCT id of a trial's JSON, converted from the XML or
+    a ClinicalTrials.gov API v2 record
+
+    """
+    if "protocolSection" in record:
+        return record["protocolSection"]["identificationModule"]["nctId"]
+    return record["clinical_study"]["id_info"]["nct_id"]
+
+
+def content_hash(record):
+    """Return the SHA-1 of a trial's JSON without its `PER_DUMP_FIELDS`"""
+    for path in PER_DUMP_FIELDS:
+        parent = record
+        for key in path[:-1]:
+            parent = parent.get(key)
+            if not isinstance(parent, dict):
+                break
+        else:
+            if path[-1] in parent:
+                # Copy only the dicts on the way down, not the record
+                record = without_field(record, path)
+    content = json.dumps(record, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def without_field(record, path):
+    copy = dict(record)
+    if len(path) == 1:
+        del copy[path[0]]
+    else:
+        copy[path[0]] = without_field(record[path[0]], path[1:])
+    return copy
+
+
+def read_hash_index(index_path):
+    """Return a dict of nct_id -> hash from a hash index file, or None
+    if there is no previous index.
+
+    """
+    if index_path is None:
+        return None
+    try:
+        with open(index_path, newline="") as f:
+            return {nct_id: digest for nct_id, digest in csv.reader(f)}
+    except FileNotFoundError:
+        return None
+
+
+def change_line(nct_id, change, json_line=None):
+    # Splice the original line in rather than re-serialising it
+    return '{{"nct_id": {}, "change": "{}", "record": {}}}\n'.format(
+        json.dumps(nct_id), change, json_line or "null"
+    )
+
+
+def write_changelog(json_path, previous_index_path, changelog_path, index_path):
+    """Write a change log of `json_path` relative to the hash index at
+    `previous_index_path` to `changelog_path`, and a hash index of
+    `json_path` to `index_path`.
+
+    If there is no previous index, every trial is recorded as added.
+    `json_path` may be gzip or zstd compressed, as told by its suffix.
+    Returns a dict of counts by type of change.
+
+    """
+    previous = read_hash_index(previous_index_path) or {}
+    counts = {ADDED: 0, MODIFIED: 0, REMOVED: 0}
+    current = {}
+    with open_input(json_path) as source, open(changelog_path, "w") as changelog:
+        for line in source:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            record = json.loads(line)
+            nct_id = nct_id_of(record)
+            digest = content_hash(record)
+            current[nct_id] = digest
+            old_digest = previous.pop(nct_id, None)
+            if old_digest is None:
+                change = ADDED
+            elif old_digest != digest:
+                change = MODIFIED
+            else:
+                continue
+            counts[change] += 1
+            changelog.write(change_line(nct_id, change, line))
+        for nct_id in sorted(previous):
+            counts[REMOVED] += 1
+            changelog.write(change_line(nct_id, REMOVED))
+
+    with open(index_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        for nct_id in sorted(current):
+            writer.writerow([nct_id, current[nct_id]])
+    return counts
+
+
+def is_snapshot_day(day):
+    """Full snapshots are kept on the first of each month"""
+    return day.day == 1
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Make long conversions resumable.
+
+A `Checkpoint` splits each output of a conversion into segments of
+`segment_size` trials, in archive order. A segment is written to a
+temporary file, synced to disk and renamed into place before the
+manifest records it, so whatever the manifest lists is complete. A
+conversion restarted with the same manifest skips the trials it
+already covers, and `assemble` concatenates the segments into the
+final output. Uncompressed, that is byte for byte what an
+uninterrupted run would write. Compressed segments are independent
+gzip members or zstd frames, which concatenate into a valid stream
+that decompresses to the same content, although its members start at
+different offsets.
+
+The manifest also records a key, typically a fingerprint of the
+archive and the settings that affect the output; if that changes, the
+checkpoint starts again from nothing.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from compressed_output import compressed_path, open_output
+
+MANIFEST_NAME = "manifest.json"
+SEGMENT_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def archive_fingerprint(zip_file):
+    """Return a digest of the names, sizes and CRCs of the members of
+    an open `zipfile.ZipFile`, which changes if any member does.
+
+    """
+    digest = hashlib.sha1()
+    for info in zip_file.infolist():
+        digest.update(
+            "{}\0{}\0{}\n".format(info.filename, info.file_size, info.CRC).encode(
+                "utf-8"
+            )
+        )
+    return digest.hexdigest()
+
+
+def sync(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def write_atomically(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint(object):
+    def __init__(self, directory, key, outputs, segment_size=None):
+        """`outputs` is a dict of output name -> compression (or None)"""
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.outputs = outputs
+        self.segment_size = segment_size or SEGMENT_SIZE
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self.read_manifest()
+        fresh = {
+            "key": key,
+            "outputs": outputs,
+            "segment_size": self.segment_size,
+            "segments": 0,
+            "complete": False,
+        }
+        if any(
+            self.manifest.get(k) != fresh[k] for k in ("key", "outputs", "segment_size")
+        ):
+            if self.manifest:
+                logger.info(
+                    "Discarding checkpoint in %s for a different run", directory
+                )
+            self.clear()
+            self.manifest = fresh
+            self.write_manifest()
+        elif self.manifest["segments"]:
+            logger.info(
+                "Resuming from checkpoint in %s after %s trials",
+                directory,
+                self.done,
+            )
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_manifest(self):
+        write_atomically(self.manifest_path, json.dumps(self.manifest, indent=2))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    @property
+    def complete(self):
+        return self.manifest["complete"]
+
+    @property
+    def done(self):
+        """The number of trials covered by committed segments"""
+        return self.manifest["segments"] * self.segment_size
+
+    def segment_path(self, name, segment):
+        return compressed_path(
+            os.path.join(self.directory, "{}.{:06d}".format(name, segment)),
+            self.outputs[name],
+        )
+
+    def open_segment(self):
+        """Return a dict of output name -> file for the next segment"""
+        segment = self.manifest["segments"]
+        return {
+            name: open_output(self.segment_path(name, segment) + ".tmp", compression)
+            for name, compression in self.outputs.items()
+        }
+
+    def commit(self, files, complete=False):
+        """Durably add the segment written to `files`, which should
+        cover the next `segment_size` trials, or all the rest if
+        `complete`.
+
+        """
+        segment = self.manifest["segments"]
+        for name, f in files.items():
+            f.close()
+            path = self.segment_path(name, segment)
+            sync(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.manifest["segments"] = segment + 1
+        self.manifest["complete"] = complete
+        self.write_manifest()
+
+    def write(self, results, write_result):
+        """Write `(index, result)` pairs, in archive order and starting
+        from trial `done`, to segments, calling `write_result(files,
+        result)` to write each result to the files of its segment.
+
+        """
+        files = self.open_segment()
+        end = self.done + self.segment_size
+        for index, result in results:
+            while index >= end:
+                self.commit(files)
+                files = self.open_segment()
+                end += self.segment_size
+            write_result(files, result)
+        self.commit(files, complete=True)
+
+    def assemble(self, name, destination, header=""):
+        """Write `header` and then the segments of output `name` to
+        `destination`.
+
+        """
+        with open_output(destination, self.outputs[name]) as f:
+            f.write(header)
+        with open(destination, "ab") as target:
+            for segment in range(self.manifest["segments"]):
+                with open(self.segment_path(name, segment), "rb") as source:
+                    shutil.copyfileobj(source, target)
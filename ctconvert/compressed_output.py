@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Write large text outputs compressed, using several threads.
+
+Output is buffered into chunks of `CHUNK_SIZE` bytes, and each chunk
+is compressed on its own in a thread pool as a complete gzip member or
+zstd frame. Both formats allow such members to be concatenated, so
+the chunks are simply written out in order, and any gzip or zstd
+reader sees one stream. zlib and zstandard release the GIL while
+compressing, so the threads run in parallel.
+
+zstd needs the optional `zstandard` package.
+
+"""
+import collections
+import gzip
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+COMPRESSIONS = [GZIP, ZSTD]
+SUFFIXES = {None: "", GZIP: ".gz", ZSTD: ".zst"}
+
+CHUNK_SIZE = 8 * 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compressed_path(path, compression):
+    return path + SUFFIXES[compression]
+
+
+def gzip_chunk(data):
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def zstd_chunk(data):
+    # Compressors are not thread-safe, so each chunk gets its own
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def compressor(compression):
+    if compression == GZIP:
+        return gzip_chunk
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        return zstd_chunk
+    raise ValueError("Unknown compression {}".format(compression))
+
+
+class CompressedWriter(object):
+    """A writable text file that compresses its content in chunks, in
+    parallel, to `path`.
+
+    """
+
+    def __init__(self, path, compression, threads=None, chunk_size=CHUNK_SIZE):
+        self.compress = compressor(compression)
+        self.chunk_size = chunk_size
+        threads = threads or os.cpu_count()
+        self.max_pending = 2 * threads
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.file = open(path, "wb")
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.submit()
+        return len(text)
+
+    def submit(self):
+        chunk = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.executor.submit(self.compress, chunk))
+        # Write finished chunks in order, and wait rather than let
+        # compressed chunks pile up in memory
+        while self.pending and (
+            self.pending[0].done() or len(self.pending) > self.max_pending
+        ):
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            if self.buffer:
+                self.submit()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_output(path, compression=None):
+    """Open `path` for writing text, compressed if `compression` is
+    set. Returns a file-like object usable as a context manager.
+
+    """
+    if compression is None:
+        return open(path, "w", newline="", encoding="utf-8")
+    return CompressedWriter(path, compression)
+
+
+def open_input(path):
+    """Open `path` for reading text, decompressing it according to its
+    suffix.
+
+    """
+    if path.endswith(SUFFIXES[GZIP]):
+        return gzip.open(path, "rt", newline="", encoding="utf-8")
+    if path.endswith(SUFFIXES[ZSTD]):
+        compressor(ZSTD)
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(reader, newline="", encoding="utf-8")
+    return open(path, newline="", encoding="utf-8")
@@ -1,17 +1,44 @@
 # -*- coding: utf-8 -*-
+import argparse
+import collections
+import contextlib
+import functools
+import hashlib
 import logging
+import operator
+import re
 import sys
-
-from multiprocessing import Pool
-from bigquery import StorageClient
+import threading
+import time
+
+from multiprocessing import util
+from archive_cache import ArchiveCache
+from archive_index import ArchiveIndex
+import aggregates
+import bigquery_schema
+import changelog
+import ctgov_v2
+from checkpoint import Checkpoint, archive_fingerprint
+import profiler
+from compressed_output import COMPRESSIONS, compressed_path, open_input, open_output
+import executors
+from facts_store import FactsStore
+from executors import EXECUTORS, PROCESS, SERIAL
+import log_pipeline
+from rules import Predicate, RulePlan, merge_stats
+import sampling
+from scheduling import Utilization, balanced_batches
+from storage import GCSStorage, LocalStorage, partitioned_name
+from worker_pool import Limits, MemoryAwarePool
 import xmltodict
 import os
 import subprocess
 import json
 import glob
 import gzip
-import tempfile
+import io
 import shutil
+import tempfile
 import zipfile
 from bs4 import BeautifulSoup
 from datetime import date
@@ -21,17 +48,36 @@ from dateutil.relativedelta import relativedelta
 import csv
 from xml.parsers.expat import ExpatError
 
-# When multiprocessing, we write to separate files and combine them
-# later. Associated files are identified by things containing
-# FILE_FRAGMENT_SUFFIX and sharing a common left stem.
+# When multiprocessing, workers write reports to separate files which
+# we combine later. Associated files are identified by things
+# containing FILE_FRAGMENT_SUFFIX and sharing a common left stem.
 FILE_FRAGMENT_SUFFIX = ".pid_"
 
+# Documents are sent to workers in batches of this size, with at most
+# MAX_PENDING_BATCHES per worker in flight at a time
+BATCH_SIZE = 100
+MAX_PENDING_BATCHES = 4
+
+# How trials are sent to workers: in archive order, or largest first
+# within windows of SCHEDULE_WINDOW trials
+ARCHIVE_ORDER = "archive"
+LARGEST_FIRST = "largest-first"
+SCHEDULE_WINDOW = 10000
+
 STORAGE_PREFIX = "clinicaltrials/"
+ARCHIVE_NAME = STORAGE_PREFIX + "AllPublicXML.zip"
 INTERMEDIATE_CSV_NAME = "clinical_trials.csv"
 
+# Where the daily JSON is archived: as a datestamped file directly
+# under STORAGE_PREFIX, or partitioned by date under RAW_JSON_PREFIX,
+# which BigQuery can query by date (see `bigquery.Client`)
+FLAT_LAYOUT = "flat"
+HIVE_LAYOUT = "hive"
+RAW_JSON_PREFIX = STORAGE_PREFIX + "raw_json/"
+PARTITIONED_JSON_NAME = "raw_clinicaltrials.json"
+
 TMPDIR = tempfile.mkdtemp()
 
-logging.basicConfig(filename="/tmp/clinicaltrials.log", level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
@@ -45,256 +91,1782 @@ def name_fragment(base_file_path):
     return base_file_path + "{}{}".format(FILE_FRAGMENT_SUFFIX, os.getpid())
 
 
-def combine_fragments(base_file_path):
+def write_worker_report(base_file_path, report):
+    """Append `report` as a line of JSON to the current process's
+    fragment of `base_file_path`.
+
     """
+    with open(name_fragment(base_file_path), "a") as f:
+        f.write(json.dumps(report) + "\n")
+
+
+def read_worker_reports(base_file_path):
+    """Return all reports written by `write_worker_report` to fragments
+    of `base_file_path`, removing the fragments.
+
     """
-    with open(base_file_path, "w") as fdst:
-        for infile in sorted(glob.glob(base_file_path + FILE_FRAGMENT_SUFFIX + "*")):
-            with open(infile, "r") as fsrc:
-                shutil.copyfileobj(fsrc, fdst, 2 * 30)
-            os.remove(infile)
+    reports = []
+    for infile in sorted(glob.glob(base_file_path + FILE_FRAGMENT_SUFFIX + "*")):
+        with open(infile) as f:
+            reports.extend(json.loads(line) for line in f)
+        os.remove(infile)
+    return reports
 
 
 def wget_file(target, url):
     subprocess.check_call(["wget", "-q", "-O", target, url])
 
 
-def upload_to_cloud(source_path, target_path, make_public=False):
-    logger.info("Uploading to {} cloud".format(source_path))
-    client = StorageClient()
-    bucket = client.get_bucket()
-    blob = bucket.blob(target_path, chunk_size=1024 * 1024)
-    with open(source_path, "rb") as f:
-        blob.upload_from_file(f)
-    if make_public:
-        blob.make_public()
+def upload_to_cloud(
+    source_path,
+    target_path,
+    make_public=False,
+    content_type=None,
+    content_encoding=None,
+    cloud=None,
+):
+    """Upload a file to Cloud Storage, through the run's `GCSStorage`
+    `cloud` if given, as connecting to the bucket takes a round trip
+
+    """
+    (cloud or GCSStorage()).upload(
+        source_path,
+        target_path,
+        make_public=make_public,
+        content_type=content_type,
+        content_encoding=content_encoding,
+    )
+
+
+def is_trial_member(name):
+    """Whether `name` is a trial in the legacy XML archive, or in the
+    API v2 JSON export (see `ctgov_v2`)
+
+    """
+    return "NCT" in name and (name.endswith(".xml") or ctgov_v2.is_v2_member(name))
+
 
+def document_stream(zip_filename, start=0):
+    """Yield the name and content of each trial in a zip archive, given
+    as a path or a file object, from the `start`th trial on.
 
-def document_stream(zip_filename):
+    """
     with zipfile.ZipFile(zip_filename, "r") as enormous_zipfile:
-        for name in enormous_zipfile.namelist():
-            if "NCT" not in name or not name.endswith(".xml"):
-                continue
+        names = [name for name in enormous_zipfile.namelist() if is_trial_member(name)]
+        for name in names[start:]:
             yield name, enormous_zipfile.read(name)
 
 
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def convert_batch(worker, documents):
+    """Apply `worker` to each `(index, name, data)` in `documents`,
+    returning `(index, result)` pairs.
+
+    As when each document was a separate task, one that fails is
+    logged and skipped rather than stopping the run.
+
+    """
+    results = []
+    for index, name, data in documents:
+        try:
+            results.append((index, worker(name, data)))
+        except Exception:
+            logger.warning("Unable to convert %s", name, exc_info=True)
+    return results
+
+
+def timed_batch(func, batch):
+    started = time.time()
+    output = func(batch)
+    return started, time.time(), output
+
+
+def stream(
+    worker,
+    source,
+    processes=None,
+    initializer=None,
+    limits=None,
+    schedule=ARCHIVE_ORDER,
+    start=0,
+    indexed=False,
+    executor=PROCESS,
+):
+    """Lazily yield `worker(name, data)` for each trial in the zip
+    archive `source` (a path or file object), in archive order.
+
+    `worker` must be picklable (a module-level function or a
+    `functools.partial` of one). Work is spread over `processes`
+    workers (default: one per core), which are processes, threads or
+    this process according to `executor` (see `executors`); a single
+    worker is always this process. Only a few batches per worker are
+    in flight at once, so memory use does not grow with the size of
+    the archive.
+
+    Given `limits` (a `worker_pool.Limits`), worker processes are
+    recycled and large members handled separately as described in
+    `worker_pool`, and the memory high-water mark of each worker is
+    written to `worker_memory_path()`. Limits only apply to the
+    process executor.
+
+    With `schedule=LARGEST_FIRST`, trials are sent to workers in
+    size-balanced batches, largest first (see `stream_largest_first`);
+    results are still yielded in archive order.
+
+    The first `start` trials are skipped. With `indexed`, `(index,
+    result)` pairs are yielded, where `index` is the trial's position
+    in the archive; trials that failed to convert have no result.
+
+    """
+    if processes == 1:
+        executor = SERIAL
+    if schedule == LARGEST_FIRST:
+        results = stream_largest_first(
+            worker, source, processes, initializer, limits, start, executor
+        )
+    else:
+        results = (
+            result
+            for output in run_batches(
+                functools.partial(convert_batch, worker),
+                batches(indexed_documents(source, start), BATCH_SIZE),
+                processes,
+                initializer,
+                limits,
+                executor,
+            )
+            for result in output
+        )
+    for index, result in results:
+        yield (index, result) if indexed else result
+
+
+def indexed_documents(source, start=0):
+    for index, (name, data) in enumerate(document_stream(source, start), start):
+        yield index, name, data
+
+
+def stream_largest_first(
+    worker, source, processes, initializer, limits, start=0, executor=PROCESS
+):
+    """Yield `(index, worker(name, data))` for each trial in `source`
+    from the `start`th on, in archive order, having sent them to
+    workers largest first.
+
+    Sizes are read from the zip's central directory up front. Each
+    window of `SCHEDULE_WINDOW` trials is dealt into size-balanced
+    batches (see `scheduling.balanced_batches`), and its results are
+    put back in archive order once all its batches are done. Later
+    windows are already being converted meanwhile, so the pool never
+    waits for a window to finish.
+
+    Results arrive in the order their batches were sent, however the
+    pool splits them up (see `worker_pool.MemoryAwarePool.split`), so
+    a window is done once a result from a later one arrives.
+
+    """
+    with zipfile.ZipFile(source, "r") as enormous_zipfile:
+        infos = [
+            info
+            for info in enormous_zipfile.infolist()
+            if is_trial_member(info.filename)
+        ]
+
+        def dispatch():
+            for first in range(start, len(infos), SCHEDULE_WINDOW):
+                window = list(enumerate(infos[first : first + SCHEDULE_WINDOW], first))
+                for batch in balanced_batches(
+                    window, lambda item: item[1].file_size, BATCH_SIZE
+                ):
+                    yield [
+                        (index, info.filename, enormous_zipfile.read(info))
+                        for index, info in batch
+                    ]
+
+        def window_of(index):
+            return (index - start) // SCHEDULE_WINDOW
+
+        done = []
+        for output in run_batches(
+            functools.partial(convert_batch, worker),
+            dispatch(),
+            processes,
+            initializer,
+            limits,
+            executor,
+        ):
+            for pair in output:
+                if done and window_of(pair[0]) != window_of(done[0][0]):
+                    done.sort(key=lambda pair: pair[0])
+                    yield from done
+                    done = []
+                done.append(pair)
+        done.sort(key=lambda pair: pair[0])
+        yield from done
+
+
+def run_batches(
+    func, batches, processes=None, initializer=None, limits=None, executor=PROCESS
+):
+    """Yield `func(batch)` for each of `batches`, in order, computed by
+    the workers of `executor`. The pool's utilization over time is
+    written to `pool_utilization_path()` when all are done.
+
+    """
+    if executor == SERIAL:
+        processes = 1
+    processes = processes or os.cpu_count()
+    max_pending = MAX_PENDING_BATCHES * processes
+    utilization = Utilization(processes)
+    func = functools.partial(timed_batch, func)
+    memory_aware = limits is not None and executor == PROCESS
+    if memory_aware:
+        pool = MemoryAwarePool(processes, initializer=initializer, limits=limits)
+        outputs = pool.imap(func, batches, max_pending)
+    else:
+        outputs = executors.imap(
+            executor, func, batches, processes, initializer, max_pending
+        )
+    for started, finished, output in outputs:
+        utilization.add(started, finished)
+        yield output
+    if memory_aware:
+        write_worker_memory(pool.report())
+    write_pool_utilization(utilization)
+
+
+def pool_utilization_path():
+    return os.path.join(TMPDIR, "pool_utilization.csv")
+
+
+def write_pool_utilization(utilization):
+    with open(pool_utilization_path(), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["seconds", "busy_workers"])
+        writer.writerows(utilization.timeline())
+    summary = utilization.summary()
+    logger.info(
+        "Pool of %s busy %s of %ss; tail with idle workers %ss",
+        utilization.processes,
+        summary["utilization"],
+        summary["seconds"],
+        summary["tail_seconds"],
+    )
+
+
+def worker_memory_path():
+    return os.path.join(TMPDIR, "worker_memory.json")
+
+
+def write_worker_memory(report):
+    with open(worker_memory_path(), "w") as f:
+        json.dump(report, f, indent=2)
+    if report:
+        logger.info(
+            "Highest worker RSS %sMB; %s of %s workers recycled",
+            max(worker["peak_rss_mb"] for worker in report),
+            sum(worker["recycled"] for worker in report),
+            len(report),
+        )
+
+
 def zip_archive():
     return os.path.join(TMPDIR, "AllPublicXML.zip")
 
 
-def download_zipfile(local_only=False):
+def download_zipfile(local_only=False, cache_dir=None, partial_dir=None, cloud=None):
     """Download zipfile into a temp location, and back it up in Cloud Storage.
 
     If there is a copy from today in Cloud Storage, download from
     there instead (the download from CT.gov is very slow)
 
-    Setting `local_only` skips the Google Cloud steps.
-    """
-    destination_file_name = zip_archive()
+    Setting `local_only` skips the Google Cloud steps.
+
+    If `cache_dir` is given, downloads from CT.gov go through a local
+    `ArchiveCache` there, which revalidates with a conditional request
+    and reuses the cached archive when it is unchanged.
+
+    With `partial_dir`, a download from Cloud Storage is made there
+    rather than in TMPDIR (which is new for every run), so a run
+    restarted after an interruption resumes it, or reuses it if it had
+    finished. `main` removes it once the run succeeds.
+
+    `cloud` is the run's `GCSStorage`, if it already has one.
+    """
+    destination_file_name = zip_archive()
+
+    # First check if a recent version exists in cloud - this is much
+    # faster that downloading from CT.gov
+    downloaded = False
+    if not local_only:
+        cloud = cloud or GCSStorage()
+        updated = cloud.updated(ARCHIVE_NAME)
+        if updated and updated.strftime("%Y-%m-%d") == date.today().strftime(
+            "%Y-%m-%d"
+        ):
+            downloaded = cloud.download(
+                ARCHIVE_NAME, destination_file_name, partial_dir=partial_dir
+            )
+    if not downloaded:
+        # Download and cache in Google Cloud
+        logger.info(
+            "Downloading zipfile. This takes at least 30 mins on a fast connection!"
+        )
+        url = "https://clinicaltrials.gov/AllPublicXML.zip"
+        if cache_dir:
+            ArchiveCache(cache_dir).fetch(url, destination_file_name)
+        else:
+            wget_file(destination_file_name, url)
+        if not local_only:
+            upload_to_cloud(destination_file_name, ARCHIVE_NAME, cloud=cloud)
+
+
+# JSON generation
+#################
+
+
+def postprocessor(path, key, value):
+    """Convert key names to something bigquery-compatible, so it is
+    possible to import the JSON into bigquery tables.
+
+    """
+    if key.startswith("#") or key.startswith("@"):
+        key = key[1:]
+    if key == "clinical_results":
+        # Arbitrarily long field that we don't need, see #179
+        value = {"truncated_by_postprocessor": True}
+    return key, value
+
+
+def trial_to_dict(data, name=""):
+    """Return the dict of one trial that is written as JSON: its XML
+    converted by xmltodict, or, if `name` is a member of the v2 JSON
+    export, its record as it is.
+
+    """
+    if ctgov_v2.is_v2_member(name):
+        return ctgov_v2.loads(data)
+    return xmltodict.parse(data, item_depth=0, postprocessor=postprocessor)
+
+
+def trial_to_json(data, schema=None, name=""):
+    """Return the JSON for one trial's XML (or v2 JSON, as for
+    `trial_to_dict`), as a single line. With `schema` (a
+    `bigquery_schema.SchemaBuilder`), the trial is added to the schema
+    and written in its shape.
+
+    """
+    trial = trial_to_dict(data, name)
+    profiler.mark("parse")
+    if schema is not None:
+        trial = schema.add(trial)
+        profiler.mark("schema")
+    line = json.dumps(trial)
+    profiler.mark("serialize")
+    return line
+
+
+def parse_one_file(input_file_path, data):
+    """Return the name and parsed JSON-ready dict of one trial"""
+    return input_file_path, trial_to_dict(data, input_file_path)
+
+
+def convert_one_file_to_json(input_file_path, data, infer_schema=False):
+    """Return one trial as a line of JSON, or None if it cannot be
+    parsed. With `infer_schema`, the JSON is in the shape of this
+    process's `schema_builder()`.
+
+    """
+    logger.debug("Converting %s", input_file_path)
+    try:
+        schema = schema_builder() if infer_schema else None
+        return trial_to_json(data, schema, input_file_path) + "\n"
+    except ExpatError:
+        logger.warn("Unable to parse %s", input_file_path)
+        return None
+
+
+def iter_trials(
+    source, processes=None, limits=None, schedule=ARCHIVE_ORDER, executor=PROCESS
+):
+    """Yield `(name, trial)` for each trial in the zip archive `source`
+    (a path or file object), where `trial` is the dict that is written
+    as JSON.
+
+    """
+    return stream(
+        parse_one_file,
+        source,
+        processes=processes,
+        limits=limits,
+        schedule=schedule,
+        executor=executor,
+    )
+
+
+def convert_to_json(
+    processes=None,
+    compression=None,
+    limits=None,
+    schedule=ARCHIVE_ORDER,
+    profile=None,
+    checkpoint_dir=None,
+    executor=PROCESS,
+    infer_schema=False,
+    schema_seed=None,
+):
+    """Write the JSON of every trial to `raw_json_path()`, plus a
+    suffix for the `compression` if set.
+
+    With `infer_schema`, a BigQuery schema for the JSON is written to
+    `raw_json_schema_path()`, starting from `schema_seed` (the schema
+    of a previous run) if given; see `write_raw_json_schema`.
+
+    With `profile` (a `profiler.Options`), the slowest trials are
+    reported in `profile_path("json")`.
+
+    With `checkpoint_dir`, progress is saved there so that an
+    interrupted conversion can be resumed; see `write_outputs`.
+
+    """
+    logger.info("Converting to JSON...")
+    global SCHEMA_SEED
+    SCHEMA_SEED = schema_seed
+    worker = convert_one_file_to_json
+    if infer_schema:
+        worker = functools.partial(worker, infer_schema=True)
+
+    def convert(start, indexed):
+        return stream(
+            profiled(worker, "json", profile),
+            zip_archive(),
+            processes,
+            limits=limits,
+            schedule=schedule,
+            start=start,
+            indexed=indexed,
+            executor=executor,
+        )
+
+    def write_result(files, line):
+        if line is not None:
+            files["json"].write(line)
+
+    resumed = write_outputs(
+        convert,
+        {"json": (compressed_path(raw_json_path(), compression), compression, "")},
+        write_result,
+        checkpoint_dir and os.path.join(checkpoint_dir, "json"),
+        {
+            # The JSON depends on the schema it starts from
+            "schema": infer_schema
+            and hashlib.sha1(json.dumps(schema_seed).encode("utf8")).hexdigest()
+        },
+    )
+    if infer_schema:
+        write_raw_json_schema(schema_seed, compression, resumed)
+    if profile is not None:
+        write_profile("json", profile)
+
+
+RAW_JSON_SCHEMA_NAME = "raw_clinicaltrials_json_schema.json"
+
+# The schema each process's SchemaBuilder starts from. Like
+# `fda_reg_dict`, a global so that forked workers inherit it
+SCHEMA_SEED = None
+# This process's SchemaBuilder, once created
+SCHEMA_BUILDER = None
+SCHEMA_LOCK = threading.Lock()
+
+
+def raw_json_schema_path():
+    return os.path.join(TMPDIR, RAW_JSON_SCHEMA_NAME)
+
+
+def schema_report_path():
+    return os.path.join(TMPDIR, "raw_json_schema_report.json")
+
+
+def schema_builder():
+    """Return this process's `bigquery_schema.SchemaBuilder`, which is
+    reported when the process exits.
+
+    """
+    global SCHEMA_BUILDER
+    if SCHEMA_BUILDER is None:
+        with SCHEMA_LOCK:
+            if SCHEMA_BUILDER is None:
+                builder = bigquery_schema.SchemaBuilder(SCHEMA_SEED)
+                builder.finalizer = util.Finalize(
+                    None,
+                    lambda: write_worker_report(schema_report_path(), builder.report()),
+                    exitpriority=10,
+                )
+                SCHEMA_BUILDER = builder
+    return SCHEMA_BUILDER
+
+
+def write_raw_json_schema(seed=None, compression=None, resumed=False):
+    """Merge the schema of each worker into `raw_json_schema_path()`.
+
+    If the workers wrote some trials before widening the schema to fit
+    later ones, or if the JSON was partly written by an earlier,
+    interrupted run whose schema is unknown, the JSON is rewritten to
+    fit the final schema.
+
+    """
+    global SCHEMA_BUILDER
+    reports = read_worker_reports(schema_report_path())
+    if SCHEMA_BUILDER is not None:
+        # Run in this process, so report now rather than at exit
+        SCHEMA_BUILDER.finalizer.cancel()
+        reports.append(SCHEMA_BUILDER.report())
+        SCHEMA_BUILDER = None
+    fields, written = bigquery_schema.merge_reports(seed, reports)
+    if resumed or not bigquery_schema.conforms(fields, written):
+        logger.info("Rewriting JSON to fit its widened schema...")
+        fields = bigquery_schema.conform_file(
+            compressed_path(raw_json_path(), compression), fields, compression
+        )
+    schema = bigquery_schema.to_bigquery(fields)
+    with open(raw_json_schema_path(), "w") as f:
+        json.dump(schema, f, indent=2)
+    return schema
+
+
+# CSV generation
+################
+
+EFFECTIVE_DATE = date(2017, 1, 18)
+CS = "clinical_study"
+CSV_HEADERS = [
+    "nct_id",
+    "act_flag",
+    "included_pact_flag",
+    "has_results",
+    "pending_results",
+    "pending_data",
+    "has_certificate",
+    "results_due",
+    "start_date",
+    "available_completion_date",
+    "used_primary_completion_date",
+    "defaulted_pcd_flag",
+    "defaulted_cd_flag",
+    "results_submitted_date",
+    "last_updated_date",
+    "certificate_date",
+    "phase",
+    "enrollment",
+    "location",
+    "study_status",
+    "study_type",
+    "primary_purpose",
+    "sponsor",
+    "sponsor_type",
+    "collaborators",
+    "exported",
+    "fda_reg_drug",
+    "fda_reg_device",
+    "is_fda_regulated",
+    "url",
+    "title",
+    "official_title",
+    "brief_title",
+    "discrep_date_status",
+    "late_cert",
+    "defaulted_date",
+    "condition",
+    "condition_mesh",
+    "intervention",
+    "intervention_mesh",
+    "keywords",
+]
+# The CSV fields that hold dates (or None)
+DATE_FIELDS = [
+    "start_date",
+    "available_completion_date",
+    "results_submitted_date",
+    "last_updated_date",
+    "certificate_date",
+]
+
+
+class TrialRecord(object):
+    """A CSV row: the value of each of `CSV_HEADERS`, with booleans as
+    the ints written to the CSV.
+
+    Records have a slot per field rather than a dict, and are pickled
+    as a bare tuple of values (see `pack`), so they take less memory
+    and fewer bytes than a row dict when sent back from workers in
+    batches. Fields can be read as attributes or by name, like a dict.
+
+    """
+
+    __slots__ = tuple(CSV_HEADERS)
+    get_values = operator.attrgetter(*CSV_HEADERS)
+    date_positions = [CSV_HEADERS.index(name) for name in DATE_FIELDS]
+    title_position = CSV_HEADERS.index("title")
+
+    def __init__(self, values):
+        for name, value in zip(CSV_HEADERS, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        """Make a record of a row dict, as returned by `derive_row`"""
+        return cls(
+            int(value) if isinstance(value, bool) else value
+            for value in map(row.get, CSV_HEADERS)
+        )
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def values(self):
+        """Return the fields' values, in the order of `CSV_HEADERS`"""
+        return TrialRecord.get_values(self)
+
+    def as_dict(self):
+        return dict(zip(CSV_HEADERS, self.values()))
+
+    def derived_title(self):
+        if self.official_title is not None:
+            return self.official_title
+        return self.brief_title
+
+    def pack(self):
+        """Return the values as a tuple of ints, strings and None, with
+        dates as ordinals and the title (usually a copy of another
+        field) as `...` if it can be derived.
+
+        """
+        values = list(self.values())
+        for i in self.date_positions:
+            if values[i] is not None:
+                values[i] = values[i].toordinal()
+        if self.title == self.derived_title():
+            values[self.title_position] = ...
+        return tuple(values)
+
+    @classmethod
+    def unpack(cls, values):
+        record = cls(values)
+        for name in DATE_FIELDS:
+            if getattr(record, name) is not None:
+                setattr(record, name, date.fromordinal(getattr(record, name)))
+        if record.title is ...:
+            record.title = record.derived_title()
+        return record
+
+    def __reduce__(self):
+        return TrialRecord.unpack, (self.pack(),)
+
+
+# Results are due a year and 30 days after completion, or three years
+# and 30 days after completion for trials with a certificate of delay
+RESULTS_DUE_AFTER = relativedelta(years=1, days=30)
+CERTIFIED_RESULTS_DUE_AFTER = relativedelta(years=3, days=30)
+
+# Statuses inconsistent with a completion date in the past
+NOT_ONGOING = frozenset(
+    [
+        "Unknown status",
+        "Active, not recruiting",
+        "Not yet recruiting",
+        "Enrolling by invitation",
+        "Suspended",
+        "Recruiting",
+    ]
+)
+
+
+def latest_date_before(as_of, delta):
+    """Return the latest date `d` for which `d + delta < as_of`.
+
+    `d + delta` is monotonic in `d`, but adding years is not exactly
+    reversible around 29 February, hence the adjustment steps.
+
+    """
+    one_day = timedelta(days=1)
+    d = as_of - delta
+    while d + delta >= as_of:
+        d -= one_day
+    while d + one_day + delta < as_of:
+        d += one_day
+    return d
+
+
+class AsOf(object):
+    """The date against which time-dependent flags are evaluated, with
+    thresholds precomputed so that each row needs only date comparisons.
+
+    """
+
+    def __init__(self, as_of):
+        self.date = as_of
+        # A completion date on or before these means results are due
+        self.results_due_cutoff = latest_date_before(as_of, RESULTS_DUE_AFTER)
+        self.certified_results_due_cutoff = latest_date_before(
+            as_of, CERTIFIED_RESULTS_DUE_AFTER
+        )
+
+
+def set_fda_reg_dict():
+    """Generate a dictionary for looking up FDA regulation flags from a
+    snapshot of CT.gov at a time when it included such flags.
+
+    """
+    # We use globals as a convenient way to access this from child
+    # processes
+    global fda_reg_dict
+    fda_reg_dict = {}
+    snapshot = gzip.open(
+        os.path.join(os.path.dirname(__file__), "fdaaa_regulatory_snapshot.csv.gz"),
+        "rt",
+    )
+
+    with snapshot as old_fda_reg:
+        reader = csv.DictReader(old_fda_reg)
+        for d in reader:
+            fda_reg_dict[d["nct_id"]] = d["is_fda_regulated"]
+
+
+def generated_csv_path():
+    return os.path.join(TMPDIR, INTERMEDIATE_CSV_NAME)
+
+
+def raw_json_name():
+    date = datetime.now().strftime("%Y-%m-%d")
+    return "raw_clincialtrials_json_{}.csv".format(date)
+
+
+def raw_json_path():
+    """The (datestamped) path of the JSON file we generate and store in
+    BigQuery on each run
+
+    """
+    return os.path.join(TMPDIR, raw_json_name())
+
+
+def raw_json_storage_name(layout=FLAT_LAYOUT, compression=None):
+    """The name under which the JSON is archived in Cloud Storage"""
+    if layout == HIVE_LAYOUT:
+        name = partitioned_name(
+            RAW_JSON_PREFIX, datetime.now().date(), PARTITIONED_JSON_NAME
+        )
+    else:
+        name = STORAGE_PREFIX + raw_json_name()
+    return compressed_path(name, compression)
+
+
+HASH_INDEX_NAME = "raw_clinicaltrials_hashes.csv"
+
+
+def run_storage(name, local_only=False, cache_dir=None, cloud=None):
+    """Return `(storage, name)` for a file kept from one run to the
+    next: in Cloud Storage (the run's `GCSStorage` `cloud`, if given),
+    or in `cache_dir` when running locally. `storage` is None for local
+    runs without a `cache_dir`.
+
+    """
+    if not local_only:
+        return cloud or GCSStorage(), STORAGE_PREFIX + name
+    if cache_dir:
+        return LocalStorage(cache_dir), name
+    return None, name
+
+
+def changelog_name():
+    date = datetime.now().strftime("%Y-%m-%d")
+    return "raw_clinicaltrials_changes_{}.json".format(date)
+
+
+def changelog_path():
+    return os.path.join(TMPDIR, changelog_name())
+
+
+def update_changelog(local_only=False, cache_dir=None, compression=None, cloud=None):
+    """Write a change log of today's raw JSON against the previous
+    run's hash index, and today's index to `hash_index_path()`.
+
+    The index is kept in Cloud Storage, or in `cache_dir` when running
+    locally. Returns True if today's full JSON should also be archived,
+    which is the case on snapshot days and when there was no previous
+    index to compare against.
+
+    Today's index is only stored for the next run by
+    `store_hash_index`, once everything it describes is stored too.
+    Otherwise a run failing after this would leave today's changes out
+    of every change log.
+
+    """
+    logger.info("Comparing JSON with previous run...")
+    previous_index_path = os.path.join(TMPDIR, "previous_" + HASH_INDEX_NAME)
+    index_storage, index_name = run_storage(
+        HASH_INDEX_NAME, local_only, cache_dir, cloud
+    )
+    has_previous = index_storage is not None and index_storage.download(
+        index_name, previous_index_path
+    )
+
+    counts = changelog.write_changelog(
+        compressed_path(raw_json_path(), compression),
+        previous_index_path if has_previous else None,
+        changelog_path(),
+        hash_index_path(),
+    )
+    logger.info("Changes since previous run: %s", counts)
+    return not has_previous or changelog.is_snapshot_day(date.today())
+
+
+def hash_index_path():
+    return os.path.join(TMPDIR, HASH_INDEX_NAME)
+
+
+def store_hash_index(local_only=False, cache_dir=None, cloud=None):
+    """Keep the index written by `update_changelog` for the next run"""
+    index_storage, index_name = run_storage(
+        HASH_INDEX_NAME, local_only, cache_dir, cloud
+    )
+    if index_storage is not None:
+        index_storage.upload(hash_index_path(), index_name)
+
+
+FACTS_NAME = "trial_facts.json"
+
+# The raw fields of each trial that `derive_row` consumes, in the
+# order they are stored in the facts file
+FACT_HEADERS = [
+    "nct_id",
+    "study_type",
+    "phase",
+    "study_status",
+    "primary_purpose",
+    "fda_reg_drug",
+    "fda_reg_device",
+    "start_date",
+    "primary_completion_date",
+    "defaulted_pcd_flag",
+    "completion_date",
+    "defaulted_cd_flag",
+    "intervention_types",
+    "location_countries",
+    "location",
+    "has_certificate",
+    "certificate_date",
+    "has_results",
+    "results_submitted_date",
+    "pending_results",
+    "pending_data",
+    "last_updated_date",
+    "enrollment",
+    "sponsor",
+    "sponsor_type",
+    "collaborators",
+    "exported",
+    "url",
+    "official_title",
+    "brief_title",
+    "condition",
+    "condition_mesh",
+    "intervention",
+    "intervention_mesh",
+    "keywords",
+]
+DATE_FACTS = [
+    "start_date",
+    "primary_completion_date",
+    "completion_date",
+    "certificate_date",
+    "results_submitted_date",
+    "last_updated_date",
+]
+
+
+def trial_facts_path():
+    return os.path.join(TMPDIR, FACTS_NAME)
+
+
+def facts_to_line(facts):
+    """Serialise facts as a JSON array in FACT_HEADERS order"""
+    values = []
+    for k in FACT_HEADERS:
+        v = facts[k]
+        if k in DATE_FACTS and v is not None:
+            v = v.isoformat()
+        values.append(v)
+    return json.dumps(values, separators=(",", ":")) + "\n"
+
+
+def facts_from_line(line):
+    facts = dict(zip(FACT_HEADERS, json.loads(line)))
+    for k in DATE_FACTS:
+        if facts[k] is not None:
+            facts[k] = datetime.strptime(facts[k], "%Y-%m-%d").date()
+    return facts
+
+
+def iter_rows(
+    source,
+    processes=None,
+    as_of=None,
+    included_only=True,
+    limits=None,
+    schedule=ARCHIVE_ORDER,
+    executor=PROCESS,
+):
+    """Yield the CSV row of each trial in the zip archive `source` (a
+    path or file object) as a `TrialRecord`, as written to the CSV.
+
+    Unless `included_only` is false, only ACT and pACT trials are
+    included, as in the CSV.
+
+    """
+    set_fda_reg_dict()
+    worker = functools.partial(
+        convert_one_file_to_csv,
+        thresholds=AsOf(as_of or date.today()),
+        included_only=included_only,
+    )
+    for _, row in stream(
+        worker,
+        source,
+        processes=processes,
+        limits=limits,
+        schedule=schedule,
+        executor=executor,
+    ):
+        if row is not None:
+            yield row
+
+
+def convert_to_csv(
+    store_facts=False,
+    as_of=None,
+    processes=None,
+    compression=None,
+    limits=None,
+    schedule=ARCHIVE_ORDER,
+    profile=None,
+    checkpoint_dir=None,
+    executor=PROCESS,
+):
+    """Convert unzipped CT.gov XML to a CSV format used in the web app.
+
+    If `store_facts` is set, the raw fields of every trial are also
+    written to `trial_facts_path()`, from which `derive_csv` can
+    rebuild the CSV without parsing any XML.
+
+    The conditions, interventions, MeSH terms, collaborators and
+    keywords of the trials in the CSV are also written one per line to
+    `terms_path()`; see `row_terms`.
+
+    Time-dependent flags are evaluated as of the date `as_of`, or
+    today.
+
+    The included trials are counted by sponsor, phase, etc. as they are
+    converted, and the counts written to `aggregates_path()`; see
+    `aggregates`.
+
+    With `compression`, the CSV is compressed and its path gets the
+    corresponding suffix.
+
+    With `profile` (a `profiler.Options`), the slowest trials are
+    reported in `profile_path("csv")`.
+
+    With `checkpoint_dir`, progress is saved there so that an
+    interrupted conversion can be resumed; see `write_outputs`. The
+    rule counts then only cover the trials converted since resuming.
+
+    """
+    set_fda_reg_dict()
+    thresholds = AsOf(as_of or date.today())
+    logger.info("Converting to CSV as of %s...", thresholds.date)
+    worker = functools.partial(
+        convert_one_file_to_csv, store_facts=store_facts, thresholds=thresholds
+    )
+    ELIGIBILITY.reset_stats()
+    AGGREGATES.reset()
+
+    def convert(start, indexed):
+        # Process the files in as many processes as possible
+        return stream(
+            profiled(worker, "csv", profile),
+            zip_archive(),
+            processes,
+            initializer=init_csv_worker,
+            limits=limits,
+            schedule=schedule,
+            start=start,
+            indexed=indexed,
+            executor=executor,
+        )
+
+    def write_result(files, result):
+        facts_line, row = result
+        if facts_line is not None:
+            files["facts"].write(facts_line)
+        if row is not None:
+            files["csv"].write(csv_line(row))
+            files["terms"].write(terms_lines(row))
+
+    outputs = {
+        "csv": (
+            compressed_path(generated_csv_path(), compression),
+            compression,
+            ",".join(CSV_HEADERS) + "\r\n",
+        ),
+        "terms": (
+            compressed_path(terms_path(), compression),
+            compression,
+            ",".join(TERM_HEADERS) + "\r\n",
+        ),
+    }
+    if store_facts:
+        outputs["facts"] = (trial_facts_path(), None, json.dumps(FACT_HEADERS) + "\n")
+    resumed = write_outputs(
+        convert,
+        outputs,
+        write_result,
+        checkpoint_dir and os.path.join(checkpoint_dir, "csv"),
+        {"as_of": thresholds.date.isoformat()},
+    )
+    # Worker processes report their rule counters; when run in this
+    # process or in threads, they are in our own ELIGIBILITY
+    write_rule_stats(
+        read_worker_reports(rule_stats_path()) or [ELIGIBILITY.stats()]
+    )
+    # Likewise for the aggregates, unless some trials were converted by
+    # an earlier run, in which case they are counted from the CSV
+    worker_aggregates = read_worker_reports(aggregates_path()) or [AGGREGATES.stats()]
+    if resumed:
+        worker_aggregates = [
+            aggregate_csv(compressed_path(generated_csv_path(), compression))
+        ]
+    write_aggregates(worker_aggregates)
+    if profile is not None:
+        write_profile("csv", profile)
+
+
+def write_outputs(convert, outputs, write_result, checkpoint_dir=None, settings=None):
+    """Write the results of a conversion to one or more files.
+
+    `outputs` is a dict of output name -> `(path, compression,
+    header)`. `convert(start, indexed)` should return the results of
+    `stream(..., start=start, indexed=indexed)`, and
+    `write_result(files, result)` write one result to a dict of output
+    name -> open file.
+
+    With `checkpoint_dir`, outputs are written in segments which are
+    recorded in a `checkpoint.Checkpoint` there. If a checkpoint for
+    the same archive and `settings` is found, only the trials after
+    its last segment are converted. The outputs hold the same content
+    either way, although compressed ones may be split into gzip members
+    or zstd frames differently.
+
+    Returns whether any trials were taken from an earlier run's
+    checkpoint.
+
+    """
+    if checkpoint_dir is None:
+        with contextlib.ExitStack() as stack:
+            files = {}
+            for name, (path, compression, header) in outputs.items():
+                files[name] = stack.enter_context(open_output(path, compression))
+                files[name].write(header)
+            for result in convert(0, False):
+                write_result(files, result)
+        return False
+
+    with zipfile.ZipFile(zip_archive()) as enormous_zipfile:
+        key = dict(settings or {}, archive=archive_fingerprint(enormous_zipfile))
+    checkpoint = Checkpoint(
+        checkpoint_dir,
+        key,
+        {name: compression for name, (_, compression, _) in outputs.items()},
+    )
+    resumed = checkpoint.done > 0
+    if not checkpoint.complete:
+        checkpoint.write(convert(checkpoint.done, True), write_result)
+    for name, (path, _, header) in outputs.items():
+        checkpoint.assemble(name, path, header)
+    return resumed
+
+
+# Guards creating each process's DocumentProfiler, which its threads share
+PROFILER_LOCK = threading.Lock()
+
+
+def profile_path(stage):
+    return os.path.join(TMPDIR, "profile_{}.json".format(stage))
+
+
+def profiled(worker, stage, options):
+    """Return `worker`, wrapped to record its slowest trials if
+    `options` is set.
+
+    """
+    if options is None:
+        return worker
+    return functools.partial(profile_document, worker, profile_path(stage), options)
+
+
+def profile_document(worker, report_path, options, name, data):
+    if profiler.ACTIVE is None:
+        with PROFILER_LOCK:
+            if profiler.ACTIVE is None:
+                active = profiler.DocumentProfiler(options)
+                active.finalizer = util.Finalize(
+                    None,
+                    lambda: write_worker_report(report_path, active.report()),
+                    exitpriority=10,
+                )
+                profiler.ACTIVE = active
+    return profiler.ACTIVE.run(
+        worker, name, data, functools.partial(without_counting, worker)
+    )
+
+
+def without_counting(worker, name, data):
+    """Return `worker(name, data)` without counting the trial in the
+    rule counters or aggregates, as when converting it again
+
+    """
+    with ELIGIBILITY.uncounted(), AGGREGATES.uncounted():
+        return worker(name, data)
+
+
+def write_profile(stage, options):
+    """Merge the reports of the slowest trials from each worker into
+    `profile_path(stage)`.
+
+    """
+    reports = read_worker_reports(profile_path(stage))
+    if profiler.ACTIVE is not None:
+        # Run in this process, so report now rather than at exit
+        profiler.ACTIVE.finalizer.cancel()
+        reports.append(profiler.ACTIVE.report())
+        profiler.ACTIVE = None
+    merged = profiler.merge_reports(reports, options.top_k)
+    with open(profile_path(stage), "w") as f:
+        json.dump(merged, f, indent=2)
+    for entry in merged["slowest"][:5]:
+        logger.info(
+            "Slow %s conversion: %s (%s bytes) took %ss",
+            stage,
+            entry["name"],
+            entry["bytes"],
+            entry["seconds"],
+        )
+    return merged
+
+
+def rule_stats_path():
+    return os.path.join(TMPDIR, "rule_stats.json")
+
+
+AGGREGATES_NAME = "trial_aggregates.csv"
+# Counts of the trials in the CSV by sponsor, phase, etc.
+AGGREGATES = aggregates.Aggregates()
+
+
+def aggregates_path():
+    return os.path.join(TMPDIR, AGGREGATES_NAME)
+
+
+def init_csv_worker():
+    """Start each worker with empty rule counters and aggregates, and
+    arrange for them to be reported when it exits.
+
+    """
+    ELIGIBILITY.reset_stats()
+    AGGREGATES.reset()
+    util.Finalize(
+        None,
+        lambda: write_worker_report(rule_stats_path(), ELIGIBILITY.stats()),
+        exitpriority=10,
+    )
+    util.Finalize(
+        None,
+        lambda: write_worker_report(aggregates_path(), AGGREGATES.stats()),
+        exitpriority=10,
+    )
+
+
+def write_rule_stats(stats_list):
+    """Merge the rule counters of each worker and write them to
+    `rule_stats_path()`.
+
+    """
+    stats = merge_stats(stats_list)
+    with open(rule_stats_path(), "w") as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+    logger.info("Eligibility rule counts: %s", json.dumps(stats["rules"]))
+    return stats
+
+
+def write_aggregates(stats_list):
+    """Merge the aggregates of each worker and write them to
+    `aggregates_path()`.
+
+    """
+    stats = aggregates.merge_stats(stats_list)
+    aggregates.write_csv(aggregates_path(), stats)
+    return stats
+
+
+def aggregate_csv(csv_path):
+    """Return the aggregates of the trials in a CSV already written"""
+    counts = aggregates.Aggregates()
+    with open_input(csv_path) as f:
+        for row in csv.DictReader(f):
+            for name in aggregates.METRICS:
+                row[name] = row[name] == "1"
+            counts.add(row)
+    return counts.stats()
+
+
+def read_facts(facts_path):
+    """Yield the facts of each trial in a facts file"""
+    with open(facts_path) as f:
+        headers = json.loads(f.readline())
+        if headers != FACT_HEADERS:
+            raise ValueError(
+                "{} was written with different fields; reconvert the archive".format(
+                    facts_path
+                )
+            )
+        for line in f:
+            yield facts_from_line(line)
+
+
+def derive_included_rows(facts_path, thresholds):
+    """Yield the facts and CSV row of each included trial in a facts
+    file, evaluated as of `thresholds`.
+
+    """
+    return included_rows(read_facts(facts_path), thresholds)
+
+
+def included_rows(trial_facts, thresholds):
+    """Yield the facts and CSV row of each included trial among
+    `trial_facts`, evaluated as of `thresholds`.
+
+    """
+    for facts in trial_facts:
+        try:
+            td = derive_row(facts, thresholds)
+        except TypeError:
+            # As when converting, a trial whose dates cannot be
+            # compared is left out
+            logger.warning("Unable to derive a row for %s", facts["nct_id"])
+            continue
+        if is_included(td):
+            yield facts, td
+
+
+def derive_csv(facts_path, as_of=None):
+    """Rebuild the CSV from a facts file written by `convert_to_csv`.
+
+    This applies the current ACT/pACT logic without touching the XML
+    archive, so changes to the rules can be re-run in seconds. The
+    terms CSV and the aggregates are rebuilt too.
+
+    """
+    set_fda_reg_dict()
+    thresholds = AsOf(as_of or date.today())
+    logger.info("Deriving CSV from %s as of %s...", facts_path, thresholds.date)
+    ELIGIBILITY.reset_stats()
+    AGGREGATES.reset()
+    with contextlib.ExitStack() as stack:
+        out, terms_out = (
+            stack.enter_context(open(path, "w", newline="", encoding="utf-8"))
+            for path in (generated_csv_path(), terms_path())
+        )
+        writer = csv.DictWriter(out, fieldnames=CSV_HEADERS)
+        writer.writeheader()
+        terms_writer = csv.writer(terms_out)
+        terms_writer.writerow(TERM_HEADERS)
+        for _, td in derive_included_rows(facts_path, thresholds):
+            writer.writerow(convert_bools_to_ints(td))
+            terms_writer.writerows(row_terms(td))
+            AGGREGATES.add(td)
+    write_rule_stats([ELIGIBILITY.stats()])
+    write_aggregates([AGGREGATES.stats()])
+    return generated_csv_path()
+
+
+def as_of_series_paths():
+    return (
+        os.path.join(TMPDIR, "as_of_counts.csv"),
+        os.path.join(TMPDIR, "as_of_transitions.csv"),
+    )
+
+
+def as_of_series(facts_path, first_date, last_date):
+    """Evaluate the time-dependent flags of every included trial for
+    each date from `first_date` to `last_date`, in one pass over a
+    facts file.
+
+    Each flag is false until some date and true from then on, so it is
+    enough to find that transition date for each trial. Writes two
+    CSVs, whose paths are returned: the number of trials with each
+    flag set for every as-of date, and the transition dates of each
+    trial.
+
+    """
+    set_fda_reg_dict()
+    logger.info("Evaluating flags from %s to %s...", first_date, last_date)
+    counts_path, transitions_path = as_of_series_paths()
+    flags = ["results_due", "discrep_date_status"]
+    days = (last_date - first_date).days + 1
+    # new_from[flag][i] counts trials whose flag becomes true on
+    # first_date + i days
+    new_from = {flag: [0] * days for flag in flags}
+    with open(transitions_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["nct_id"] + [flag + "_from" for flag in flags])
+        for facts, td in derive_included_rows(facts_path, AsOf(first_date)):
+            transitions = flag_transitions(facts, td)
+            if not any(transitions.values()):
+                continue
+            writer.writerow([td["nct_id"]] + [transitions[flag] for flag in flags])
+            for flag in flags:
+                if transitions[flag] and transitions[flag] <= last_date:
+                    i = max((transitions[flag] - first_date).days, 0)
+                    new_from[flag][i] += 1
+
+    with open(counts_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["as_of"] + flags)
+        totals = {flag: 0 for flag in flags}
+        for i in range(days):
+            for flag in flags:
+                totals[flag] += new_from[flag][i]
+            writer.writerow(
+                [first_date + timedelta(days=i)] + [totals[flag] for flag in flags]
+            )
+    return counts_path, transitions_path
+
+
+# Dates in the names of snapshot archives, as 2018-06-01 or 20180601
+SNAPSHOT_DATE = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})")
+
+
+def backfill_facts_path():
+    """The `FactsStore` of the distinct documents being backfilled"""
+    return os.path.join(TMPDIR, "backfill_facts.sqlite")
+
+
+def snapshot_date(path, infos):
+    """Return the date of a snapshot archive: the date in its name, or
+    else that of the latest of its trials `infos`
+
+    """
+    match = SNAPSHOT_DATE.search(os.path.basename(path))
+    if match:
+        return date(*(int(part) for part in match.groups()))
+    return max(date(*info.date_time[:3]) for info in infos)
+
+
+def document_key(info):
+    """Identify a trial's document across archives, by the `ZipInfo`
+    of its member: an unchanged trial has the same name, CRC32 and
+    size in every snapshot.
+
+    """
+    return os.path.basename(info.filename), info.CRC, info.file_size
+
+
+def document_facts_line(name, data):
+    return facts_to_line(parse_document(name, data))
+
+
+def backfill_csv_path(as_of):
+    return os.path.join(TMPDIR, "clinical_trials_{}.csv".format(as_of.isoformat()))
+
+
+def write_snapshot_csvs(snapshots):
+    """Write the CSV of each `(path, as_of)` snapshot in `snapshots`
+    from the facts in `backfill_facts_path()`, returning their paths
+
+    """
+    paths = []
+    with FactsStore(backfill_facts_path()) as store:
+        for path, as_of in snapshots:
+            with zipfile.ZipFile(path) as archive:
+                keys = [
+                    document_key(info)
+                    for info in archive.infolist()
+                    if is_trial_member(info.filename)
+                ]
+            lines = (store.get(key) for key in keys)
+            trial_facts = (facts_from_line(line) for line in lines if line)
+            csv_path = backfill_csv_path(as_of)
+            with open(csv_path, "w", newline="", encoding="utf-8") as out:
+                writer = csv.DictWriter(out, fieldnames=CSV_HEADERS)
+                writer.writeheader()
+                for _, td in included_rows(trial_facts, AsOf(as_of)):
+                    writer.writerow(convert_bools_to_ints(td))
+            paths.append(csv_path)
+    return paths
+
+
+def backfill(snapshot_paths, processes=None, executor=PROCESS):
+    """Write the CSV of each of a series of archived snapshots, as of
+    the snapshot's date (see `snapshot_date`), returning a dict of
+    their paths by date.
+
+    Most trials are unchanged from one snapshot to the next, so the
+    documents in all the snapshots are deduplicated by `document_key`
+    from the zips' central directories, and each distinct document is
+    parsed only once, in one pass over the pool. Their facts are kept
+    in a `FactsStore` on disk, from which the snapshots' CSVs are then
+    derived in parallel.
+
+    """
+    if processes == 1:
+        executor = SERIAL
+    set_fda_reg_dict()
+    snapshots = []
+    for path in snapshot_paths:
+        with zipfile.ZipFile(path) as archive:
+            infos = [i for i in archive.infolist() if is_trial_member(i.filename)]
+        snapshots.append((path, snapshot_date(path, infos)))
+    dates = [as_of for _, as_of in snapshots]
+    if len(set(dates)) < len(dates):
+        raise ValueError("Each snapshot must be of a different date")
+
+    def distinct_documents():
+        seen = set()
+        members = 0
+        for path, _ in snapshots:
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if not is_trial_member(info.filename):
+                        continue
+                    members += 1
+                    key = document_key(info)
+                    if key not in seen:
+                        seen.add(key)
+                        yield key, info.filename, archive.read(info)
+        logger.info(
+            "Read %s distinct trials of %s in %s snapshots",
+            len(seen),
+            members,
+            len(snapshots),
+        )
+
+    if os.path.exists(backfill_facts_path()):
+        os.remove(backfill_facts_path())
+    try:
+        with FactsStore(backfill_facts_path()) as store:
+            for output in run_batches(
+                functools.partial(convert_batch, document_facts_line),
+                batches(distinct_documents(), BATCH_SIZE),
+                processes,
+                executor=executor,
+            ):
+                store.add(output)
+        for _ in run_batches(
+            write_snapshot_csvs,
+            ([snapshot] for snapshot in snapshots),
+            processes,
+            executor=executor,
+        ):
+            pass
+    finally:
+        os.remove(backfill_facts_path())
+    return {as_of: backfill_csv_path(as_of) for as_of in dates}
+
+
+def parse_trial(data):
+    """Return the facts of one trial's XML"""
+    soup = BeautifulSoup(data, "xml", from_encoding="utf-8")
+    parsed_json = xmltodict.parse(data)
+    return extract_facts(soup, parsed_json)
+
+
+def parse_document(name, data):
+    """Return the facts of one trial in an archive, from its XML or
+    its v2 JSON record according to `name`
+
+    """
+    if ctgov_v2.is_v2_member(name):
+        return ctgov_v2.facts(ctgov_v2.loads(data))
+    return parse_trial(data)
+
+
+def convert_one_file_to_csv(
+    xml_filename, data, store_facts=False, thresholds=None, included_only=True
+):
+    """Return `(facts_line, row)` for one trial.
+
+    `facts_line` is the trial's line for the facts file if
+    `store_facts` is set, and otherwise None. `row` is its CSV row as
+    a `TrialRecord`, or None if `included_only` is set and it is not
+    an ACT or pACT.
+
+    """
+    logger.debug("Considering %s for converting to csv", xml_filename)
+    facts = parse_document(xml_filename, data)
+    profiler.mark("parse")
+    facts_line = facts_to_line(facts) if store_facts else None
+
+    td = derive_row(facts, thresholds)
+    profiler.mark("evaluate")
+    row = None
+    included = is_included(td)
+    if included:
+        AGGREGATES.add(td)
+    if included or not included_only:
+        logger.debug("Writing a record for %s", xml_filename)
+        row = TrialRecord.from_row(td)
+    return facts_line, row
+
+
+def csv_line(td):
+    """Format a row (a dict or `TrialRecord`) as it would appear in the
+    CSV
+
+    """
+    if not isinstance(td, TrialRecord):
+        td = TrialRecord.from_row(td)
+    out = io.StringIO()
+    csv.writer(out).writerow(td.values())
+    return out.getvalue()
+
+
+TERMS_NAME = "clinical_trials_terms.csv"
+TERM_HEADERS = ["nct_id", "term", "type"]
+# The CSV columns packed as JSON by `dict_or_none`, the key of their
+# terms within each item (if the items aren't the terms themselves),
+# and the type of the terms
+TERM_COLUMNS = [
+    ("condition", None, "condition"),
+    ("condition_mesh", "mesh_term", "condition_mesh"),
+    ("intervention", "intervention_name", "intervention"),
+    ("intervention_mesh", "mesh_term", "intervention_mesh"),
+    ("collaborators", "agency", "collaborator"),
+    ("keywords", None, "keyword"),
+]
+
+
+def terms_path():
+    return os.path.join(TMPDIR, TERMS_NAME)
+
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def row_terms(row):
+    """Yield `(nct_id, term, type)` for each distinct term in the
+    columns of a CSV row listed in `TERM_COLUMNS`, so that they can be
+    searched without decoding the JSON.
+
+    """
+    seen = set()
+    for column, key, term_type in TERM_COLUMNS:
+        if not row[column]:
+            continue
+        for item in as_list(json.loads(row[column])):
+            if key is not None:
+                item = item.get(key) if isinstance(item, dict) else None
+            for term in as_list(item):
+                if isinstance(term, dict):
+                    # An element with attributes
+                    term = term.get("text")
+                if term and (term, term_type) not in seen:
+                    seen.add((term, term_type))
+                    yield row["nct_id"], term, term_type
+
+
+def terms_lines(row):
+    """Format the terms of a row as they appear in the terms CSV"""
+    out = io.StringIO()
+    csv.writer(out).writerows(row_terms(row))
+    return out.getvalue()
+
+
+def lookup(nct_ids, zip_path, as_of=None, index_dir=None):
+    """Return a dict of each of `nct_ids` to its raw XML (or its
+    `v2_record`, in the API v2 JSON export), JSON line and CSV line
+    (whether or not the trial is included in the CSV), or to None if
+    it is not in the archive at `zip_path`.
+
+    Trials are read via the archive's sidecar index (see
+    `archive_index`), kept next to it or in `index_dir`, so this takes
+    milliseconds once the index exists.
+
+    """
+    set_fda_reg_dict()
+    thresholds = AsOf(as_of or date.today())
+    found = {}
+    with ArchiveIndex(zip_path, index_dir) as index:
+        for nct_id in nct_ids:
+            try:
+                name, data = index.read_member(nct_id)
+            except KeyError:
+                found[nct_id] = None
+                continue
+            td = derive_row(parse_document(name, data), thresholds)
+            source = "v2_record" if ctgov_v2.is_v2_member(name) else "xml"
+            found[nct_id] = {
+                source: data.decode("utf-8"),
+                "json": trial_to_json(data, name=name),
+                "csv": csv_line(td),
+                "included": bool(is_included(td)),
+            }
+    return found
+
+
+def regenerate_csv(nct_ids, zip_path, output_path, as_of=None, index_dir=None):
+    """Write a CSV with the rows of just `nct_ids`, as a full run would"""
+    set_fda_reg_dict()
+    thresholds = AsOf(as_of or date.today())
+    with ArchiveIndex(zip_path, index_dir) as index, open(
+        output_path, "w", newline="", encoding="utf-8"
+    ) as out:
+        writer = csv.DictWriter(out, fieldnames=CSV_HEADERS)
+        writer.writeheader()
+        for nct_id in nct_ids:
+            try:
+                name, data = index.read_member(nct_id)
+            except KeyError:
+                logger.warning("%s is not in %s", nct_id, zip_path)
+                continue
+            td = derive_row(parse_document(name, data), thresholds)
+            if is_included(td):
+                writer.writerow(convert_bools_to_ints(td))
+    return output_path
+
+
+def extract_facts(soup, parsed_json):
+    """Return a dict of the raw fields of one trial (see
+    FACT_HEADERS) that the ACT/pACT logic and the CSV consume.
+
+    """
+    facts = {}
+
+    facts["nct_id"] = t(soup.nct_id)
+
+    facts["study_type"] = t(soup.study_type)
+
+    facts["phase"] = t(soup.phase)
+
+    facts["study_status"] = t(soup.overall_status)
 
-    # First check if a recent version exists in cloud - this is much
-    # faster that downloading from CT.gov
-    downloaded = False
-    if not local_only:
-        client = StorageClient()
-        bucket = client.get_bucket()
-        blob = bucket.get_blob("clinicaltrials/AllPublicXML.zip")
-        if blob and blob.updated.strftime("%Y-%m-%d") == date.today().strftime(
-            "%Y-%m-%d"
-        ):
-            blob.download_to_filename(destination_file_name)
-            downloaded = True
-    if not downloaded:
-        # Download and cache in Google Cloud
-        logger.info(
-            "Downloading zipfile. This takes at least 30 mins on a fast connection!"
-        )
-        url = "https://clinicaltrials.gov/AllPublicXML.zip"
-        wget_file(destination_file_name, url)
-        if not local_only:
-            upload_to_cloud(destination_file_name, "clinicaltrials/AllPublicXML.zip")
+    facts["primary_purpose"] = t(soup.find("primary_purpose"))
 
+    facts["fda_reg_drug"] = t(soup.is_fda_regulated_drug)
 
-# JSON generation
-#################
+    facts["fda_reg_device"] = t(soup.is_fda_regulated_device)
 
+    facts["start_date"] = (str_to_date(soup.start_date))[0]
 
-def postprocessor(path, key, value):
-    """Convert key names to something bigquery-compatible, so it is
-    possible to import the JSON into bigquery tables.
+    facts["primary_completion_date"], facts["defaulted_pcd_flag"] = str_to_date(
+        soup.primary_completion_date
+    )
 
-    """
-    if key.startswith("#") or key.startswith("@"):
-        key = key[1:]
-    if key == "clinical_results":
-        # Arbitrarily long field that we don't need, see #179
-        value = {"truncated_by_postprocessor": True}
-    return key, value
+    facts["completion_date"], facts["defaulted_cd_flag"] = str_to_date(
+        soup.completion_date
+    )
 
+    facts["intervention_types"] = [
+        tag.get_text() for tag in soup.find_all("intervention_type")
+    ]
 
-def convert_one_file_to_json(input_file_path, data):
-    logger.debug("Converting %s", input_file_path)
-    output_file_path = raw_json_path()
+    facts["location_countries"] = t(soup.location_countries)
 
-    # Write to a fragment named for the current process
-    output_file_path = name_fragment(output_file_path)
+    facts["location"] = dict_or_none(parsed_json, [CS, "location_countries"])
 
-    with open(output_file_path, "a") as target_file:
-        try:
-            target_file.write(
-                json.dumps(
-                    xmltodict.parse(data, item_depth=0, postprocessor=postprocessor)
-                )
-                + "\n"
-            )
-        except ExpatError:
-            logger.warn("Unable to parse %s", input_file_path)
+    facts["has_certificate"] = does_it_exist(soup.disposition_first_submitted)
 
+    facts["certificate_date"] = (str_to_date(soup.disposition_first_submitted))[0]
 
-def convert_to_json():
-    logger.info("Converting to JSON...")
-    pool = Pool()
-    for name, xmldoc in document_stream(zip_archive()):
-        pool.apply_async(convert_one_file_to_json, (name, xmldoc))
-    pool.close()
-    pool.join()
-    combine_fragments(raw_json_path())
+    facts["has_results"] = does_it_exist(soup.results_first_submitted)
 
+    facts["results_submitted_date"] = (str_to_date(soup.results_first_submitted))[0]
 
-# CSV generation
-################
+    facts["pending_results"] = does_it_exist(soup.pending_results)
 
-EFFECTIVE_DATE = date(2017, 1, 18)
-CS = "clinical_study"
-CSV_HEADERS = [
-    "nct_id",
-    "act_flag",
-    "included_pact_flag",
-    "has_results",
-    "pending_results",
-    "pending_data",
-    "has_certificate",
-    "results_due",
-    "start_date",
-    "available_completion_date",
-    "used_primary_completion_date",
-    "defaulted_pcd_flag",
-    "defaulted_cd_flag",
-    "results_submitted_date",
-    "last_updated_date",
-    "certificate_date",
-    "phase",
-    "enrollment",
-    "location",
-    "study_status",
-    "study_type",
-    "primary_purpose",
-    "sponsor",
-    "sponsor_type",
-    "collaborators",
-    "exported",
-    "fda_reg_drug",
-    "fda_reg_device",
-    "is_fda_regulated",
-    "url",
-    "title",
-    "official_title",
-    "brief_title",
-    "discrep_date_status",
-    "late_cert",
-    "defaulted_date",
-    "condition",
-    "condition_mesh",
-    "intervention",
-    "intervention_mesh",
-    "keywords",
-]
+    facts["pending_data"] = dict_or_none(parsed_json, [CS, "pending_results"])
 
+    facts["last_updated_date"] = (str_to_date(soup.last_update_submitted))[0]
 
-def set_fda_reg_dict():
-    """Generate a dictionary for looking up FDA regulation flags from a
-    snapshot of CT.gov at a time when it included such flags.
+    facts["enrollment"] = t(soup.enrollment)
 
-    """
-    # We use globals as a convenient way to access this from child
-    # processes
-    global fda_reg_dict
-    fda_reg_dict = {}
-    snapshot = gzip.open(
-        os.path.join(os.path.dirname(__file__), "fdaaa_regulatory_snapshot.csv.gz"),
-        "rt",
+    if soup.sponsors and soup.sponsors.lead_sponsor:
+        facts["sponsor"] = t(soup.sponsors.lead_sponsor.agency)
+        facts["sponsor_type"] = t(soup.sponsors.lead_sponsor.agency_class)
+    else:
+        facts["sponsor"] = facts["sponsor_type"] = None
+
+    facts["collaborators"] = dict_or_none(
+        parsed_json, [CS, "sponsors", "collaborator"]
     )
 
-    with snapshot as old_fda_reg:
-        reader = csv.DictReader(old_fda_reg)
-        for d in reader:
-            fda_reg_dict[d["nct_id"]] = d["is_fda_regulated"]
+    facts["exported"] = t(soup.oversight_info and soup.oversight_info.is_us_export)
 
+    facts["url"] = t(soup.url)
 
-def generated_csv_path():
-    return os.path.join(TMPDIR, INTERMEDIATE_CSV_NAME)
+    facts["official_title"] = t(soup.official_title)
 
+    facts["brief_title"] = t(soup.brief_title)
 
-def raw_json_name():
-    date = datetime.now().strftime("%Y-%m-%d")
-    return "raw_clincialtrials_json_{}.csv".format(date)
+    facts["condition"] = dict_or_none(parsed_json, [CS, "condition"])
 
+    facts["condition_mesh"] = dict_or_none(parsed_json, [CS, "condition_browse"])
 
-def raw_json_path():
-    """The (datestamped) path of the JSON file we generate and store in
-    BigQuery on each run
+    facts["intervention"] = dict_or_none(parsed_json, [CS, "intervention"])
 
-    """
-    return os.path.join(TMPDIR, raw_json_name())
+    facts["intervention_mesh"] = dict_or_none(
+        parsed_json, [CS, "intervention_browse"]
+    )
 
+    facts["keywords"] = dict_or_none(parsed_json, [CS, "keyword"])
 
-def convert_to_csv():
-    """Convert unzipped CT.gov XML to a CSV format used in the web app.
+    return facts
 
-    """
-    set_fda_reg_dict()
-    logger.info("Converting to CSV...")
-    # Process the files in as many processes as possible
-    pool = Pool()
-    for name, xmldoc in document_stream(zip_archive()):
-        pool.apply_async(convert_one_file_to_csv, (name, xmldoc))
-    pool.close()
-    pool.join()
-    # Write a header to a file that will be first when sorted by glob
-    with open(
-        generated_csv_path() + FILE_FRAGMENT_SUFFIX + "0",
-        "w",
-        newline="",
-        encoding="utf-8",
-    ) as test_csv:
-        writer = csv.DictWriter(test_csv, fieldnames=CSV_HEADERS)
-        writer.writeheader()
 
-    # combine that header with all other produced outputs
-    combine_fragments(generated_csv_path())
+def derive_row(facts, thresholds=None):
+    """Apply the ACT/pACT logic to the facts of one trial, returning a
+    dict of CSV_HEADERS fields.
 
+    Time-dependent flags are evaluated as of the `AsOf` instance
+    `thresholds`, which defaults to today.
 
-def convert_one_file_to_csv(xml_filename, data):
+    """
     global fda_reg_dict
-    logger.debug("Considering %s for converting to csv", xml_filename)
-    soup = BeautifulSoup(data, "xml", from_encoding="utf-8")
-    parsed_json = xmltodict.parse(data)
-
+    if thresholds is None:
+        thresholds = AsOf(date.today())
     td = {}
 
-    td["nct_id"] = t(soup.nct_id)
+    td["nct_id"] = facts["nct_id"]
 
-    td["study_type"] = t(soup.study_type)
+    td["study_type"] = facts["study_type"]
 
-    td["has_certificate"] = does_it_exist(soup.disposition_first_submitted)
+    td["has_certificate"] = facts["has_certificate"]
 
-    td["phase"] = t(soup.phase)
+    td["phase"] = facts["phase"]
 
-    td["fda_reg_drug"] = t(soup.is_fda_regulated_drug)
+    td["fda_reg_drug"] = facts["fda_reg_drug"]
 
-    td["fda_reg_device"] = t(soup.is_fda_regulated_device)
+    td["fda_reg_device"] = facts["fda_reg_device"]
 
-    td["primary_purpose"] = t(soup.find("primary_purpose"))
+    td["primary_purpose"] = facts["primary_purpose"]
 
     try:
         if fda_reg_dict[td["nct_id"]] == "false":
@@ -305,15 +1877,15 @@ def convert_one_file_to_csv(xml_filename, data):
             td["is_fda_regulated"] = None
     except KeyError:
         td["is_fda_regulated"] = None
-    td["study_status"] = t(soup.overall_status)
+    td["study_status"] = facts["study_status"]
 
-    td["start_date"] = (str_to_date(soup.start_date))[0]
+    td["start_date"] = facts["start_date"]
 
-    primary_completion_date, td["defaulted_pcd_flag"] = str_to_date(
-        soup.primary_completion_date
-    )
+    primary_completion_date = facts["primary_completion_date"]
+    td["defaulted_pcd_flag"] = facts["defaulted_pcd_flag"]
 
-    completion_date, td["defaulted_cd_flag"] = str_to_date(soup.completion_date)
+    completion_date = facts["completion_date"]
+    td["defaulted_cd_flag"] = facts["defaulted_cd_flag"]
 
     if not primary_completion_date and not completion_date:
         td["available_completion_date"] = None
@@ -324,116 +1896,50 @@ def convert_one_file_to_csv(xml_filename, data):
         td["available_completion_date"] = primary_completion_date
         td["used_primary_completion_date"] = True
 
-    if (
-        is_interventional(td["study_type"])
-        and is_fda_reg(td["fda_reg_drug"], td["fda_reg_device"])
-        and is_covered_phase(td["phase"])
-        and is_not_device_feasibility(td["primary_purpose"])
-        and td["start_date"]
-        and td["start_date"] >= EFFECTIVE_DATE
-        and is_not_withdrawn(td["study_status"])
-    ):
-        td["act_flag"] = True
-    else:
-        td["act_flag"] = False
-
-    intervention_type_field = soup.find_all("intervention_type")
-    trial_intervention_types = []
-    for tag in intervention_type_field:
-        trial_intervention_types.append(tag.get_text())
+    flags = ELIGIBILITY.evaluate(facts, td)
+    td["act_flag"] = flags["act_flag"]
+    td["included_pact_flag"] = flags["old_pact_flag"] or flags["new_pact_flag"]
 
-    locs = t(soup.location_countries)
+    td["location"] = facts["location"]
 
-    if (
-        is_interventional(td["study_type"])
-        and is_covered_intervention(trial_intervention_types)
-        and is_covered_phase(td["phase"])
-        and is_not_device_feasibility(td["primary_purpose"])
-        and td["available_completion_date"]
-        and td["available_completion_date"] >= EFFECTIVE_DATE
-        and td["start_date"]
-        and td["start_date"] < EFFECTIVE_DATE
-        and is_not_withdrawn(td["study_status"])
-        and (
-            is_fda_reg(td["fda_reg_drug"], td["fda_reg_device"])
-            or is_old_fda_regulated(
-                td["is_fda_regulated"], td["fda_reg_drug"], td["fda_reg_device"]
-            )
-        )
-        and has_us_loc(locs)
-    ):
-        old_pact_flag = True
-    else:
-        old_pact_flag = False
-
-    if (
-        is_interventional(td["study_type"])
-        and is_fda_reg(td["fda_reg_drug"], td["fda_reg_device"])
-        and is_covered_phase(td["phase"])
-        and is_not_device_feasibility(td["primary_purpose"])
-        and td["start_date"]
-        and td["start_date"] < EFFECTIVE_DATE
-        and td["available_completion_date"]
-        and td["available_completion_date"] >= EFFECTIVE_DATE
-        and is_not_withdrawn(td["study_status"])
-    ):
-        new_pact_flag = True
-    else:
-        new_pact_flag = False
-
-    if old_pact_flag == True or new_pact_flag == True:
-        td["included_pact_flag"] = True
-    else:
-        td["included_pact_flag"] = False
+    td["has_results"] = facts["has_results"]
 
-    td["location"] = dict_or_none(parsed_json, [CS, "location_countries"])
+    td["pending_results"] = facts["pending_results"]
 
-    td["has_results"] = does_it_exist(soup.results_first_submitted)
-
-    td["pending_results"] = does_it_exist(soup.pending_results)
-
-    td["pending_data"] = dict_or_none(parsed_json, [CS, "pending_results"])
+    td["pending_data"] = facts["pending_data"]
 
     if (
         (td["act_flag"] == True or td["included_pact_flag"] == True)
-        and date.today()
-        > td["available_completion_date"] + relativedelta(years=1) + timedelta(days=30)
+        and td["available_completion_date"] <= thresholds.results_due_cutoff
         and (
             td["has_certificate"] == 0
-            or (
-                date.today()
-                > td["available_completion_date"]
-                + relativedelta(years=3)
-                + timedelta(days=30)
-            )
+            or td["available_completion_date"]
+            <= thresholds.certified_results_due_cutoff
         )
     ):
         td["results_due"] = True
     else:
         td["results_due"] = False
 
-    td["results_submitted_date"] = (str_to_date(soup.results_first_submitted))[0]
+    td["results_submitted_date"] = facts["results_submitted_date"]
 
-    td["last_updated_date"] = (str_to_date(soup.last_update_submitted))[0]
+    td["last_updated_date"] = facts["last_updated_date"]
 
-    td["certificate_date"] = (str_to_date(soup.disposition_first_submitted))[0]
+    td["certificate_date"] = facts["certificate_date"]
 
-    td["enrollment"] = t(soup.enrollment)
-    if soup.sponsors and soup.sponsors.lead_sponsor:
-        td["sponsor"] = t(soup.sponsors.lead_sponsor.agency)
-        td["sponsor_type"] = t(soup.sponsors.lead_sponsor.agency_class)
-    else:
-        td["sponsor"] = td["sponsor_type"] = None
+    td["enrollment"] = facts["enrollment"]
+    td["sponsor"] = facts["sponsor"]
+    td["sponsor_type"] = facts["sponsor_type"]
 
-    td["collaborators"] = dict_or_none(parsed_json, [CS, "sponsors", "collaborator"])
+    td["collaborators"] = facts["collaborators"]
 
-    td["exported"] = t(soup.oversight_info and soup.oversight_info.is_us_export)
+    td["exported"] = facts["exported"]
 
-    td["url"] = t(soup.url)
+    td["url"] = facts["url"]
 
-    td["official_title"] = t(soup.official_title)
+    td["official_title"] = facts["official_title"]
 
-    td["brief_title"] = t(soup.brief_title)
+    td["brief_title"] = facts["brief_title"]
 
     td["title"] = td["official_title"] or td["brief_title"]
 
@@ -444,19 +1950,11 @@ def convert_one_file_to_csv(xml_filename, data):
     else:
         td["title"] = None
 
-    not_ongoing = [
-        "Unknown status",
-        "Active, not recruiting",
-        "Not yet recruiting",
-        "Enrolling by invitation",
-        "Suspended",
-        "Recruiting",
-    ]
     if (
-        (primary_completion_date is None or primary_completion_date < date.today())
+        (primary_completion_date is None or primary_completion_date < thresholds.date)
         and completion_date is not None
-        and completion_date < date.today()
-        and td["study_status"] in not_ongoing
+        and completion_date < thresholds.date
+        and td["study_status"] in NOT_ONGOING
     ):
         td["discrep_date_status"] = True
     else:
@@ -486,31 +1984,56 @@ def convert_one_file_to_csv(xml_filename, data):
     else:
         td["defaulted_date"] = False
 
-    td["condition"] = dict_or_none(parsed_json, [CS, "condition"])
+    td["condition"] = facts["condition"]
 
-    td["condition_mesh"] = dict_or_none(parsed_json, [CS, "condition_browse"])
+    td["condition_mesh"] = facts["condition_mesh"]
 
-    td["intervention"] = dict_or_none(parsed_json, [CS, "intervention"])
+    td["intervention"] = facts["intervention"]
 
-    td["intervention_mesh"] = dict_or_none(parsed_json, [CS, "intervention_browse"])
+    td["intervention_mesh"] = facts["intervention_mesh"]
 
-    td["keywords"] = dict_or_none(parsed_json, [CS, "keyword"])
+    td["keywords"] = facts["keywords"]
 
-    if td["act_flag"] or td["included_pact_flag"]:
-        logger.debug("Writing a record for %s", xml_filename)
-        with open(
-            name_fragment(generated_csv_path()), "a", newline="", encoding="utf-8"
-        ) as test_csv:
-            writer = csv.DictWriter(test_csv, fieldnames=CSV_HEADERS)
-            writer.writerow(convert_bools_to_ints(td))
+    return td
+
+
+def is_included(td):
+    return td["act_flag"] or td["included_pact_flag"]
+
+
+def flag_transitions(facts, td):
+    """Return the first as-of date on which each time-dependent flag
+    of an included trial is true, or None if it never is.
+
+    This mirrors the conditions in `derive_row`: a flag that compares
+    the as-of date with `x` using `>` is true from the day after `x`.
+
+    """
+    acd = td["available_completion_date"]
+    if td["has_certificate"]:
+        results_due_from = acd + CERTIFIED_RESULTS_DUE_AFTER + timedelta(days=1)
+    else:
+        results_due_from = acd + RESULTS_DUE_AFTER + timedelta(days=1)
+
+    completion_date = facts["completion_date"]
+    discrep_date_status_from = None
+    if completion_date is not None and td["study_status"] in NOT_ONGOING:
+        primary_completion_date = facts["primary_completion_date"] or completion_date
+        discrep_date_status_from = max(
+            primary_completion_date, completion_date
+        ) + timedelta(days=1)
+    return {
+        "results_due": results_due_from,
+        "discrep_date_status": discrep_date_status_from,
+    }
 
 
 # Helper functions for CSV assenbly
 ###################################
 
 
-def is_covered_phase(phase):
-    return phase in [
+COVERED_PHASES = frozenset(
+    [
         "Phase 1/Phase 2",
         "Phase 2",
         "Phase 2/Phase 3",
@@ -518,6 +2041,32 @@ def is_covered_phase(phase):
         "Phase 4",
         "N/A",
     ]
+)
+
+COVERED_INTERVENTION_TYPES = frozenset(
+    [
+        "Drug",
+        "Device",
+        "Biological",
+        "Genetic",
+        "Radiation",
+        "Combination Product",
+        "Diagnostic Test",
+    ]
+)
+
+US_LOCATIONS = (
+    "United States",
+    "American Samoa",
+    "Guam",
+    "Northern Mariana Islands",
+    "Puerto Rico",
+    "Virgin Islands (U.S.)",
+)
+
+
+def is_covered_phase(phase):
+    return phase in COVERED_PHASES
 
 
 def is_not_withdrawn(study_status):
@@ -529,21 +2078,7 @@ def is_interventional(study_type):
 
 
 def is_covered_intervention(intervention_type_list):
-    covered_intervention_type = [
-        "Drug",
-        "Device",
-        "Biological",
-        "Genetic",
-        "Radiation",
-        "Combination Product",
-        "Diagnostic Test",
-    ]
-    a_set = set(covered_intervention_type)
-    b_set = set(intervention_type_list)
-    if a_set & b_set:
-        return True
-    else:
-        return False
+    return not COVERED_INTERVENTION_TYPES.isdisjoint(intervention_type_list)
 
 
 def is_not_device_feasibility(primary_purpose):
@@ -567,21 +2102,131 @@ def is_old_fda_regulated(is_fda_regulated, fda_reg_drug, fda_reg_device):
 
 
 def has_us_loc(locs):
-    us_locs = [
-        "United States",
-        "American Samoa",
-        "Guam",
-        "Northern Mariana Islands",
-        "Puerto Rico",
-        "Virgin Islands (U.S.)",
-    ]
+    # `locs` is the text of all location countries run together, so
+    # this is a substring search
     if locs:
-        for us_loc in us_locs:
+        for us_loc in US_LOCATIONS:
             if us_loc in locs:
                 return True
     return False
 
 
+# ACT/pACT eligibility rules
+############################
+
+# Each predicate takes the facts and the partly built CSV row of a
+# trial. Citations are to the FDAAA 801 Final Rule, 42 CFR Part 11.
+ELIGIBILITY_PREDICATES = [
+    Predicate(
+        "interventional",
+        lambda facts, td: is_interventional(td["study_type"]),
+        "study type is Interventional (11.10(a))",
+    ),
+    Predicate(
+        "covered_phase",
+        lambda facts, td: is_covered_phase(td["phase"]),
+        "phase is not Phase 1 or Early Phase 1 (11.22(b))",
+    ),
+    Predicate(
+        "not_device_feasibility",
+        lambda facts, td: is_not_device_feasibility(td["primary_purpose"]),
+        "primary purpose is not Device Feasibility (11.22(b))",
+    ),
+    Predicate(
+        "not_withdrawn",
+        lambda facts, td: is_not_withdrawn(td["study_status"]),
+        "status is not Withdrawn",
+    ),
+    Predicate(
+        "fda_regulated",
+        lambda facts, td: is_fda_reg(td["fda_reg_drug"], td["fda_reg_device"]),
+        "studies an FDA-regulated drug or device (11.22(b))",
+    ),
+    Predicate(
+        "fda_regulated_or_legacy_regulated",
+        lambda facts, td: is_fda_reg(td["fda_reg_drug"], td["fda_reg_device"])
+        or is_old_fda_regulated(
+            td["is_fda_regulated"], td["fda_reg_drug"], td["fda_reg_device"]
+        ),
+        "studies an FDA-regulated drug or device, or has no such flags and "
+        "was not marked unregulated in the legacy is_fda_regulated field",
+    ),
+    Predicate(
+        "covered_intervention",
+        lambda facts, td: is_covered_intervention(facts["intervention_types"]),
+        "has a drug, device, biological, genetic, radiation, combination "
+        "product or diagnostic test intervention",
+    ),
+    Predicate(
+        "us_location",
+        lambda facts, td: has_us_loc(facts["location_countries"]),
+        "has a location in the US or its territories",
+    ),
+    Predicate(
+        "started_on_or_after_effective_date",
+        lambda facts, td: td["start_date"] and td["start_date"] >= EFFECTIVE_DATE,
+        "started on or after the Final Rule effective date, 18 January 2017",
+    ),
+    Predicate(
+        "started_before_effective_date",
+        lambda facts, td: td["start_date"] and td["start_date"] < EFFECTIVE_DATE,
+        "started before 18 January 2017",
+    ),
+    Predicate(
+        "completed_on_or_after_effective_date",
+        lambda facts, td: td["available_completion_date"]
+        and td["available_completion_date"] >= EFFECTIVE_DATE,
+        "primary completion (or completion) date on or after 18 January 2017",
+    ),
+]
+
+ELIGIBILITY_RULES = [
+    # Applicable clinical trials under the Final Rule
+    (
+        "act_flag",
+        [
+            "interventional",
+            "fda_regulated",
+            "covered_phase",
+            "not_device_feasibility",
+            "started_on_or_after_effective_date",
+            "not_withdrawn",
+        ],
+    ),
+    # Probable ACTs, by the definitions in use before FDAAA flags
+    # were added to CT.gov
+    (
+        "old_pact_flag",
+        [
+            "interventional",
+            "covered_intervention",
+            "covered_phase",
+            "not_device_feasibility",
+            "completed_on_or_after_effective_date",
+            "started_before_effective_date",
+            "not_withdrawn",
+            "fda_regulated_or_legacy_regulated",
+            "us_location",
+        ],
+    ),
+    # Probable ACTs, using the FDAAA flags
+    (
+        "new_pact_flag",
+        [
+            "interventional",
+            "fda_regulated",
+            "covered_phase",
+            "not_device_feasibility",
+            "started_before_effective_date",
+            "completed_on_or_after_effective_date",
+            "not_withdrawn",
+        ],
+    ),
+]
+
+ELIGIBILITY = RulePlan(ELIGIBILITY_PREDICATES, ELIGIBILITY_RULES)
+
+
 def dict_or_none(data, keys):
     for k in keys:
         try:
@@ -635,30 +2280,480 @@ def convert_bools_to_ints(row):
     return row
 
 
+def parse_iso_date(datestr):
+    return datetime.strptime(datestr, "%Y-%m-%d").date()
+
+
+SAMPLE_ESTIMATES_NAME = "sample_estimates.csv"
+# The counts of included trials extrapolated from a sample
+SAMPLED_COUNTS = ["act_flag", "included_pact_flag", "results_due"]
+
+
+def sample_estimates_path():
+    return os.path.join(TMPDIR, SAMPLE_ESTIMATES_NAME)
+
+
+def write_sample_estimates(population, sampled, compression=None):
+    """Extrapolate the `SAMPLED_COUNTS` in the CSV of a sample of
+    `sampled` trials of `population` to the whole archive, writing
+    each with its 95% confidence interval to `sample_estimates_path()`.
+
+    """
+    counts = collections.Counter()
+    with open_input(compressed_path(generated_csv_path(), compression)) as f:
+        for row in csv.DictReader(f):
+            counts.update(name for name in SAMPLED_COUNTS if row[name] == "1")
+    with open(sample_estimates_path(), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["count", "sampled", "in_sample", "estimate", "low", "high"])
+        for name in SAMPLED_COUNTS:
+            estimate, low, high = sampling.estimate(counts[name], sampled, population)
+            logger.info(
+                "Estimated %s: %s (%s to %s) from %s of %s trials",
+                name,
+                estimate,
+                low,
+                high,
+                sampled,
+                population,
+            )
+            writer.writerow(
+                [name, sampled, counts[name]]
+                + [None if n is None else round(n) for n in (estimate, low, high)]
+            )
+
+
 def get_csv_path():
     return "{}{}".format(STORAGE_PREFIX, INTERMEDIATE_CSV_NAME)
 
 
-def main(local_only=False):
-    download_zipfile(local_only=local_only)
-    convert_to_json()
-    convert_to_csv()
+def main(
+    local_only=False,
+    cache_dir=None,
+    with_changelog=False,
+    store_facts=False,
+    as_of=None,
+    compression=None,
+    limits=None,
+    schedule=ARCHIVE_ORDER,
+    profile=None,
+    checkpoint_dir=None,
+    executor=PROCESS,
+    json_layout=FLAT_LAYOUT,
+    infer_schema=False,
+    archive=None,
+    sample=None,
+):
+    """Download the archive and convert it, returning the location of
+    the CSV. A local `archive` (the legacy XML archive or the API v2
+    JSON export) can be given instead.
+
+    With `with_changelog`, only the day-over-day change log is
+    archived, plus a full JSON snapshot periodically (see
+    `update_changelog`); otherwise the full JSON is archived every day.
+
+    With `store_facts`, the raw fields behind each row are also kept
+    (see `convert_to_csv`), so `derive_csv` can apply rule changes
+    later without reconverting the archive.
+
+    `as_of` sets the date for time-dependent flags such as
+    `results_due` (default: today).
+
+    `compression` ("gzip" or "zstd") compresses the raw JSON and the
+    CSV. Only gzip can be uploaded: the public CSV keeps its name and
+    is served with `Content-Encoding: gzip`, which Cloud Storage
+    decompresses for clients that don't accept it, while the JSON is
+    stored as a plain `.gz` object, which BigQuery loads directly.
+
+    `json_layout` sets where the JSON is stored: `FLAT_LAYOUT` keeps
+    each day's file directly under `STORAGE_PREFIX`, and `HIVE_LAYOUT`
+    partitions them by date under `RAW_JSON_PREFIX` for BigQuery (see
+    `raw_json_storage_name`).
+
+    With `infer_schema`, a BigQuery schema is inferred for the JSON as
+    it is written, starting from the previous run's, and the JSON is
+    written to fit it; see `convert_to_json`. The schema is kept for
+    the next run like the change log's hash index.
+
+    `limits` (a `worker_pool.Limits`) bounds the memory of the worker
+    processes, `schedule` sets the order in which trials are sent to
+    workers, and `executor` whether they are processes, threads or
+    this process; see `stream`.
+
+    With `profile` (a `profiler.Options`), the slowest trials of each
+    conversion are reported; see `write_profile`.
+
+    With `checkpoint_dir`, a run that is interrupted can be restarted
+    with the same `checkpoint_dir` and will only convert the trials it
+    had not yet finished, or download the parts of the archive it had
+    not yet fetched from Cloud Storage. The checkpoints are removed
+    once the run completes.
+
+    With `sample`, a fraction between 0 and 1, only that fraction of
+    the trials is converted (see `sampling`), and the counts of ACT,
+    pACT and results_due trials in the whole archive are estimated in
+    `sample_estimates_path()`. Samples are only converted locally, and
+    not with `with_changelog`, so they never replace a full run's
+    outputs.
+
+    """
+    if not local_only and compression not in (None, "gzip"):
+        raise ValueError("Only gzip output can be uploaded to Cloud Storage")
+    if sample is not None and (not local_only or with_changelog):
+        raise ValueError("Samples can only be converted locally, without a changelog")
+    # One connection to the bucket for all of the run's transfers
+    cloud = None if local_only else GCSStorage()
+    if archive is not None:
+        os.symlink(os.path.abspath(archive), zip_archive())
+    else:
+        download_zipfile(
+            local_only=local_only,
+            cache_dir=cache_dir,
+            partial_dir=checkpoint_dir and os.path.join(checkpoint_dir, "download"),
+            cloud=cloud,
+        )
+    if sample is not None:
+        full_archive = zip_archive() + ".full"
+        os.replace(zip_archive(), full_archive)
+        sample_size = sampling.sample_archive(
+            full_archive, zip_archive(), sample, is_trial_member
+        )
+        logger.info("Sampled %s of %s trials", sample_size[1], sample_size[0])
+    schema_seed = None
+    if infer_schema:
+        schema_storage, schema_name = run_storage(
+            RAW_JSON_SCHEMA_NAME, local_only, cache_dir, cloud
+        )
+        previous_schema_path = os.path.join(TMPDIR, "previous_" + RAW_JSON_SCHEMA_NAME)
+        if schema_storage is not None and schema_storage.download(
+            schema_name, previous_schema_path
+        ):
+            with open(previous_schema_path) as f:
+                schema_seed = json.load(f)
+    convert_to_json(
+        compression=compression,
+        limits=limits,
+        schedule=schedule,
+        profile=profile,
+        checkpoint_dir=checkpoint_dir,
+        executor=executor,
+        infer_schema=infer_schema,
+        schema_seed=schema_seed,
+    )
+    if infer_schema and schema_storage is not None:
+        schema_storage.upload(raw_json_schema_path(), schema_name)
+    archive_full_json = True
+    if with_changelog:
+        archive_full_json = update_changelog(
+            local_only=local_only,
+            cache_dir=cache_dir,
+            compression=compression,
+            cloud=cloud,
+        )
+    convert_to_csv(
+        store_facts=store_facts,
+        as_of=as_of,
+        compression=compression,
+        limits=limits,
+        schedule=schedule,
+        profile=profile,
+        checkpoint_dir=checkpoint_dir,
+        executor=executor,
+    )
+    if sample is not None:
+        write_sample_estimates(*sample_size, compression=compression)
     if not local_only:
-        json_path = "{}{}".format(STORAGE_PREFIX, raw_json_name())
-        upload_to_cloud(raw_json_path(), json_path)
+        if store_facts:
+            upload_to_cloud(
+                trial_facts_path(), STORAGE_PREFIX + FACTS_NAME, cloud=cloud
+            )
+        if with_changelog:
+            upload_to_cloud(
+                changelog_path(), STORAGE_PREFIX + changelog_name(), cloud=cloud
+            )
+        if archive_full_json:
+            upload_to_cloud(
+                compressed_path(raw_json_path(), compression),
+                raw_json_storage_name(json_layout, compression),
+                content_type="application/gzip" if compression else None,
+                cloud=cloud,
+            )
         csv_path = get_csv_path()
+        for path, name in [
+            (generated_csv_path(), csv_path),
+            (terms_path(), STORAGE_PREFIX + TERMS_NAME),
+        ]:
+            upload_to_cloud(
+                compressed_path(path, compression),
+                name,
+                make_public=True,
+                content_type="text/csv" if compression else None,
+                content_encoding=compression,
+                cloud=cloud,
+            )
         upload_to_cloud(
-            generated_csv_path(),
-            csv_path,
+            aggregates_path(),
+            STORAGE_PREFIX + AGGREGATES_NAME,
             make_public=True,
+            cloud=cloud,
         )
         csv_path = "https://storage.googleapis.com/" + csv_path
     else:
-        csv_path = generated_csv_path()
+        csv_path = compressed_path(generated_csv_path(), compression)
+    if with_changelog:
+        # Last, so that a failed run is compared against again
+        store_hash_index(local_only=local_only, cache_dir=cache_dir, cloud=cloud)
+    if checkpoint_dir:
+        for stage in ("download", "json", "csv"):
+            shutil.rmtree(os.path.join(checkpoint_dir, stage), ignore_errors=True)
     return csv_path
 
 
 if __name__ == "__main__":
-    local_only = len(sys.argv) > 1 and sys.argv[1] == "local"
-    csv_path = main(local_only)
+    parser = argparse.ArgumentParser(
+        description="Convert the CT.gov archive to the CSV used by the FDAAA tracker"
+    )
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["local", "derive", "series", "rules", "lookup", "serve", "backfill"],
+        help="`local` skips all Google Cloud steps; `derive` rebuilds the CSV "
+        "from a facts file written with --store-facts; `series` counts "
+        "time-dependent flags for each date from --from to --to in such a file; "
+        "`rules` lists the ACT/pACT eligibility rules; `lookup` shows the "
+        "XML, JSON and CSV row of the given trials in --archive; `serve` "
+        "converts trials in --archive on demand over HTTP; `backfill` writes "
+        "the CSV of each of --snapshots as of its date",
+    )
+    parser.add_argument("nct_ids", nargs="*", help="Trials to show in `lookup` mode")
+    parser.add_argument(
+        "--archive",
+        help="A local AllPublicXML.zip to read in `lookup` and `serve` modes, "
+        "or to convert instead of downloading one in `local` mode (which "
+        "also reads the API v2 JSON export)",
+    )
+    parser.add_argument(
+        "--index-dir",
+        help="Keep the index of --archive in this directory rather than "
+        "next to it, in `lookup` and `serve` modes",
+    )
+    parser.add_argument(
+        "--snapshots",
+        nargs="+",
+        metavar="ZIP",
+        help="Archived snapshots to convert in `backfill` mode, each dated by "
+        "a YYYY-MM-DD in its name or else by its latest trial",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000, help="Port to listen on in `serve` mode"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=10000,
+        help="Number of converted trials to keep in memory in `serve` mode",
+    )
+    parser.add_argument(
+        "--output",
+        help="In `lookup` mode, write the CSV rows of the trials to this file "
+        "instead of showing them",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep downloaded archives in this directory and reuse them when unchanged",
+    )
+    parser.add_argument(
+        "--changelog",
+        action="store_true",
+        help="Archive a change log against the previous run instead of the full JSON",
+    )
+    parser.add_argument(
+        "--store-facts",
+        action="store_true",
+        help="Also keep the raw fields of every trial, for use with `derive`",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        help="Compress the raw JSON and CSV outputs; zstd only with `local`",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=[ARCHIVE_ORDER, LARGEST_FIRST],
+        default=ARCHIVE_ORDER,
+        help="Send trials to workers in archive order, or largest first to "
+        "shorten the tail of the run; the output is in archive order either way",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default=PROCESS,
+        help="Convert trials in worker processes, in threads, or serially in "
+        "this process (for debugging and profiling)",
+    )
+    parser.add_argument(
+        "--json-layout",
+        choices=[FLAT_LAYOUT, HIVE_LAYOUT],
+        default=FLAT_LAYOUT,
+        help="Archive the daily JSON as a datestamped file, or in date "
+        "partitions under {} for BigQuery".format(RAW_JSON_PREFIX),
+    )
+    parser.add_argument(
+        "--bigquery-schema",
+        action="store_true",
+        help="Infer a BigQuery schema for the raw JSON while converting it, "
+        "and write the JSON to fit it",
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        metavar="FRACTION",
+        help="In `local` mode, convert only this fraction of the trials, chosen "
+        "by a hash of their NCT ids, and estimate the counts of ACT, pACT and "
+        "results_due trials in the whole archive",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="Log at this level or above to {} (default: ${} or {})".format(
+            log_pipeline.LOG_PATH,
+            log_pipeline.LEVEL_VARIABLE,
+            log_pipeline.DEFAULT_LEVEL,
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        help="Save progress here, so that an interrupted run restarted with the "
+        "same directory resumes where it stopped",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        metavar="K",
+        help="Report the K slowest trials of each conversion",
+    )
+    parser.add_argument(
+        "--profile-functions",
+        action="store_true",
+        help="With --profile, also report the hottest functions in the "
+        "slowest trials, using cProfile",
+    )
+    parser.add_argument(
+        "--max-worker-rss",
+        type=int,
+        metavar="MB",
+        help="Replace worker processes whose memory use exceeds this",
+    )
+    parser.add_argument(
+        "--max-worker-tasks",
+        type=int,
+        metavar="N",
+        help="Replace worker processes after N batches of trials",
+    )
+    parser.add_argument(
+        "--large-member-size",
+        type=int,
+        metavar="BYTES",
+        help="Convert trials whose XML is larger than this one at a time, "
+        "in a separate worker",
+    )
+    parser.add_argument(
+        "--facts", help="The facts file to read in `derive` and `series` modes"
+    )
+    parser.add_argument(
+        "--as-of",
+        type=parse_iso_date,
+        help="Evaluate results_due etc. as of this date (YYYY-MM-DD) instead of today",
+    )
+    parser.add_argument(
+        "--from", dest="first_date", type=parse_iso_date, help="First date of a series"
+    )
+    parser.add_argument(
+        "--to", dest="last_date", type=parse_iso_date, help="Last date of a series"
+    )
+    # Intermixed, so that NCT ids can come before or after the options
+    args = parser.parse_intermixed_args()
+    log_pipeline.configure(args.log_level)
+    if args.compression == "zstd" and args.mode != "local":
+        parser.error("zstd compression can only be used with `local`")
+    limits = None
+    if args.max_worker_rss or args.max_worker_tasks or args.large_member_size:
+        limits = Limits(
+            max_rss_mb=args.max_worker_rss,
+            max_tasks=args.max_worker_tasks,
+            large_member_size=args.large_member_size,
+        )
+    if limits is not None and args.executor != PROCESS:
+        parser.error("worker limits can only be used with the process executor")
+    profile = None
+    if args.profile:
+        profile = profiler.Options(top_k=args.profile, capture=args.profile_functions)
+    if args.sample is not None:
+        if args.mode != "local":
+            parser.error("--sample can only be used with `local`")
+        if not 0 < args.sample <= 1 or args.changelog:
+            parser.error("--sample must be in (0, 1], and not used with --changelog")
+    if args.mode in ("derive", "series") and not args.facts:
+        parser.error("{} requires --facts".format(args.mode))
+    if args.mode == "rules":
+        print(ELIGIBILITY.describe())
+        sys.exit()
+    if args.mode == "serve":
+        if not args.archive:
+            parser.error("serve requires --archive")
+        from server import serve
+
+        serve(
+            args.archive,
+            port=args.port,
+            cache_size=args.cache_size,
+            index_dir=args.index_dir,
+        )
+        sys.exit()
+    if args.mode == "lookup":
+        if not (args.archive and args.nct_ids):
+            parser.error("lookup requires --archive and at least one NCT id")
+        if args.output:
+            print(
+                regenerate_csv(
+                    args.nct_ids, args.archive, args.output, args.as_of, args.index_dir
+                )
+            )
+        else:
+            found = lookup(args.nct_ids, args.archive, args.as_of, args.index_dir)
+            for nct_id, trial in found.items():
+                if trial is None:
+                    print("{} not found".format(nct_id), file=sys.stderr)
+                else:
+                    print(json.dumps(dict(trial, nct_id=nct_id), indent=2))
+        sys.exit()
+    if args.mode == "backfill":
+        if not args.snapshots:
+            parser.error("backfill requires --snapshots")
+        paths = backfill(args.snapshots, executor=args.executor)
+        csv_path = "\n".join(paths[as_of] for as_of in sorted(paths))
+    elif args.mode == "derive":
+        csv_path = derive_csv(args.facts, as_of=args.as_of)
+    elif args.mode == "series":
+        if not (args.first_date and args.last_date):
+            parser.error("series requires --from and --to")
+        csv_path = "\n".join(as_of_series(args.facts, args.first_date, args.last_date))
+    else:
+        csv_path = main(
+            local_only=args.mode == "local",
+            cache_dir=args.cache_dir,
+            with_changelog=args.changelog,
+            store_facts=args.store_facts,
+            as_of=args.as_of,
+            compression=args.compression,
+            limits=limits,
+            schedule=args.schedule,
+            profile=profile,
+            checkpoint_dir=args.checkpoint_dir,
+            executor=args.executor,
+            json_layout=args.json_layout,
+            infer_schema=args.bigquery_schema,
+            archive=args.archive if args.mode == "local" else None,
+            sample=args.sample,
+        )
     print(csv_path)
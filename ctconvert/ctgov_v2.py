@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Read trials from the ClinicalTrials.gov API v2 JSON export.
+
+The export is a zip of one JSON file per study (`NCT01234567.json`),
+each a study record as returned by the v2 API. `facts` maps a record
+onto the same facts that `convert_data.extract_facts` takes from the
+legacy XML, so the ACT/pACT rules and the CSV are unchanged. The v2
+vocabulary differs from the XML's: enums such as `PHASE1` and
+`ACTIVE_NOT_RECRUITING` are translated back to the XML's "Phase 1" and
+"Active, not recruiting", ISO dates are parsed like the XML's (a
+month without a day is its last day, and flagged as defaulted), and
+the JSON-packed facts take the shapes xmltodict gives the XML.
+
+Records are parsed with `orjson` if it is installed, which is several
+times quicker than the standard library.
+
+"""
+import calendar
+import json
+from datetime import date
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+SUFFIX = ".json"
+
+STUDY_TYPES = {
+    "INTERVENTIONAL": "Interventional",
+    "OBSERVATIONAL": "Observational",
+    "EXPANDED_ACCESS": "Expanded Access",
+}
+PHASES = {
+    "EARLY_PHASE1": "Early Phase 1",
+    "PHASE1": "Phase 1",
+    "PHASE2": "Phase 2",
+    "PHASE3": "Phase 3",
+    "PHASE4": "Phase 4",
+    "NA": "N/A",
+}
+STATUSES = {
+    "ACTIVE_NOT_RECRUITING": "Active, not recruiting",
+    "COMPLETED": "Completed",
+    "ENROLLING_BY_INVITATION": "Enrolling by invitation",
+    "NOT_YET_RECRUITING": "Not yet recruiting",
+    "RECRUITING": "Recruiting",
+    "SUSPENDED": "Suspended",
+    "TERMINATED": "Terminated",
+    "WITHDRAWN": "Withdrawn",
+    "AVAILABLE": "Available",
+    "NO_LONGER_AVAILABLE": "No longer available",
+    "TEMPORARILY_NOT_AVAILABLE": "Temporarily not available",
+    "APPROVED_FOR_MARKETING": "Approved for marketing",
+    "WITHHELD": "Withheld",
+    "UNKNOWN": "Unknown status",
+}
+# The XML only distinguishes these sponsor classes
+AGENCY_CLASSES = {"NIH": "NIH", "FED": "U.S. Fed", "INDUSTRY": "Industry"}
+# How the XML's <pending_results> names each kind of unposted event
+UNPOSTED_EVENTS = {
+    "RELEASE": "submitted",
+    "RESET": "returned",
+    "CANCELLATION": "submission_canceled",
+}
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def is_v2_member(name):
+    return name.endswith(SUFFIX)
+
+
+def pack(value):
+    """Pack a value as `convert_data.dict_or_none` does, or None"""
+    if value is None:
+        return None
+    return json.dumps(value, separators=(",", ":"))
+
+
+def one_or_list(items):
+    """Return `items` as xmltodict gives repeated elements: None if
+    there are none, the item if there is one, or a list.
+
+    """
+    items = list(items)
+    if not items:
+        return None
+    return items[0] if len(items) == 1 else items
+
+
+def enum_text(value):
+    """ "DIETARY_SUPPLEMENT" -> "Dietary Supplement" """
+    if value is None:
+        return None
+    return value.replace("_", " ").title()
+
+
+def yes_no(value):
+    if value is None:
+        return None
+    return "Yes" if value else "No"
+
+
+def parse_date(value):
+    """Return `(date, defaulted)` for an ISO date or year and month,
+    which is taken as the last day of the month, like
+    `convert_data.str_to_date`.
+
+    """
+    if value is None:
+        return None, False
+    parts = [int(part) for part in value.split("-")]
+    if len(parts) == 3:
+        return date(*parts), False
+    year, month = parts
+    return date(year, month, calendar.monthrange(year, month)[1]), True
+
+
+def legacy_date(value):
+    """ "2018-03-01" -> "March 1, 2018", as dates are written in the XML"""
+    day, defaulted = parse_date(value)
+    if defaulted:
+        return "{:%B %Y}".format(day)
+    return "{:%B} {}, {}".format(day, day.day, day.year)
+
+
+def mesh_terms(module):
+    terms = one_or_list(mesh["term"] for mesh in module.get("meshes", []))
+    return None if terms is None else {"mesh_term": terms}
+
+
+def intervention(item):
+    legacy = {
+        "intervention_type": enum_text(item.get("type")),
+        "intervention_name": item.get("name"),
+        "description": item.get("description"),
+        "arm_group_label": one_or_list(item.get("armGroupLabels", [])),
+        "other_name": one_or_list(item.get("otherNames", [])),
+    }
+    return {k: v for k, v in legacy.items() if v is not None}
+
+
+def pending_results(annotation):
+    unposted = annotation.get("annotationModule", {}).get("unpostedAnnotation")
+    if unposted is None:
+        return None
+    pending = {}
+    for event in unposted.get("unpostedEvents", []):
+        key = UNPOSTED_EVENTS.get(event.get("type"))
+        if key is not None:
+            text = "Unknown" if event.get("dateUnknown") else legacy_date(event["date"])
+            pending.setdefault(key, []).append(text)
+    return {k: one_or_list(v) for k, v in pending.items()}
+
+
+def facts(study):
+    """Return the facts of a v2 study record, as
+    `convert_data.extract_facts` does for XML (see `FACT_HEADERS`).
+
+    """
+    protocol = study["protocolSection"]
+    identification = protocol["identificationModule"]
+    status = protocol.get("statusModule", {})
+    sponsors = protocol.get("sponsorCollaboratorsModule", {})
+    oversight = protocol.get("oversightModule", {})
+    conditions = protocol.get("conditionsModule", {})
+    design = protocol.get("designModule", {})
+    interventions = protocol.get("armsInterventionsModule", {}).get("interventions", [])
+    locations = protocol.get("contactsLocationsModule", {}).get("locations", [])
+    derived = study.get("derivedSection", {})
+
+    facts = {}
+    facts["nct_id"] = identification["nctId"]
+    study_type = STUDY_TYPES.get(design.get("studyType"))
+    if study_type == "Observational" and design.get("patientRegistry"):
+        study_type = "Observational [Patient Registry]"
+    facts["study_type"] = study_type
+    phases = design.get("phases")
+    facts["phase"] = "/".join(PHASES[p] for p in phases) if phases else None
+    facts["study_status"] = STATUSES.get(status.get("overallStatus"))
+    facts["primary_purpose"] = enum_text(
+        design.get("designInfo", {}).get("primaryPurpose")
+    )
+    facts["fda_reg_drug"] = yes_no(oversight.get("isFdaRegulatedDrug"))
+    facts["fda_reg_device"] = yes_no(oversight.get("isFdaRegulatedDevice"))
+
+    facts["start_date"] = parse_date(status.get("startDateStruct", {}).get("date"))[0]
+    facts["primary_completion_date"], facts["defaulted_pcd_flag"] = parse_date(
+        status.get("primaryCompletionDateStruct", {}).get("date")
+    )
+    facts["completion_date"], facts["defaulted_cd_flag"] = parse_date(
+        status.get("completionDateStruct", {}).get("date")
+    )
+
+    facts["intervention_types"] = [enum_text(i.get("type")) for i in interventions]
+    countries = []
+    for location in locations:
+        country = location.get("country")
+        if country is not None and country not in countries:
+            countries.append(country)
+    # The text of the XML's <location_countries>
+    facts["location_countries"] = (
+        "\n" + "".join(c + "\n" for c in countries) if countries else None
+    )
+    facts["location"] = pack(
+        None if not countries else {"country": one_or_list(countries)}
+    )
+
+    certificate = status.get("dispFirstSubmitDate")
+    facts["has_certificate"] = certificate is not None
+    facts["certificate_date"] = parse_date(certificate)[0]
+    results = status.get("resultsFirstSubmitDate")
+    facts["has_results"] = results is not None
+    facts["results_submitted_date"] = parse_date(results)[0]
+    pending = pending_results(study.get("annotationSection", {}))
+    facts["pending_results"] = pending is not None
+    facts["pending_data"] = pack(pending)
+    facts["last_updated_date"] = parse_date(status.get("lastUpdateSubmitDate"))[0]
+
+    enrollment = design.get("enrollmentInfo", {}).get("count")
+    facts["enrollment"] = None if enrollment is None else str(enrollment)
+    lead = sponsors.get("leadSponsor")
+    if lead is not None:
+        facts["sponsor"] = lead.get("name")
+        facts["sponsor_type"] = AGENCY_CLASSES.get(lead.get("class"), "Other")
+    else:
+        facts["sponsor"] = facts["sponsor_type"] = None
+    facts["collaborators"] = pack(
+        one_or_list(
+            {
+                "agency": c.get("name"),
+                "agency_class": AGENCY_CLASSES.get(c.get("class"), "Other"),
+            }
+            for c in sponsors.get("collaborators", [])
+        )
+    )
+    facts["exported"] = yes_no(oversight.get("isUsExport"))
+    facts["url"] = "https://clinicaltrials.gov/show/" + facts["nct_id"]
+    facts["official_title"] = identification.get("officialTitle")
+    facts["brief_title"] = identification.get("briefTitle")
+
+    facts["condition"] = pack(one_or_list(conditions.get("conditions", [])))
+    facts["condition_mesh"] = pack(mesh_terms(derived.get("conditionBrowseModule", {})))
+    facts["intervention"] = pack(one_or_list(intervention(i) for i in interventions))
+    facts["intervention_mesh"] = pack(
+        mesh_terms(derived.get("interventionBrowseModule", {}))
+    )
+    facts["keywords"] = pack(one_or_list(conditions.get("keywords", [])))
+    return facts
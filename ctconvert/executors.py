@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Run batches of conversion work in worker processes, in threads, or
+serially in this process.
+
+Processes sidestep the GIL, but every batch and its results are
+pickled and copied between processes. Threads share the parent's
+memory and pay nothing for that, which is worthwhile whenever the
+work releases the GIL. Serial execution runs each batch in turn in
+the calling thread, where debuggers and profilers can see it.
+
+Each `*_imap` yields `func(batch)` for each of `batches`, in order,
+with at most `max_pending` batches submitted but not yet yielded. The
+`initializer` sets up per-process state, so it is only run by worker
+processes: threads and serial execution share this process's state.
+
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+PROCESS = "process"
+THREAD = "thread"
+SERIAL = "serial"
+EXECUTORS = [PROCESS, THREAD, SERIAL]
+
+
+def process_imap(func, batches, processes, initializer, max_pending):
+    pool = Pool(processes, initializer=initializer)
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            pending.append(pool.apply_async(func, (batch,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        # Let workers exit normally, so they write their reports
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def thread_imap(func, batches, processes, initializer, max_pending):
+    executor = ThreadPoolExecutor(processes)
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            pending.append(executor.submit(func, batch))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def serial_imap(func, batches, processes, initializer, max_pending):
+    for batch in batches:
+        yield func(batch)
+
+
+IMAPS = {PROCESS: process_imap, THREAD: thread_imap, SERIAL: serial_imap}
+
+
+def imap(executor, func, batches, processes, initializer=None, max_pending=1):
+    """Yield `func(batch)` for each of `batches`, in order, using the
+    named `executor` with `processes` workers.
+
+    """
+    try:
+        run = IMAPS[executor]
+    except KeyError:
+        raise ValueError("Unknown executor {}".format(executor))
+    return run(func, batches, processes, initializer, max_pending)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""An on-disk store of trial facts, by document.
+
+Backfilling parses each distinct document across hundreds of snapshots,
+which is far more facts than fit in memory, let alone in the memory of
+every forked worker. `FactsStore` keeps them in an SQLite file instead:
+one facts line (as written to the facts file by `convert_to_csv`) for
+each `document_key`, i.e. the basename, CRC32 and size of the trial's
+zip member. Each process opens its own `FactsStore` on the file;
+lookups are by primary key, so a worker only ever reads the facts of
+the trials it is writing out.
+
+"""
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS facts (
+    name TEXT NOT NULL,
+    crc INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    PRIMARY KEY (name, crc, size)
+) WITHOUT ROWID
+"""
+
+
+class FactsStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(SCHEMA)
+
+    def add(self, items):
+        """Store `(key, line)` pairs, keeping the line already stored
+        for a key if there is one
+
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO facts VALUES (?, ?, ?, ?)",
+                (key + (line,) for key, line in items),
+            )
+
+    def get(self, key):
+        """Return the facts line stored for `key`, or None"""
+        row = self.connection.execute(
+            "SELECT line FROM facts WHERE name = ? AND crc = ? AND size = ?", key
+        ).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Send the log records of every worker through one queue to one file.
+
+`configure` gives the root logger a `QueueHandler` feeding a
+`multiprocessing.Queue`, and starts a `QueueListener` thread that
+writes whatever arrives to the log file as lines of JSON (for the
+logging agent configured by `fdaaa-converter-log.conf`). Worker
+processes forked afterwards inherit the handler, so the file has a
+single writer however many processes log.
+
+Records below the configured level are discarded by the logger
+before any formatting, which is where most of the savings are: the
+per-trial messages are DEBUG, and the default level is INFO. Records
+that pass are thinned twice:
+
+* in the process that logs them, by a `Sampler` keeping a fixed
+  fraction of each level (by default 1% of DEBUG records), so dropped
+  records are never pickled or sent;
+* in the listener, by a `RateLimiter` allowing each level below ERROR
+  a number of records per second. The next record let through says
+  how many were suppressed.
+
+The level is taken from `--log-level`, or the `CTCONVERT_LOG_LEVEL`
+environment variable, and is INFO otherwise.
+
+"""
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_PATH = "/tmp/clinicaltrials.log"
+LEVEL_VARIABLE = "CTCONVERT_LOG_LEVEL"
+DEFAULT_LEVEL = "INFO"
+# Fraction of the records at each level to keep
+SAMPLE_RATES = {logging.DEBUG: 0.01}
+# Records per second allowed at each level below ERROR
+RATE_LIMIT = 200
+
+# The QueueListener of this process, once configured
+LISTENER = None
+
+
+class Sampler(logging.Filter):
+    """Keep an evenly spread fraction of the records at each level"""
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = SAMPLE_RATES if rates is None else rates
+        self.counts = Counter()
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1)
+        if rate >= 1:
+            return True
+        self.counts[record.levelno] += 1
+        count = self.counts[record.levelno]
+        if int(count * rate) == int((count - 1) * rate):
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class RateLimiter(logging.Filter):
+    """Allow at most `per_second` records a second at each level below
+    `exempt` (with bursts of as many), counting the ones dropped.
+
+    """
+
+    def __init__(self, per_second=RATE_LIMIT, exempt=logging.ERROR, clock=None):
+        super().__init__()
+        self.per_second = per_second
+        self.exempt = exempt
+        self.clock = clock or time.monotonic
+        self.allowance = {}
+        self.last = {}
+        self.suppressed = Counter()
+
+    def filter(self, record):
+        level = record.levelno
+        if level >= self.exempt:
+            return True
+        now = self.clock()
+        allowance = min(
+            self.per_second,
+            self.allowance.get(level, self.per_second)
+            + (now - self.last.get(level, now)) * self.per_second,
+        )
+        self.last[level] = now
+        if allowance < 1:
+            self.allowance[level] = allowance
+            self.suppressed[level] += 1
+            return False
+        self.allowance[level] = allowance - 1
+        if self.suppressed[level]:
+            record.suppressed = self.suppressed.pop(level)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            # Always with microseconds, which the agent's time_format
+            # (%N) requires
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="microseconds"
+            ),
+            "severity": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["message"] += "\n" + self.formatException(record.exc_info)
+        for key in ("sample_rate", "suppressed"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        return json.dumps(entry)
+
+
+def configure(level=None, path=LOG_PATH, sample_rates=None, rate_limit=RATE_LIMIT):
+    """Route all logging through a queue to `path`, as described above.
+    The queue is flushed by `shutdown`, which runs when this process
+    exits.
+
+    Call this before starting any worker processes; they must be
+    forked to inherit the handler.
+
+    """
+    global LISTENER
+    shutdown()
+    level = (level or os.environ.get(LEVEL_VARIABLE) or DEFAULT_LEVEL).upper()
+    # Don't collect what the JSON doesn't show
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    queue = multiprocessing.Queue(-1)
+    # Stop the listener before multiprocessing closes its queue at exit
+    atexit.unregister(shutdown)
+    atexit.register(shutdown)
+    handler = QueueHandler(queue)
+    handler.addFilter(Sampler(sample_rates))
+    root = logging.getLogger()
+    root.setLevel(level)
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(JSONFormatter())
+    file_handler.addFilter(RateLimiter(rate_limit))
+    LISTENER = QueueListener(queue, file_handler)
+    LISTENER.pid = os.getpid()
+    LISTENER.start()
+
+
+def shutdown():
+    """Write out everything logged so far, and stop the listener"""
+    global LISTENER
+    # Forked workers inherit LISTENER, but its thread runs in the parent
+    if LISTENER is not None and LISTENER.pid == os.getpid():
+        LISTENER.stop()
+        for handler in LISTENER.handlers:
+            handler.close()
+        LISTENER = None
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Find the trials that take longest to convert, and why.
+
+When profiling is on, each worker process wraps every conversion in
+`DocumentProfiler.run`, which times it and keeps the `top_k` slowest
+trials seen by that process, with their size and the time spent in
+each phase (recorded by the conversion code calling `mark`).
+
+With `capture`, a trial that enters a worker's top-K is converted again
+under cProfile, and its hottest functions are kept with it, so only the
+outliers pay for the profiler. Conversion counts each trial in the
+rule counters and aggregates, so the caller passes a `rerun` function
+which converts it again without counting it.
+
+Each worker reports its list when it exits; `merge_reports` combines
+them into the run's slowest trials and hot functions. Threads share
+their process's `DocumentProfiler`, which times each of them
+separately.
+
+"""
+import cProfile
+import heapq
+import itertools
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+
+TOP_K = 20
+HOT_FUNCTIONS = 25
+
+# The DocumentProfiler of this process, while profiling
+ACTIVE = None
+
+
+class Options(object):
+    def __init__(self, top_k=TOP_K, capture=False):
+        self.top_k = top_k
+        self.capture = capture
+
+
+def mark(phase):
+    """Record the time since the current trial started, or since the
+    previous mark, as spent in `phase`. Does nothing unless profiling.
+
+    """
+    if ACTIVE is not None:
+        ACTIVE.mark(phase)
+
+
+def function_name(func):
+    filename, line, name = func
+    return "{}:{}({})".format(os.path.basename(filename), line, name)
+
+
+class DocumentProfiler(object):
+    def __init__(self, options):
+        self.options = options
+        self.slowest = []
+        self.counter = itertools.count()
+        self.documents = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        # The trial being converted by each thread
+        self.current = threading.local()
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        current = self.current
+        current.phases[phase] = current.phases.get(phase, 0) + now - current.last
+        current.last = now
+
+    def run(self, worker, name, data, rerun=None):
+        """Return `worker(name, data)`, recording how long it took.
+        `rerun` (by default `worker`) converts the trial again when its
+        functions are captured.
+
+        """
+        current = self.current
+        current.phases = {}
+        started = current.last = time.perf_counter()
+        result = worker(name, data)
+        seconds = time.perf_counter() - started
+        with self.lock:
+            self.documents += 1
+            self.seconds += seconds
+            self.bytes += len(data)
+            if len(self.slowest) < self.options.top_k or seconds > self.slowest[0][0]:
+                entry = {
+                    "name": name,
+                    "bytes": len(data),
+                    "seconds": round(seconds, 6),
+                    "phases": {
+                        phase: round(spent, 6)
+                        for phase, spent in current.phases.items()
+                    },
+                }
+                if self.options.capture:
+                    # Only one profiler can run at once
+                    entry["functions"] = self.capture(rerun or worker, name, data)
+                item = (seconds, next(self.counter), entry)
+                if len(self.slowest) < self.options.top_k:
+                    heapq.heappush(self.slowest, item)
+                else:
+                    heapq.heapreplace(self.slowest, item)
+        return result
+
+    def capture(self, worker, name, data):
+        """Convert the trial again under cProfile, and return its
+        hottest functions as `[function, calls, own seconds, cumulative
+        seconds]`.
+
+        """
+        self.current.phases = {}
+        self.current.last = time.perf_counter()
+        profile = cProfile.Profile()
+        profile.runcall(worker, name, data)
+        stats = pstats.Stats(profile).stats
+        hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+        return [
+            [function_name(func), calls, round(own, 6), round(cumulative, 6)]
+            for func, (_, calls, own, cumulative, _) in hottest[:HOT_FUNCTIONS]
+        ]
+
+    def report(self):
+        return {
+            "pid": os.getpid(),
+            "documents": self.documents,
+            "seconds": round(self.seconds, 6),
+            "bytes": self.bytes,
+            "slowest": [
+                entry for _, _, entry in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+def merge_reports(reports, top_k=TOP_K):
+    """Combine the reports of each worker into the `top_k` slowest
+    trials overall, and the functions that took most time in the
+    captured trials.
+
+    """
+    slowest = sorted(
+        (entry for report in reports for entry in report["slowest"]),
+        key=lambda entry: entry["seconds"],
+        reverse=True,
+    )[:top_k]
+    functions = defaultdict(lambda: [0, 0.0, 0.0])
+    for entry in slowest:
+        for name, calls, own, cumulative in entry.get("functions", []):
+            totals = functions[name]
+            totals[0] += calls
+            totals[1] += own
+            totals[2] += cumulative
+    hot_functions = sorted(functions.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        "documents": sum(report["documents"] for report in reports),
+        "seconds": round(sum(report["seconds"] for report in reports), 6),
+        "bytes": sum(report["bytes"] for report in reports),
+        "workers": [
+            {key: report[key] for key in ("pid", "documents", "seconds", "bytes")}
+            for report in reports
+        ],
+        "slowest": slowest,
+        "hot_functions": [
+            {
+                "function": name,
+                "calls": calls,
+                "own_seconds": round(own, 6),
+                "cumulative_seconds": round(cumulative, 6),
+            }
+            for name, (calls, own, cumulative) in hot_functions[:HOT_FUNCTIONS]
+        ],
+    }
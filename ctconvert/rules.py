@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Evaluate eligibility rules written as conjunctions of named
+predicates.
+
+A `RulePlan` is built once from a list of predicates and a list of
+rules. For each record it evaluates every predicate at most once,
+however many rules share it, and it stops a rule at the first
+predicate that fails. Within each rule, predicates are periodically
+reordered so that the ones that fail most often (as measured so far)
+are tried first. Because predicates are pure, the order never changes
+the outcome.
+
+A plan can be shared between threads: its counters are updated under
+a lock, and reordering replaces a rule's list of predicates rather
+than sorting it in place under another thread. Within `uncounted`, a
+thread's evaluations leave the counters alone, so a record can be
+evaluated again (e.g. under a profiler) without being counted twice.
+
+"""
+import contextlib
+import threading
+from collections import Counter
+
+REORDER_EVERY = 1000
+
+
+class Predicate(object):
+    def __init__(self, name, func, description):
+        self.name = name
+        self.func = func
+        self.description = description
+
+
+class RulePlan(object):
+    def __init__(self, predicates, rules, reorder_every=REORDER_EVERY):
+        """`predicates` is a list of `Predicate`; `rules` is a list of
+        `(rule_name, [predicate_name, ...])` pairs, all of which must
+        hold for the rule to hold.
+
+        """
+        self.predicates = {p.name: p for p in predicates}
+        for rule_name, names in rules:
+            unknown = set(names) - set(self.predicates)
+            if unknown:
+                raise ValueError(
+                    "Rule {} uses unknown predicates {}".format(
+                        rule_name, sorted(unknown)
+                    )
+                )
+        self.rules = [(rule_name, list(names)) for rule_name, names in rules]
+        self.funcs = {name: p.func for name, p in self.predicates.items()}
+        self.reorder_every = reorder_every
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset_stats()
+
+    @contextlib.contextmanager
+    def uncounted(self):
+        """Don't count what this thread evaluates within this block"""
+        self.local.uncounted = True
+        try:
+            yield
+        finally:
+            self.local.uncounted = False
+
+    def reset_stats(self):
+        self.records = 0
+        self.evaluated = Counter()
+        self.passed = Counter()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def evaluate(self, *args):
+        """Return a dict of rule name -> bool for one record. `args` are
+        passed to every predicate.
+
+        """
+        results = {}
+        outcome = {}
+        for rule_name, names in self.rules:
+            # A predicate already known to fail decides the rule for free
+            holds = not any(results.get(name) is False for name in names)
+            if holds:
+                for name in names:
+                    value = results.get(name)
+                    if value is None:
+                        value = results[name] = bool(self.funcs[name](*args))
+                    if not value:
+                        holds = False
+                        break
+            outcome[rule_name] = holds
+        if getattr(self.local, "uncounted", False):
+            return outcome
+        with self.lock:
+            for name, value in results.items():
+                self.evaluated[name] += 1
+                if value:
+                    self.passed[name] += 1
+            for rule_name, holds in outcome.items():
+                if holds:
+                    self.hits[rule_name] += 1
+                else:
+                    self.misses[rule_name] += 1
+            self.records += 1
+            if self.records % self.reorder_every == 0:
+                self.reorder()
+        return outcome
+
+    def pass_rate(self, name):
+        evaluated = self.evaluated[name]
+        if not evaluated:
+            return 1.0
+        return self.passed[name] / evaluated
+
+    def reorder(self):
+        """Put the most selective predicates of each rule first"""
+        self.rules = [
+            (rule_name, sorted(names, key=self.pass_rate))
+            for rule_name, names in self.rules
+        ]
+
+    def stats(self):
+        return {
+            "records": self.records,
+            "rules": {
+                rule_name: {
+                    "hits": self.hits[rule_name],
+                    "misses": self.misses[rule_name],
+                }
+                for rule_name, _ in self.rules
+            },
+            "predicates": {
+                name: {"evaluated": self.evaluated[name], "passed": self.passed[name]}
+                for name in self.predicates
+            },
+        }
+
+    def describe(self):
+        """Return a plain-text listing of each rule and its predicates,
+        in their current order, for auditing.
+
+        """
+        lines = []
+        for rule_name, names in self.rules:
+            lines.append("{} holds if all of:".format(rule_name))
+            for name in names:
+                lines.append(
+                    "  - {}: {}".format(name, self.predicates[name].description)
+                )
+        return "\n".join(lines)
+
+
+def merge_stats(stats_list):
+    """Sum a list of `RulePlan.stats()` dicts, e.g. from each worker"""
+    merged = {"records": 0, "rules": {}, "predicates": {}}
+    for stats in stats_list:
+        merged["records"] += stats["records"]
+        for section in ("rules", "predicates"):
+            for name, counts in stats[section].items():
+                total = merged[section].setdefault(name, Counter())
+                total.update(counts)
+    for section in ("rules", "predicates"):
+        merged[section] = {
+            name: dict(counts) for name, counts in merged[section].items()
+        }
+    return merged
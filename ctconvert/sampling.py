@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Convert a deterministic sample of the archive, and extrapolate.
+
+A full run takes an hour, which is a long wait to see what a change to
+the ACT/pACT rules does. `sample_archive` copies a fixed fraction of
+the trials to a smaller archive, which converts in proportion. Trials
+are chosen by a hash of their NCT id, so a sample always holds the
+same trials, whichever snapshot (or format) it is drawn from, and the
+output of two runs can be compared trial by trial.
+
+`estimate` extrapolates a count in the sample to the whole archive,
+with a Wilson score interval, corrected for sampling without
+replacement from a known number of trials.
+
+"""
+import hashlib
+import math
+import os
+import zipfile
+
+# z for a 95% interval
+Z = 1.96
+
+
+def nct_id(name):
+    """ "NCT0000xxxx/NCT00001234.xml" -> "NCT00001234" """
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def in_sample(name, fraction):
+    """Whether the trial in the archive member `name` is in a sample of
+    `fraction` of the trials
+
+    """
+    digest = hashlib.sha1(nct_id(name).encode("utf-8")).hexdigest()
+    return int(digest[:15], 16) < fraction * 16**15
+
+
+def sample_archive(source, target, fraction, is_member):
+    """Copy the members of the zip `source` for which `is_member(name)`
+    holds and which are in a sample of `fraction` of them to a new zip
+    `target`, uncompressed. Return `(population, sampled)`, the number
+    of such members in `source` and in `target`.
+
+    """
+    population = sampled = 0
+    with zipfile.ZipFile(source) as archive:
+        with zipfile.ZipFile(target, "w", zipfile.ZIP_STORED) as sample:
+            for info in archive.infolist():
+                if not is_member(info.filename):
+                    continue
+                population += 1
+                if in_sample(info.filename, fraction):
+                    sampled += 1
+                    sample.writestr(
+                        zipfile.ZipInfo(info.filename, info.date_time),
+                        archive.read(info),
+                    )
+    return population, sampled
+
+
+def estimate(count, sampled, population, z=Z):
+    """Return `(estimate, low, high)` for the number of trials in a
+    population of `population` given `count` of a simple random sample
+    of `sampled` of them.
+
+    """
+    if sampled == 0:
+        return None, 0, population
+    proportion = count / sampled
+    if sampled >= population:
+        return count, count, count
+    # The sample size for which an interval with replacement is as wide
+    # as this one without
+    n = sampled * (population - 1) / (population - sampled)
+    denominator = 1 + z**2 / n
+    centre = (proportion + z**2 / (2 * n)) / denominator
+    half_width = (
+        z
+        * math.sqrt(proportion * (1 - proportion) / n + z**2 / (4 * n**2))
+        / denominator
+    )
+    # The trials outside the sample can add none or all of themselves
+    return (
+        proportion * population,
+        max((centre - half_width) * population, count),
+        min((centre + half_width) * population, population - sampled + count),
+    )
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Order work so that a pool of workers finishes together, and measure
+how busy the pool was.
+
+Trials vary in size by orders of magnitude. Sent in archive order, a
+handful of large ones near the end keep a few workers busy while the
+rest of the pool sits idle. `balanced_batches` instead deals items out
+largest first to whichever batch is currently smallest (the classic
+longest-processing-time rule), so batches come out with similar total
+sizes, each led by its largest item.
+
+`Utilization` records when each batch ran, to report how many workers
+were busy over time and how long the idle tail at the end of a run
+lasted.
+
+"""
+import heapq
+import math
+
+
+def balanced_batches(items, size_of, batch_size):
+    """Split `items` into `ceil(len(items) / batch_size)` batches of
+    roughly equal total `size_of(item)`, largest batch first, with the
+    items in each batch in descending order of size.
+
+    """
+    if not items:
+        return []
+    count = math.ceil(len(items) / batch_size)
+    heap = [(0, i) for i in range(count)]
+    batches = [[] for _ in range(count)]
+    totals = [0] * count
+    for item in sorted(items, key=size_of, reverse=True):
+        total, i = heapq.heappop(heap)
+        batches[i].append(item)
+        totals[i] = total + size_of(item)
+        heapq.heappush(heap, (totals[i], i))
+    order = sorted(range(count), key=lambda i: totals[i], reverse=True)
+    return [batches[i] for i in order]
+
+
+class Utilization(object):
+    def __init__(self, processes):
+        self.processes = processes
+        self.intervals = []
+
+    def add(self, started, finished):
+        self.intervals.append((started, finished))
+
+    def timeline(self, step=1.0):
+        """Return `(seconds, busy_workers)` pairs giving the average
+        number of busy workers in each `step` seconds of the run.
+
+        """
+        if not self.intervals:
+            return []
+        start = min(started for started, _ in self.intervals)
+        end = max(finished for _, finished in self.intervals)
+        busy = [0.0] * (int((end - start) / step) + 1)
+        for started, finished in self.intervals:
+            first = int((started - start) / step)
+            last = int((finished - start) / step)
+            for bucket in range(first, last + 1):
+                bucket_start = start + bucket * step
+                overlap = min(finished, bucket_start + step) - max(
+                    started, bucket_start
+                )
+                busy[bucket] += max(overlap, 0) / step
+        return [(round(i * step, 3), round(b, 2)) for i, b in enumerate(busy)]
+
+    def summary(self):
+        """Return the wall time, the fraction of the pool's capacity
+        spent converting, and the tail: the time from the last moment
+        every worker was busy to the end of the run.
+
+        """
+        if not self.intervals:
+            return {"seconds": 0, "utilization": None, "tail_seconds": 0}
+        start = min(started for started, _ in self.intervals)
+        end = max(finished for _, finished in self.intervals)
+        seconds = end - start
+        busy = sum(finished - started for started, finished in self.intervals)
+        events = sorted(
+            [(started, 1) for started, _ in self.intervals]
+            + [(finished, -1) for _, finished in self.intervals]
+        )
+        running = 0
+        last_full = start
+        for when, change in events:
+            if running >= self.processes:
+                last_full = when
+            running += change
+        return {
+            "seconds": round(seconds, 3),
+            "utilization": round(busy / (seconds * self.processes), 3)
+            if seconds
+            else None,
+            "tail_seconds": round(end - last_full, 3),
+        }
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""A long-running HTTP service that converts single trials on demand.
+
+The archive (with its index; see `archive_index`), the FDA regulatory lookup and an
+LRU cache of converted trials stay in memory between requests, so
+each request costs at most one member read and parse.
+
+Endpoints:
+
+    GET /trials/NCT01234567.json   the trial's JSON
+    GET /trials/NCT01234567.csv    CSV header and the trial's row
+    GET /trials.json?ids=NCT...,NCT...   object of nct_id -> JSON or null
+    GET /trials.csv?ids=NCT...,NCT...    CSV header and rows
+    GET /stats                     cache hit rate and latency percentiles
+
+CSV rows are returned whether or not the trial would be included in
+the full CSV; the `act_flag` and `included_pact_flag` columns say.
+Requests for ids that aren't NCT ids get a 400, and trials that fail
+to convert a 500.
+
+"""
+import collections
+import json
+import logging
+import re
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import convert_data
+from archive_index import ArchiveIndex
+
+CACHE_SIZE = 10000
+LATENCY_SAMPLES = 10000
+
+TRIAL_PATH = re.compile(r"^/trials/([^/]+)\.(json|csv)$")
+NCT_ID = re.compile(r"^NCT[0-9]{8}$")
+BATCH_PATH = re.compile(r"^/trials\.(json|csv)$")
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionService(object):
+    def __init__(self, zip_path, cache_size=CACHE_SIZE, index_dir=None):
+        self.index = ArchiveIndex(zip_path, index_dir)
+        convert_data.set_fda_reg_dict()
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.as_of = None
+        self.thresholds = None
+        self.hits = 0
+        self.misses = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def current_thresholds(self):
+        """Return today's `AsOf`, emptying the cache when the date
+        changes, as results_due etc. may differ. Call with `self.lock`
+        held.
+
+        """
+        today = date.today()
+        if today != self.as_of:
+            self.cache.clear()
+            self.as_of = today
+            self.thresholds = convert_data.AsOf(today)
+        return self.thresholds
+
+    def get(self, nct_id):
+        """Return a dict with the `json` and `csv` (line) forms of
+        `nct_id`, or None if it is not in the archive.
+
+        """
+        with self.lock:
+            thresholds = self.current_thresholds()
+            as_of = self.as_of
+            trial = self.cache.get(nct_id)
+            if trial is not None:
+                self.cache.move_to_end(nct_id)
+                self.hits += 1
+                return trial
+            self.misses += 1
+        try:
+            name, data = self.index.read_member(nct_id)
+        except KeyError:
+            return None
+        td = convert_data.derive_row(
+            convert_data.parse_document(name, data), thresholds
+        )
+        trial = {
+            "json": convert_data.trial_to_json(data, name=name),
+            "csv": convert_data.csv_line(td),
+        }
+        with self.lock:
+            # Unless the date changed meanwhile, and with it the cache
+            if self.as_of == as_of:
+                self.cache[nct_id] = trial
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return trial
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            lookups = self.hits + self.misses
+            stats = {
+                "cached": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "requests": len(latencies),
+            }
+        for p in (50, 90, 99):
+            key = "latency_p{}_ms".format(p)
+            if latencies:
+                i = min(len(latencies) - 1, int(len(latencies) * p / 100))
+                stats[key] = round(latencies[i] * 1000, 3)
+            else:
+                stats[key] = None
+        return stats
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        started = time.time()
+        url = urlparse(self.path)
+        try:
+            self.route(url)
+        except Exception:
+            logger.exception("Failed to serve %s", self.path)
+            self.send_error(500)
+        finally:
+            if url.path != "/stats":
+                self.service.record_latency(time.time() - started)
+
+    def route(self, url):
+        match = TRIAL_PATH.match(url.path)
+        if match:
+            nct_id, fmt = match.groups()
+            if not NCT_ID.match(nct_id):
+                self.send_error(400, "Not an NCT id")
+                return
+            trial = self.service.get(nct_id)
+            if trial is None:
+                self.send_error(404, "{} not found".format(nct_id))
+            elif fmt == "json":
+                self.respond("application/json", trial["json"])
+            else:
+                self.respond("text/csv", csv_header() + trial["csv"])
+            return
+
+        match = BATCH_PATH.match(url.path)
+        if match:
+            fmt = match.group(1)
+            ids = [
+                nct_id
+                for value in parse_qs(url.query).get("ids", [])
+                for nct_id in value.split(",")
+                if nct_id
+            ]
+            if not all(NCT_ID.match(nct_id) for nct_id in ids):
+                self.send_error(400, "Not an NCT id")
+                return
+            trials = [(nct_id, self.service.get(nct_id)) for nct_id in ids]
+            if fmt == "json":
+                body = "{{{}}}".format(
+                    ", ".join(
+                        "{}: {}".format(
+                            json.dumps(nct_id), trial["json"] if trial else "null"
+                        )
+                        for nct_id, trial in trials
+                    )
+                )
+                self.respond("application/json", body)
+            else:
+                rows = "".join(trial["csv"] for _, trial in trials if trial)
+                self.respond("text/csv", csv_header() + rows)
+            return
+
+        if url.path == "/stats":
+            self.respond("application/json", json.dumps(self.service.stats()))
+            return
+
+        self.send_error(404)
+
+    def respond(self, content_type, body):
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def csv_header():
+    return ",".join(convert_data.CSV_HEADERS) + "\r\n"
+
+
+def make_server(
+    zip_path, host="127.0.0.1", port=8000, cache_size=CACHE_SIZE, index_dir=None
+):
+    service = ConversionService(zip_path, cache_size=cache_size, index_dir=index_dir)
+    handler = type("Handler", (ConversionHandler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(zip_path, host="127.0.0.1", port=8000, cache_size=CACHE_SIZE, index_dir=None):
+    httpd = make_server(zip_path, host, port, cache_size, index_dir)
+    logger.info("Serving %s on %s:%s", zip_path, host, httpd.server_port)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Download a Cloud Storage blob as byte-range slices fetched in
+parallel.
+
+The destination file is preallocated to the size of the blob and each
+slice is written into place as it arrives. Completed slices are
+synced to disk and then recorded in a progress file next to the
+destination, so an interrupted download can be resumed without
+fetching them again, as long as the destination survives the
+interruption. Once all slices are present, the file is checked against
+the CRC32C (or MD5) recorded in the blob metadata, and the blob is
+checked to be the same generation as when the download started. The
+progress file then records the download as complete, and is left in
+place with the file, so that downloading the same generation again
+(e.g. in a run restarted after a later failure) reuses the file as it
+is.
+
+Only `Blob.download_as_string(start=, end=)` is used, which the
+pinned google-cloud-storage 1.15 has; it can't pin a download to a
+generation, hence the check at the end.
+
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import google_crc32c
+except ImportError:  # pragma: no cover
+    google_crc32c = None
+
+SLICE_SIZE = 32 * 1024 * 1024
+MAX_WORKERS = 8
+RETRIES = 3
+PROGRESS_SUFFIX = ".slices"
+
+logger = logging.getLogger(__name__)
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class GenerationChanged(Exception):
+    pass
+
+
+def slices(size, slice_size):
+    """Return a list of `(start, end)` byte ranges covering `size`
+    bytes. `end` is inclusive, as in an HTTP Range header.
+
+    """
+    return [
+        (start, min(start + slice_size, size) - 1)
+        for start in range(0, size, slice_size)
+    ]
+
+
+def read_progress(progress_path, blob):
+    """Return the progress recorded for this generation of `blob`, a
+    dict with the list of slice indexes already written as `done` and
+    whether the download was verified as `complete`, or None if there
+    is nothing usable to resume from.
+
+    """
+    try:
+        with open(progress_path) as f:
+            progress = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (
+        progress.get("generation") != blob.generation
+        or progress.get("size") != blob.size
+    ):
+        return None
+    return progress
+
+
+def write_progress(progress_path, blob, done, complete=False):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "generation": blob.generation,
+                "size": blob.size,
+                "done": sorted(done),
+                "complete": complete,
+            },
+            f,
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, progress_path)
+
+
+def file_checksums(path):
+    """Return base64-encoded `(crc32c, md5)` digests of the file at
+    `path`, in the format used by Cloud Storage metadata. The CRC32C is
+    None if `google_crc32c` is unavailable.
+
+    """
+    crc = google_crc32c.Checksum() if google_crc32c else None
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    crc32c = base64.b64encode(crc.digest()).decode("ascii") if crc else None
+    return crc32c, base64.b64encode(md5.digest()).decode("ascii")
+
+
+def verify(path, blob):
+    """Raise `ChecksumMismatch` unless the file at `path` matches the
+    checksums in the metadata of `blob`.
+
+    Composite objects have no MD5, so CRC32C is preferred when both the
+    metadata and the library to compute it are available.
+
+    """
+    crc32c, md5 = file_checksums(path)
+    if blob.crc32c and crc32c:
+        expected, actual, kind = blob.crc32c, crc32c, "CRC32C"
+    elif blob.md5_hash:
+        expected, actual, kind = blob.md5_hash, md5, "MD5"
+    else:
+        logger.warning("No checksum available to verify %s", path)
+        return
+    if expected != actual:
+        raise ChecksumMismatch(
+            "{} of {} is {}, expected {}".format(kind, path, actual, expected)
+        )
+
+
+def download_blob_sliced(
+    blob, destination, slice_size=SLICE_SIZE, max_workers=MAX_WORKERS
+):
+    """Download `blob` to `destination` using `max_workers` concurrent
+    ranged requests of `slice_size` bytes each.
+
+    `blob` must have its metadata loaded (as returned by
+    `bucket.get_blob()`). If a progress file from an earlier attempt
+    at the same generation exists, only the missing slices are
+    fetched, or none if that attempt completed. Raises `GenerationChanged` if the blob was replaced
+    during the download, which must then be started again.
+
+    """
+    generation = blob.generation
+    progress_path = destination + PROGRESS_SUFFIX
+    ranges = slices(blob.size, slice_size)
+    progress = None
+    if os.path.exists(destination):
+        progress = read_progress(progress_path, blob)
+    if progress and progress.get("complete"):
+        logger.info("Reusing %s, already downloaded to %s", blob.name, destination)
+        return
+    done = set(progress["done"]) if progress else set()
+    lock = threading.Lock()
+
+    mode = "r+b" if done else "wb"
+    with open(destination, mode) as f:
+        f.truncate(blob.size)
+        fd = f.fileno()
+
+        def fetch(index):
+            start, end = ranges[index]
+            for attempt in range(1, RETRIES + 1):
+                try:
+                    data = blob.download_as_string(start=start, end=end)
+                    break
+                except Exception:
+                    if attempt == RETRIES:
+                        raise
+                    logger.warning(
+                        "Retrying slice %s of %s (attempt %s)",
+                        index,
+                        blob.name,
+                        attempt,
+                    )
+            if len(data) != end - start + 1:
+                raise IOError(
+                    "Short read for bytes {}-{} of {}".format(start, end, blob.name)
+                )
+            os.pwrite(fd, data, start)
+            # The slice must be on disk before it is recorded as done
+            os.fsync(fd)
+            with lock:
+                done.add(index)
+                write_progress(progress_path, blob, done)
+
+        todo = [i for i in range(len(ranges)) if i not in done]
+        logger.info(
+            "Downloading %s slices of %s (%s already present)",
+            len(todo),
+            blob.name,
+            len(ranges) - len(todo),
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() to re-raise the first exception from any slice
+            list(executor.map(fetch, todo))
+        os.fsync(fd)
+
+    try:
+        blob.reload()
+        if blob.generation != generation:
+            raise GenerationChanged(
+                "{} was replaced while it was downloaded".format(blob.name)
+            )
+        verify(destination, blob)
+    except (ChecksumMismatch, GenerationChanged):
+        os.remove(destination)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        raise
+    write_progress(progress_path, blob, done, complete=True)
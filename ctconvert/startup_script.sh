@@ -31,6 +31,8 @@ apt-get update
 apt-get -y install python3.7 python3.7-venv
 
 cd /tmp
+# A preempted instance runs this again when restarted
+rm -rf clinicaltrials-act-converter
 git clone https://github.com/ebmdatalab/clinicaltrials-act-converter.git
 cd clinicaltrials-act-converter
 
@@ -38,7 +40,7 @@ python3.7 -m venv venv
 venv/bin/pip install -r requirements.txt
 
 echo "Running command"
-venv/bin/python ctconvert/convert_data.py
+venv/bin/python ctconvert/convert_data.py --checkpoint-dir /var/tmp/ctconvert-checkpoints
 
 echo "Running webhook $CALLBACK"
 curl "$CALLBACK"
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Where a run keeps the files that outlive it: the archive backup,
+the published CSV, the raw JSON and the change log's hash index.
+
+`GCSStorage` keeps them in the project's Cloud Storage bucket, and
+`LocalStorage` in a directory. The Google Cloud SDKs take a large
+share of the converter's startup time and of each worker's memory, so
+they are imported only when a `GCSStorage` is created; `local` runs
+never load them.
+
+"""
+import logging
+import os
+import shutil
+from datetime import datetime, timezone
+
+# Daily exports laid out as <prefix>snapshot_date=YYYY-MM-DD/<name>
+# ("hive" partitioning) can be queried by date in BigQuery, which then
+# only reads the files of the dates it needs
+PARTITION_KEY = "snapshot_date"
+
+logger = logging.getLogger(__name__)
+
+
+def partitioned_name(prefix, day, name):
+    """Return the name of the object `name` for the date `day` under
+    `prefix`, in a hive-partitioned layout.
+
+    """
+    return "{}{}={}/{}".format(prefix, PARTITION_KEY, day.isoformat(), name)
+
+
+class LocalStorage(object):
+    """Store objects as files under `root`"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def updated(self, name):
+        """Return when `name` was last stored, or None if it isn't"""
+        try:
+            mtime = os.path.getmtime(self.path(name))
+        except FileNotFoundError:
+            return None
+        return datetime.fromtimestamp(mtime, timezone.utc)
+
+    def download(self, name, destination):
+        """Copy `name` to `destination`, returning False if there is no
+        such object.
+
+        """
+        if not os.path.exists(self.path(name)):
+            return False
+        shutil.copyfile(self.path(name), destination)
+        return True
+
+    def upload(
+        self,
+        source_path,
+        name,
+        make_public=False,
+        content_type=None,
+        content_encoding=None,
+    ):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        shutil.copyfile(source_path, self.path(name))
+
+
+class GCSStorage(object):
+    """Store objects in the project's Cloud Storage bucket"""
+
+    def __init__(self):
+        from bigquery import StorageClient
+
+        self.bucket = StorageClient().get_bucket()
+
+    def updated(self, name):
+        blob = self.bucket.get_blob(name)
+        return blob.updated if blob else None
+
+    def download(self, name, destination, partial_dir=None):
+        """Download `name` to `destination` in concurrent slices,
+        returning False if there is no such object.
+
+        With `partial_dir`, the download is made there and `destination`
+        linked to it, so an interrupted download resumes from where it
+        stopped, and a finished one is reused, if `partial_dir`
+        survives until the next attempt.
+
+        """
+        from sliced_download import download_blob_sliced
+
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return False
+        if partial_dir is None:
+            download_blob_sliced(blob, destination)
+            return True
+        os.makedirs(partial_dir, exist_ok=True)
+        partial = os.path.join(partial_dir, os.path.basename(name))
+        download_blob_sliced(blob, partial)
+        os.symlink(os.path.abspath(partial), destination)
+        return True
+
+    def upload(
+        self,
+        source_path,
+        name,
+        make_public=False,
+        content_type=None,
+        content_encoding=None,
+    ):
+        logger.info("Uploading %s to %s", source_path, name)
+        blob = self.bucket.blob(name, chunk_size=1024 * 1024)
+        blob.content_encoding = content_encoding
+        with open(source_path, "rb") as f:
+            blob.upload_from_file(f, content_type=content_type)
+        if make_public:
+            blob.make_public()
@@ -0,0 +1,48 @@
+"""Tests for aggregates.py"""
+
+import csv
+
+import aggregates
+
+
+def make_row(sponsor, phase=None, **flags):
+    row = {name: False for name in aggregates.METRICS}
+    row.update(
+        sponsor=sponsor, sponsor_type="Industry", phase=phase, study_status="Completed"
+    )
+    row.update(flags)
+    return row
+
+
+def test_worker_counts_merge_into_one_summary(tmp_path):
+    first, second = aggregates.Aggregates(), aggregates.Aggregates()
+    first.add(make_row("Acme", "Phase 2", act_flag=True, results_due=True))
+    first.add(make_row("Bloggs", "Phase 3", act_flag=True))
+    second.add(make_row("Acme", None, included_pact_flag=True, results_due=True))
+    stats = aggregates.merge_stats([first.stats(), second.stats()])
+    assert stats["sponsor"]["Acme"] == {
+        "trials": 2,
+        "act_flag": 1,
+        "included_pact_flag": 1,
+        "results_due": 2,
+    }
+    assert stats["sponsor_type"]["Industry"]["trials"] == 3
+    assert stats["phase"][""] == {
+        "trials": 1,
+        "included_pact_flag": 1,
+        "results_due": 1,
+    }
+
+    path = str(tmp_path / "aggregates.csv")
+    aggregates.write_csv(path, stats)
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == aggregates.HEADERS
+    assert rows[1] == ["sponsor", "Acme", "2", "1", "1", "2", "0", "0", "0", "0"]
+    assert [row[:3] for row in rows[3:]] == [
+        ["sponsor_type", "Industry", "3"],
+        ["phase", "", "1"],
+        ["phase", "Phase 2", "1"],
+        ["phase", "Phase 3", "1"],
+        ["study_status", "Completed", "3"],
+    ]
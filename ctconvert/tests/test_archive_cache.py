@@ -0,0 +1,86 @@
+"""Tests for archive_cache.py, against a local stand-in for CT.gov"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from archive_cache import ArchiveCache
+
+FIXTURE_ROOT = "ctconvert/tests/fixtures/"
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    content = b""
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    with open(FIXTURE_ROOT + "data.zip", "rb") as f:
+        ArchiveHandler.content = f.read()
+    ArchiveHandler.etag = '"v1"'
+    ArchiveHandler.requests = []
+    httpd = HTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{}/AllPublicXML.zip".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_reuses_unchanged_archive(server, tmp_path):
+    cache = ArchiveCache(str(tmp_path / "cache"))
+    destination = str(tmp_path / "AllPublicXML.zip")
+
+    assert not cache.fetch(server, destination)
+    assert cache.fetch(server, destination)
+    assert ArchiveHandler.requests[1]["If-None-Match"] == '"v1"'
+    with open(destination, "rb") as f:
+        assert f.read() == ArchiveHandler.content
+
+
+def test_refetches_changed_archive_and_evicts(server, tmp_path):
+    cache = ArchiveCache(str(tmp_path / "cache"), max_entries=1)
+    destination = str(tmp_path / "AllPublicXML.zip")
+    cache.fetch(server, destination)
+
+    ArchiveHandler.content = b"a newer archive"
+    ArchiveHandler.etag = '"v2"'
+    assert not cache.fetch(server, destination)
+    with open(destination, "rb") as f:
+        assert f.read() == b"a newer archive"
+    assert len(os.listdir(cache.objects_dir)) == 1
+
+
+def test_refetches_corrupt_entry(server, tmp_path):
+    cache = ArchiveCache(str(tmp_path / "cache"))
+    destination = str(tmp_path / "AllPublicXML.zip")
+    cache.fetch(server, destination)
+    os.remove(destination)
+    (object_name,) = os.listdir(cache.objects_dir)
+    with open(os.path.join(cache.objects_dir, object_name), "r+b") as f:
+        f.write(b"garbage")
+
+    assert not cache.fetch(server, destination)
+    assert "If-None-Match" not in ArchiveHandler.requests[-1]
+    with open(destination, "rb") as f:
+        assert f.read() == ArchiveHandler.content
@@ -0,0 +1,111 @@
+"""Tests for archive_index.py and the lookup functions that use it"""
+
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+from datetime import date
+
+import pytest
+
+import convert_data
+from archive_index import ArchiveIndex, index_path
+
+FIXTURE_ROOT = "ctconvert/tests/fixtures/"
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = str(tmp_path / "AllPublicXML.zip")
+    shutil.copy(FIXTURE_ROOT + "data.zip", path)
+    return path
+
+
+def test_reads_members_by_nct_id(archive):
+    with zipfile.ZipFile(archive) as z:
+        expected = {
+            os.path.basename(name)[:-4]: z.read(name)
+            for name in z.namelist()
+            if name.endswith(".xml")
+        }
+    with ArchiveIndex(archive) as index:
+        assert len(index) == 5
+        for nct_id, data in expected.items():
+            assert index.read(nct_id) == data
+        assert "NCT99999999" not in index
+        with pytest.raises(KeyError):
+            index.read("NCT00000001")
+
+
+def test_rebuilds_stale_index(archive):
+    ArchiveIndex(archive).close()
+    with open(index_path(archive), "r+b") as f:
+        f.write(b"garbage!")
+    with ArchiveIndex(archive) as index:
+        assert "NCT02413372" in index
+
+
+def test_lookup_matches_full_run(archive):
+    with open(FIXTURE_ROOT + "expected_trials_data.csv") as f:
+        expected = {row[0]: row for row in csv.reader(f)}
+
+    found = convert_data.lookup(
+        ["NCT02413372", "NCT99999999"], archive, as_of=date(2020, 1, 1)
+    )
+    assert found["NCT99999999"] is None
+    trial = found["NCT02413372"]
+    assert trial["included"]
+    assert next(csv.reader([trial["csv"]])) == expected["NCT02413372"]
+    assert '"nct_id": "NCT02413372"' in trial["json"]
+    assert trial["xml"].startswith("<clinical_study>")
+
+
+def test_lookup_reads_v2_export(archive):
+    v2_archive = os.path.join(os.path.dirname(archive), "ctgov_v2.zip")
+    shutil.copy(FIXTURE_ROOT + "ctgov_v2.zip", v2_archive)
+    as_of = date(2020, 1, 1)
+    [xml] = convert_data.lookup(["NCT02413372"], archive, as_of).values()
+    [v2] = convert_data.lookup(["NCT02413372"], v2_archive, as_of).values()
+    assert v2["csv"] == xml["csv"]
+    assert json.loads(v2["json"])["protocolSection"]
+    assert json.loads(v2["v2_record"]) == json.loads(v2["json"])
+
+
+def test_reads_members_in_other_compressions(tmp_path):
+    archive = str(tmp_path / "AllPublicXML.zip")
+    with zipfile.ZipFile(FIXTURE_ROOT + "data.zip") as source:
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_BZIP2) as target:
+            for name in source.namelist():
+                target.writestr(name, source.read(name))
+        expected = source.read("NCTxxx/NCT02413372.xml")
+    with ArchiveIndex(archive) as index:
+        assert index.read("NCT02413372") == expected
+
+
+def test_keeps_index_in_another_directory(tmp_path):
+    fixture = FIXTURE_ROOT + "data.zip"
+    index_dir = str(tmp_path / "indexes")
+    with ArchiveIndex(fixture, index_dir) as index:
+        assert "NCT02413372" in index
+    assert os.path.exists(index_path(fixture, index_dir))
+    assert not os.path.exists(index_path(fixture))
+
+
+def test_lookup_takes_ids_before_or_after_options(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fixture = os.path.abspath(FIXTURE_ROOT + "data.zip")
+    for order in (
+        ["NCT02413372", "--archive", fixture],
+        ["--archive", fixture, "NCT02413372"],
+    ):
+        output = subprocess.check_output(
+            [sys.executable, "convert_data.py", "lookup"]
+            + order
+            + ["--index-dir", str(tmp_path), "--as-of", "2020-01-01"],
+            cwd=root,
+        )
+        assert json.loads(output)["nct_id"] == "NCT02413372"
+    assert not os.path.exists(index_path(fixture))
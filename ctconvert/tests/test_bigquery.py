@@ -0,0 +1,121 @@
+"""Tests for bigquery.py"""
+
+from datetime import date
+from unittest.mock import patch
+
+import pytest
+
+import bigquery
+
+PREFIX = "clinicaltrials/raw_json/"
+
+
+def test_external_table_requires_a_date_filter():
+    resource = bigquery.external_table_resource(
+        "proj", "raw_json", PREFIX, bigquery.NEWLINE_DELIMITED_JSON
+    )
+    config = resource["externalDataConfiguration"]
+    assert config["sourceUris"] == ["gs://proj/clinicaltrials/raw_json/*"]
+    assert config["hivePartitioningOptions"] == {
+        "mode": "CUSTOM",
+        "sourceUriPrefix": "gs://proj/clinicaltrials/raw_json/{snapshot_date:DATE}",
+        "requirePartitionFilter": True,
+    }
+    assert config["autodetect"]
+
+
+def test_parquet_tables_take_the_files_schema():
+    schema = [{"name": "nct_id", "type": "STRING"}]
+    resource = bigquery.external_table_resource(
+        "proj", "raw", PREFIX, bigquery.PARQUET, schema
+    )
+    config = resource["externalDataConfiguration"]
+    assert "schema" not in config and "autodetect" not in config
+
+
+def test_partition_load_replaces_one_day():
+    schema = [{"name": "nct_id", "type": "STRING"}]
+    load = bigquery.partition_load_configuration(
+        "proj",
+        "clinicaltrials",
+        "raw_json",
+        PREFIX,
+        date(2020, 1, 2),
+        bigquery.NEWLINE_DELIMITED_JSON,
+        schema,
+    )["load"]
+    assert load["sourceUris"] == [
+        "gs://proj/clinicaltrials/raw_json/snapshot_date=2020-01-02/*"
+    ]
+    assert load["destinationTable"]["tableId"] == "raw_json$20200102"
+    assert load["timePartitioning"] == {"type": "DAY", "field": "snapshot_date"}
+    assert load["writeDisposition"] == "WRITE_TRUNCATE"
+    assert load["schema"] == {"fields": schema}
+
+
+def jobs_api(*states, errors=None):
+    """An `api_request` that accepts one job, whose state is then each of
+    `states` in turn
+
+    """
+    calls = []
+    polls = iter(states)
+
+    def api_request(method, path, data=None, query_params=None):
+        calls.append((method, path, data))
+        if method == "POST":
+            return {}
+        status = {"state": next(polls)}
+        if status["state"] == "DONE" and errors:
+            status.update(errorResult=errors[0], errors=errors)
+        return {"status": status}
+
+    return api_request, calls
+
+
+@patch("bigquery.time.sleep")
+@patch("bigquery.gcbq.Client")
+def test_run_job_waits_for_the_job(gcbq_client, sleep):
+    api_request, calls = jobs_api("PENDING", "RUNNING", "DONE")
+    gcbq_client.return_value._connection.api_request = api_request
+    client = bigquery.Client("clinicaltrials")
+    client.run_job({"query": {"query": "SELECT 1"}})
+    (method, path, job), *polls = calls
+    assert (method, path) == ("POST", "/projects/ebmdatalab/jobs")
+    assert job["configuration"] == {"query": {"query": "SELECT 1"}}
+    job_path = "/projects/ebmdatalab/jobs/" + job["jobReference"]["jobId"]
+    assert polls == [("GET", job_path, None)] * 3
+    assert sleep.call_count == 2
+
+
+@patch("bigquery.time.sleep")
+@patch("bigquery.gcbq.Client")
+def test_run_job_raises_the_jobs_errors(gcbq_client, sleep):
+    errors = [{"reason": "invalid", "message": "No such field"}]
+    api_request, _ = jobs_api("DONE", errors=errors)
+    gcbq_client.return_value._connection.api_request = api_request
+    client = bigquery.Client("clinicaltrials")
+    with pytest.raises(bigquery.JobError) as e:
+        client.run_job({"query": {"query": "SELECT 1"}})
+    assert e.value.args == (errors,)
+
+
+@patch("bigquery.gcbq.Client")
+def test_load_partition_runs_a_load_job(gcbq_client):
+    api_request, calls = jobs_api("DONE")
+    gcbq_client.return_value._connection.api_request = api_request
+    client = bigquery.Client("clinicaltrials")
+    client.load_partition("raw_json", PREFIX, date(2020, 1, 2))
+    load = calls[0][2]["configuration"]["load"]
+    assert (
+        load
+        == bigquery.partition_load_configuration(
+            "ebmdatalab",
+            "clinicaltrials",
+            "raw_json",
+            PREFIX,
+            date(2020, 1, 2),
+            bigquery.NEWLINE_DELIMITED_JSON,
+        )["load"]
+    )
+    client.dataset.table.assert_called_with("raw_json")
@@ -0,0 +1,131 @@
+"""Tests for bigquery_schema.py"""
+
+import json
+
+import bigquery_schema
+from bigquery_schema import (
+    BOOLEAN,
+    FLOAT,
+    INTEGER,
+    NULLABLE,
+    RECORD,
+    REPEATED,
+    STRING,
+    SchemaBuilder,
+)
+
+SCALAR_TYPES = {STRING: str, BOOLEAN: bool, INTEGER: int, FLOAT: (int, float)}
+
+
+def fits(value, field):
+    """Whether `value` can be loaded into a field of the BigQuery
+    schema `field`
+
+    """
+    if value is None:
+        return True
+    if field["mode"] == REPEATED:
+        return (
+            isinstance(value, list)
+            and None not in value
+            and all(fits(v, dict(field, mode=NULLABLE)) for v in value)
+        )
+    if field["type"] == RECORD:
+        return isinstance(value, dict) and fits_schema(value, field["fields"])
+    return isinstance(value, SCALAR_TYPES[field["type"]])
+
+
+def fits_schema(record, schema):
+    fields = {field["name"]: field for field in schema}
+    return all(k in fields and fits(v, fields[k]) for k, v in record.items())
+
+
+def test_builder_widens_and_conforms():
+    builder = SchemaBuilder()
+    first = builder.add({"condition": "Asthma", "start_date": "May 2015"})
+    assert first == {"condition": "Asthma", "start_date": "May 2015"}
+    second = builder.add(
+        {
+            "condition": ["Asthma", None, "COPD"],
+            "start_date": {"type": "Actual", "text": "June 2016"},
+            "location": None,
+        }
+    )
+    assert second == {
+        "condition": ["Asthma", "COPD"],
+        "start_date": {"type": "Actual", "text": "June 2016"},
+        "location": None,
+    }
+    # Later trials are written in the widened shape
+    assert builder.add(first) == {
+        "condition": ["Asthma"],
+        "start_date": {"text": "May 2015"},
+    }
+    schema = bigquery_schema.to_bigquery(builder.fields)
+    assert schema == [
+        {"name": "condition", "type": STRING, "mode": REPEATED},
+        {
+            "name": "start_date",
+            "type": RECORD,
+            "mode": NULLABLE,
+            "fields": [
+                {"name": "type", "type": STRING, "mode": NULLABLE},
+                {"name": "text", "type": STRING, "mode": NULLABLE},
+            ],
+        },
+        {"name": "location", "type": STRING, "mode": NULLABLE},
+    ]
+    assert not fits_schema(first, schema)
+    # But the first trial was written before the schema widened
+    fields, written = bigquery_schema.merge_reports(None, [builder.report()])
+    assert not bigquery_schema.conforms(fields, written)
+
+
+def test_seeded_builders_conform_without_rewriting():
+    builder = SchemaBuilder()
+    builder.add({"a": [{"b": "x"}, {"b": "y"}]})
+    seed = bigquery_schema.to_bigquery(builder.fields)
+    workers = [SchemaBuilder(seed), SchemaBuilder(seed)]
+    assert workers[0].add({"a": {"b": "z"}}) == {"a": [{"b": "z"}]}
+    assert workers[1].add({"a": "text", "c": "new"}) == {
+        "a": [{"text": "text"}],
+        "c": "new",
+    }
+    fields, written = bigquery_schema.merge_reports(seed, [w.report() for w in workers])
+    assert bigquery_schema.conforms(fields, written)
+    assert [f["name"] for f in bigquery_schema.to_bigquery(fields)] == ["a", "c"]
+
+
+def test_mixed_scalars_widen():
+    builder = SchemaBuilder()
+    builder.add({"n": 1, "flag": True, "x": 2})
+    assert builder.add({"n": 1.5, "flag": "yes", "x": {"unit": "mg"}}) == {
+        "n": 1.5,
+        "flag": "yes",
+        "x": {"unit": "mg"},
+    }
+    assert builder.add({"n": 1, "flag": True, "x": 2}) == {
+        "n": 1,
+        "flag": "true",
+        "x": {"text": 2},
+    }
+    types = {name: field["type"] for name, field in builder.fields.items()}
+    assert types == {"n": FLOAT, "flag": STRING, "x": RECORD}
+
+
+def test_conform_file_rewrites_lines_to_fit(tmp_path):
+    records = [{"a": "x"}, {"a": ["y", "z"]}, {"a": {"b": "w"}}]
+    path = str(tmp_path / "raw.json")
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    fields = bigquery_schema.conform_file(path, {})
+    schema = bigquery_schema.to_bigquery(fields)
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == [
+        {"a": [{"text": "x"}]},
+        {"a": [{"text": "y"}, {"text": "z"}]},
+        {"a": [{"b": "w"}]},
+    ]
+    assert all(fits_schema(line, schema) for line in lines)
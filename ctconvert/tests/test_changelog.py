@@ -0,0 +1,93 @@
+"""Tests for changelog.py"""
+
+import json
+import os
+
+import changelog
+
+FIXTURE_ROOT = "ctconvert/tests/fixtures/"
+
+
+def test_first_run_records_everything_as_added(tmp_path):
+    tmpdir = str(tmp_path)
+    index_path = os.path.join(tmpdir, "index.csv")
+    changelog_path = os.path.join(tmpdir, "changes.json")
+    counts = changelog.write_changelog(
+        FIXTURE_ROOT + "expected_trials_json.json",
+        os.path.join(tmpdir, "missing.csv"),
+        changelog_path,
+        index_path,
+    )
+    assert counts == {"added": 5, "modified": 0, "removed": 0}
+    assert len(changelog.read_hash_index(index_path)) == 5
+
+
+def test_records_only_changes_since_previous_run(tmp_path):
+    tmpdir = str(tmp_path)
+    previous_index_path = os.path.join(tmpdir, "previous.csv")
+    changelog.write_changelog(
+        FIXTURE_ROOT + "expected_trials_json.json",
+        None,
+        os.path.join(tmpdir, "first.json"),
+        previous_index_path,
+    )
+
+    with open(FIXTURE_ROOT + "expected_trials_json.json") as f:
+        records = [json.loads(line) for line in f]
+    removed = records.pop()
+    records[0]["clinical_study"]["brief_title"] = "A new title"
+    today_path = os.path.join(tmpdir, "today.json")
+    with open(today_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    changelog_path = os.path.join(tmpdir, "changes.json")
+    counts = changelog.write_changelog(
+        today_path,
+        previous_index_path,
+        changelog_path,
+        os.path.join(tmpdir, "index.csv"),
+    )
+    assert counts == {"added": 0, "modified": 1, "removed": 1}
+    with open(changelog_path) as f:
+        changes = [json.loads(line) for line in f]
+    assert changes[0]["change"] == "modified"
+    assert changes[0]["record"] == records[0]
+    assert changes[1] == {
+        "nct_id": changelog.nct_id_of(removed),
+        "change": "removed",
+        "record": None,
+    }
+
+
+def test_reads_nct_ids_of_v2_records():
+    v2 = {"protocolSection": {"identificationModule": {"nctId": "NCT02413372"}}}
+    legacy = {"clinical_study": {"id_info": {"nct_id": "NCT02413372"}}}
+    assert changelog.nct_id_of(v2) == changelog.nct_id_of(legacy) == "NCT02413372"
+
+
+def test_ignores_fields_that_change_with_every_dump(tmp_path):
+    with open(FIXTURE_ROOT + "expected_trials_json.json") as f:
+        records = [json.loads(line) for line in f]
+    paths = []
+    for day in ["March 12, 2018", "March 13, 2018"]:
+        path = str(tmp_path / "{}.json".format(len(paths)))
+        with open(path, "w") as f:
+            for record in records:
+                header = record["clinical_study"]["required_header"]
+                header["download_date"] = (
+                    "ClinicalTrials.gov processed this data on " + day
+                )
+                f.write(json.dumps(record) + "\n")
+        paths.append(path)
+
+    previous_index_path = str(tmp_path / "previous.csv")
+    changelog.write_changelog(
+        paths[0], None, str(tmp_path / "first.json"), previous_index_path
+    )
+    changelog_path = str(tmp_path / "changes.json")
+    counts = changelog.write_changelog(
+        paths[1], previous_index_path, changelog_path, str(tmp_path / "index.csv")
+    )
+    assert counts == {"added": 0, "modified": 0, "removed": 0}
+    assert os.path.getsize(changelog_path) == 0
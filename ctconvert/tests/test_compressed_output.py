@@ -0,0 +1,38 @@
+import gzip
+import os
+import tempfile
+
+import pytest
+
+from compressed_output import CompressedWriter, compressed_path, open_input
+
+LINES = ["line {}\n".format(i) for i in range(10000)]
+MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_chunks_are_concatenated_in_order(compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = compressed_path(os.path.join(tmpdir, "out"), compression)
+        with CompressedWriter(path, compression, threads=4, chunk_size=1000) as f:
+            for line in LINES:
+                f.write(line)
+        with open(path, "rb") as f:
+            data = f.read()
+        # Many independent members, which read back as one stream
+        assert data.startswith(MAGIC[compression])
+        assert data.count(MAGIC[compression]) > 1
+        with open_input(path) as f:
+            assert f.read() == "".join(LINES)
+
+
+def test_gzip_output_is_readable_by_gzip_module():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "out.gz")
+        with CompressedWriter(path, "gzip", chunk_size=100) as f:
+            for line in LINES:
+                f.write(line)
+        with gzip.open(path, "rt") as f:
+            assert f.read() == "".join(LINES)
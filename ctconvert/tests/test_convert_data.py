@@ -1,15 +1,24 @@
 """Integration test for load_data.py script"""
 
 import csv
+import gzip
 import os
+import pickle
 import json
+import multiprocessing
 import shutil
+import signal
 import tempfile
+import time
+import zipfile
+import checkpoint
 import convert_data
+import sampling
 from unittest.mock import patch
 import pathlib
+from datetime import date
 from freezegun import freeze_time
-
+import pytest
 
 CMD_ROOT = "convert_data"
 TMPDIR = tempfile.mkdtemp()
@@ -21,6 +30,31 @@ def wget_copy_fixture(data_file, url):
     shutil.copy(test_zip, data_file)
 
 
+CONVERT_ONE_FILE_TO_CSV = convert_data.convert_one_file_to_csv
+
+
+def convert_stuck_on_fourth_trial(name, data, **kwargs):
+    if name.endswith("NCT01275365.xml"):
+        time.sleep(60)
+    return CONVERT_ONE_FILE_TO_CSV(name, data, **kwargs)
+
+
+def convert_csv_until_killed(checkpoint_dir, compression=None):
+    # In a process group of its own, so the test can kill it and its pool
+    os.setpgid(0, 0)
+    convert_data.TMPDIR = TMPDIR
+    convert_data.BATCH_SIZE = 1
+    convert_data.convert_one_file_to_csv = convert_stuck_on_fourth_trial
+    checkpoint.SEGMENT_SIZE = 2
+    convert_data.convert_to_csv(
+        store_facts=True,
+        as_of=date(2020, 1, 1),
+        processes=2,
+        compression=compression,
+        checkpoint_dir=checkpoint_dir,
+    )
+
+
 def teardown_module(module):
     shutil.rmtree(TMPDIR)
 
@@ -54,3 +88,470 @@ def test_produces_csv_and_json(self, mock_wget):
         [str(json.loads(x)) for x in open(expected_json).readlines()]
     )
     assert output_ldjson == expected_ldjson
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@freeze_time("2020-01-01")
+def test_compressed_outputs_match_uncompressed(self):
+    csv_path = convert_data.main(local_only=True, compression="gzip")
+    assert csv_path == convert_data.generated_csv_path() + ".gz"
+
+    expected_csv = FIXTURE_ROOT + "expected_trials_data.csv"
+    with gzip.open(csv_path, "rt", newline="") as output_file:
+        with open(expected_csv) as expected_file:
+            results = sorted(list(csv.reader(output_file)))
+            expected = sorted(list(csv.reader(expected_file)))
+            assert results == expected
+
+    expected_json = FIXTURE_ROOT + "expected_trials_json.json"
+    with gzip.open(convert_data.raw_json_path() + ".gz", "rt") as output_file:
+        output_ldjson = sorted(str(json.loads(x)) for x in output_file)
+    expected_ldjson = sorted(str(json.loads(x)) for x in open(expected_json))
+    assert output_ldjson == expected_ldjson
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@freeze_time("2020-01-01")
+def test_derives_csv_from_stored_facts(self):
+    convert_data.main(local_only=True, store_facts=True)
+    facts_path = os.path.join(TMPDIR, "stored_facts.json")
+    shutil.move(convert_data.trial_facts_path(), facts_path)
+    os.remove(convert_data.generated_csv_path())
+
+    convert_data.derive_csv(facts_path)
+    expected_csv = FIXTURE_ROOT + "expected_trials_data.csv"
+    with open(convert_data.generated_csv_path()) as output_file:
+        with open(expected_csv) as expected_file:
+            results = sorted(list(csv.reader(output_file)))
+            expected = sorted(list(csv.reader(expected_file)))
+            assert results == expected
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@patch(CMD_ROOT + ".GCSStorage")
+@freeze_time("2020-01-01")
+def test_cloud_run_connects_to_storage_once(storage, wget):
+    storage.return_value.updated.return_value = None
+    convert_data.main(store_facts=True, with_changelog=True)
+    assert storage.call_count == 1
+    uploaded = [c[0][1] for c in storage.return_value.upload.call_args_list]
+    assert convert_data.ARCHIVE_NAME in uploaded
+    assert uploaded[-1] == convert_data.STORAGE_PREFIX + convert_data.HASH_INDEX_NAME
+
+
+def test_hash_index_is_stored_after_everything_else(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+
+    def run():
+        tmpdir = tmp_path / "run{}".format(len(os.listdir(tmp_path)))
+        tmpdir.mkdir()
+        with patch("convert_data.TMPDIR", str(tmpdir)):
+            convert_data.main(
+                local_only=True,
+                cache_dir=cache_dir,
+                with_changelog=True,
+                archive=FIXTURE_ROOT + "data.zip",
+            )
+
+    index_path = os.path.join(cache_dir, convert_data.HASH_INDEX_NAME)
+    with patch(CMD_ROOT + ".convert_to_csv", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            run()
+    # The next run still compares against the last successful one
+    assert not os.path.exists(index_path)
+    run()
+    assert os.path.exists(index_path)
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@freeze_time("2020-01-01")
+def test_aggregates_count_csv_rows(self):
+    with open(FIXTURE_ROOT + "expected_trials_data.csv") as f:
+        expected = list(csv.DictReader(f))
+
+    def aggregates():
+        with open(convert_data.aggregates_path()) as f:
+            return {(row["dimension"], row["value"]): row for row in csv.DictReader(f)}
+
+    # Counted in worker processes
+    convert_data.main(local_only=True, store_facts=True)
+    counted = aggregates()
+    for sponsor_type in {trial["sponsor_type"] for trial in expected}:
+        trials = [trial for trial in expected if trial["sponsor_type"] == sponsor_type]
+        row = counted[("sponsor_type", sponsor_type)]
+        assert int(row["trials"]) == len(trials)
+        assert int(row["act_flag"]) == sum(int(t["act_flag"]) for t in trials)
+        assert int(row["results_due"]) == sum(int(t["results_due"]) for t in trials)
+    assert sum(
+        int(row["trials"])
+        for (dimension, _), row in counted.items()
+        if dimension == "sponsor"
+    ) == len(expected)
+
+    convert_data.derive_csv(convert_data.trial_facts_path())
+    assert aggregates() == counted
+    csv_aggregates = convert_data.aggregate_csv(convert_data.generated_csv_path())
+    convert_data.write_aggregates([csv_aggregates])
+    assert aggregates() == counted
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@freeze_time("2020-01-01")
+def test_sample_extrapolates_counts(self):
+    with open(FIXTURE_ROOT + "expected_trials_data.csv") as f:
+        expected = list(csv.DictReader(f))
+
+    def estimates():
+        with open(convert_data.sample_estimates_path()) as f:
+            return {row["count"]: row for row in csv.DictReader(f)}
+
+    # The whole archive is sampled exactly
+    convert_data.main(local_only=True, sample=1)
+    for name, row in estimates().items():
+        count = sum(int(trial[name]) for trial in expected)
+        assert row["estimate"] == row["low"] == row["high"] == str(count)
+
+    convert_data.main(local_only=True, sample=0.5)
+    with open(convert_data.generated_csv_path()) as f:
+        rows = list(csv.DictReader(f))
+    in_sample = [
+        trial for trial in expected if sampling.in_sample(trial["nct_id"] + ".xml", 0.5)
+    ]
+    assert 0 < len(rows) < len(expected)
+    assert sorted(rows, key=str) == sorted(in_sample, key=str)
+    for name, row in estimates().items():
+        assert int(row["low"]) <= int(row["estimate"]) <= int(row["high"])
+        assert int(row["in_sample"]) == sum(int(trial[name]) for trial in rows)
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@freeze_time("2020-01-01")
+def test_terms_unpack_csv_columns(self):
+    convert_data.main(local_only=True, store_facts=True)
+    with open(convert_data.generated_csv_path()) as f:
+        rows = list(csv.DictReader(f))
+    with open(convert_data.terms_path()) as f:
+        terms = f.read()
+    lines = list(csv.reader(terms.splitlines()))
+    assert lines[0] == convert_data.TERM_HEADERS
+    assert lines[1:] == [
+        list(term) for row in rows for term in convert_data.row_terms(row)
+    ]
+    assert ["NCT02413372", "Fatty Liver", "condition_mesh"] in lines
+    # An intervention in two arms is listed once
+    assert lines.count(["NCT02413372", "BMS-986036", "intervention"]) == 1
+
+    convert_data.derive_csv(convert_data.trial_facts_path())
+    with open(convert_data.terms_path()) as f:
+        assert f.read() == terms
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+def test_as_of_series_matches_single_dates(self):
+    convert_data.main(local_only=True, store_facts=True, as_of=date(2020, 1, 1))
+    facts_path = convert_data.trial_facts_path()
+
+    counts_path, _ = convert_data.as_of_series(
+        facts_path, date(2018, 2, 16), date(2020, 2, 20)
+    )
+    with open(counts_path) as f:
+        counts = {row["as_of"]: int(row["results_due"]) for row in csv.DictReader(f)}
+    assert counts["2018-02-17"] == 0
+    assert counts["2018-02-18"] == 2
+    assert counts["2020-02-18"] == 5
+
+    for as_of in ["2018-02-17", "2018-02-18", "2018-02-19", "2020-02-18"]:
+        convert_data.derive_csv(facts_path, as_of=convert_data.parse_iso_date(as_of))
+        with open(convert_data.generated_csv_path()) as f:
+            due = sum(int(row["results_due"]) for row in csv.DictReader(f))
+        assert due == counts[as_of]
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+def test_backfill_parses_each_distinct_trial_once():
+    snapshots = []
+    with zipfile.ZipFile(FIXTURE_ROOT + "data.zip") as source:
+        for as_of, status in (
+            ("2018-02-17", b"Completed"),
+            ("2020-02-18", b"Withdrawn"),
+        ):
+            path = os.path.join(TMPDIR, "AllPublicXML_{}.zip".format(as_of))
+            with zipfile.ZipFile(path, "w") as snapshot:
+                for info in source.infolist():
+                    data = source.read(info)
+                    if info.filename.endswith("NCT02413372.xml"):
+                        data = data.replace(b"Completed", status)
+                    snapshot.writestr(
+                        zipfile.ZipInfo(info.filename, info.date_time), data
+                    )
+            snapshots.append(path)
+
+    with patch(
+        CMD_ROOT + ".parse_document", wraps=convert_data.parse_document
+    ) as parse:
+        paths = convert_data.backfill(snapshots, processes=1)
+    assert parse.call_count == 6
+    assert not os.path.exists(convert_data.backfill_facts_path())
+    assert sorted(paths) == [date(2018, 2, 17), date(2020, 2, 18)]
+    for as_of, path in paths.items():
+        with open(path) as f:
+            rows = list(csv.reader(f))[1:]
+        archive = os.path.join(TMPDIR, "AllPublicXML_{}.zip".format(as_of))
+        expected = [
+            next(csv.reader([convert_data.csv_line(row)]))
+            for row in convert_data.iter_rows(archive, processes=1, as_of=as_of)
+        ]
+        assert rows == expected
+    with open(paths[date(2020, 2, 18)]) as f:
+        assert "NCT02413372" not in f.read()
+    with open(paths[date(2018, 2, 17)]) as f:
+        assert "NCT02413372" in f.read()
+
+
+def test_iter_rows_streams_from_file_object():
+    expected_csv = FIXTURE_ROOT + "expected_trials_data.csv"
+    with open(expected_csv) as expected_file:
+        expected = sorted(list(csv.reader(expected_file))[1:])
+
+    for processes in (1, 2):
+        with open(FIXTURE_ROOT + "data.zip", "rb") as source:
+            rows = convert_data.iter_rows(
+                source, processes=processes, as_of=date(2020, 1, 1)
+            )
+            results = sorted(
+                next(csv.reader([convert_data.csv_line(row)])) for row in rows
+            )
+        assert results == expected
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+@freeze_time("2020-01-01")
+def test_memory_limited_workers_produce_same_csv(self):
+    limits = convert_data.Limits(max_tasks=1, large_member_size=10000)
+    convert_data.main(local_only=True, limits=limits)
+
+    expected_csv = FIXTURE_ROOT + "expected_trials_data.csv"
+    with open(convert_data.generated_csv_path()) as output_file:
+        with open(expected_csv) as expected_file:
+            results = sorted(list(csv.reader(output_file)))
+            expected = sorted(list(csv.reader(expected_file)))
+            assert results == expected
+
+    with open(convert_data.worker_memory_path()) as f:
+        report = json.load(f)
+    assert sum(worker["batches"] for worker in report) > 0
+    with open(convert_data.rule_stats_path()) as f:
+        assert json.load(f)["records"] == 5
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch("convert_data.SCHEDULE_WINDOW", 3)
+@patch("convert_data.BATCH_SIZE", 1)
+def test_largest_first_schedule_keeps_archive_order():
+    def rows(schedule):
+        return [
+            convert_data.csv_line(row)
+            for row in convert_data.iter_rows(
+                FIXTURE_ROOT + "data.zip",
+                processes=2,
+                as_of=date(2020, 1, 1),
+                schedule=schedule,
+            )
+        ]
+
+    assert rows(convert_data.LARGEST_FIRST) == rows(convert_data.ARCHIVE_ORDER)
+    with open(convert_data.pool_utilization_path()) as f:
+        assert next(csv.reader(f)) == ["seconds", "busy_workers"]
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch("convert_data.SCHEDULE_WINDOW", 3)
+@patch("convert_data.BATCH_SIZE", 2)
+def test_largest_first_schedule_with_large_members():
+    def rows(schedule, limits=None):
+        return [
+            row.nct_id
+            for row in convert_data.iter_rows(
+                FIXTURE_ROOT + "data.zip",
+                processes=2,
+                as_of=date(2020, 1, 1),
+                schedule=schedule,
+                limits=limits,
+            )
+        ]
+
+    # Most of the fixtures are large, so batches are split up
+    limits = convert_data.Limits(large_member_size=10000)
+    assert rows(convert_data.LARGEST_FIRST, limits) == rows(convert_data.ARCHIVE_ORDER)
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch("convert_data.BATCH_SIZE", 1)
+@patch("convert_data.ELIGIBILITY.reorder_every", 2)
+def test_executors_produce_same_rows():
+    def rows(executor):
+        return [
+            convert_data.csv_line(row)
+            for row in convert_data.iter_rows(
+                FIXTURE_ROOT + "data.zip",
+                processes=2,
+                as_of=date(2020, 1, 1),
+                included_only=False,
+                executor=executor,
+            )
+        ]
+
+    expected = rows(convert_data.PROCESS)
+    assert len(expected) == 5
+    for executor in ["thread", "serial"]:
+        assert rows(executor) == expected
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch(CMD_ROOT + ".wget_file", side_effect=wget_copy_fixture)
+def test_profile_reports_slowest_trials(self):
+    options = convert_data.profiler.Options(top_k=2, capture=True)
+    convert_data.main(local_only=True, as_of=date(2020, 1, 1), profile=options)
+
+    for stage, phases in [
+        ("json", {"parse", "serialize"}),
+        ("csv", {"parse", "evaluate"}),
+    ]:
+        with open(convert_data.profile_path(stage)) as f:
+            report = json.load(f)
+        assert report["documents"] == 5
+        assert len(report["slowest"]) == 2
+        assert set(report["slowest"][0]["phases"]) == phases
+        assert report["hot_functions"]
+
+    # Trials converted again to capture their functions are counted once
+    with open(convert_data.rule_stats_path()) as f:
+        assert json.load(f)["records"] == 5
+    with open(FIXTURE_ROOT + "expected_trials_data.csv") as f:
+        included = len(list(csv.DictReader(f)))
+    with open(convert_data.aggregates_path()) as f:
+        rows = [row for row in csv.DictReader(f) if row["dimension"] == "sponsor_type"]
+    assert sum(int(row["trials"]) for row in rows) == included
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+@patch("checkpoint.SEGMENT_SIZE", 2)
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_resumed_run_matches_uninterrupted_run(compression):
+    wget_copy_fixture(convert_data.zip_archive(), None)
+    checkpoint_dir = os.path.join(TMPDIR, "checkpoints")
+    csv_path = convert_data.compressed_path(
+        convert_data.generated_csv_path(), compression
+    )
+
+    def outputs():
+        # Compressed outputs are split into gzip members or zstd frames
+        # differently, so only what they decompress to is the same
+        contents = []
+        for path in (
+            csv_path,
+            convert_data.trial_facts_path(),
+            convert_data.aggregates_path(),
+        ):
+            with convert_data.open_input(path) as f:
+                contents.append(f.read())
+        return contents
+
+    convert_data.convert_to_csv(
+        store_facts=True, as_of=date(2020, 1, 1), compression=compression
+    )
+    expected = outputs()
+    os.remove(csv_path)
+
+    run = multiprocessing.Process(
+        target=convert_csv_until_killed, args=(checkpoint_dir, compression)
+    )
+    run.start()
+    manifest = os.path.join(checkpoint_dir, "csv", checkpoint.MANIFEST_NAME)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                if json.load(f)["segments"] == 1:
+                    break
+        time.sleep(0.05)
+    os.killpg(run.pid, signal.SIGKILL)
+    run.join()
+    assert not os.path.exists(csv_path)
+
+    converted = []
+
+    def convert_and_record(name, data, **kwargs):
+        converted.append(name)
+        return CONVERT_ONE_FILE_TO_CSV(name, data, **kwargs)
+
+    with patch("convert_data.convert_one_file_to_csv", convert_and_record):
+        convert_data.convert_to_csv(
+            store_facts=True,
+            as_of=date(2020, 1, 1),
+            processes=1,
+            compression=compression,
+            checkpoint_dir=checkpoint_dir,
+        )
+    # The first segment of two trials was not converted again
+    assert len(converted) == 3
+    assert outputs() == expected
+
+
+def test_iter_trials_yields_parsed_trials():
+    trials = dict(convert_data.iter_trials(FIXTURE_ROOT + "data.zip", processes=1))
+    assert len(trials) == 5
+    trial = trials["NCTxxx/NCT02413372.xml"]
+    assert trial["clinical_study"]["id_info"]["nct_id"] == "NCT02413372"
+
+
+@patch("convert_data.TMPDIR", TMPDIR)
+def test_json_fits_inferred_schema():
+    from tests.test_bigquery_schema import fits_schema
+
+    wget_copy_fixture(convert_data.zip_archive(), None)
+
+    def convert(seed=None):
+        convert_data.convert_to_json(processes=2, infer_schema=True, schema_seed=seed)
+        with open(convert_data.raw_json_schema_path()) as f:
+            schema = json.load(f)
+        with open(convert_data.raw_json_path()) as f:
+            return schema, [json.loads(line) for line in f]
+
+    schema, trials = convert()
+    assert len(trials) == 5
+    assert all(fits_schema(trial, schema) for trial in trials)
+    # Started from that schema, the JSON fits as it is written
+    with patch("bigquery_schema.conform_file") as conform_file:
+        assert convert(schema) == (schema, trials)
+    conform_file.assert_not_called()
+
+
+def test_trial_records_survive_pickling():
+    convert_data.set_fda_reg_dict()
+    with zipfile.ZipFile(FIXTURE_ROOT + "data.zip") as archive:
+        rows = [
+            convert_data.derive_row(
+                convert_data.parse_trial(archive.read(name)),
+                convert_data.AsOf(date(2020, 1, 1)),
+            )
+            for name in archive.namelist()
+            if name.endswith(".xml")
+        ]
+    # A title that can't be derived from the others is kept
+    rows[0]["title"] = "Another title"
+    for row in rows:
+        record = convert_data.TrialRecord.from_row(row)
+        copy = pickle.loads(pickle.dumps(record))
+        assert copy.as_dict() == convert_data.convert_bools_to_ints(dict(row))
+        assert copy["nct_id"] == copy.nct_id == row["nct_id"]
+        assert convert_data.csv_line(copy) == convert_data.csv_line(row)
+        assert len(pickle.dumps(record)) < len(pickle.dumps(row))
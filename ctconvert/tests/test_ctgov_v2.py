@@ -0,0 +1,63 @@
+"""Tests for ctgov_v2.py"""
+
+import zipfile
+from datetime import date
+
+import convert_data
+import ctgov_v2
+
+FIXTURE_ROOT = "ctconvert/tests/fixtures/"
+
+
+def members(path, suffix):
+    with zipfile.ZipFile(path) as archive:
+        return {
+            name.rsplit("/", 1)[-1][: -len(suffix)]: archive.read(name)
+            for name in archive.namelist()
+            if name.endswith(suffix)
+        }
+
+
+def test_v2_records_have_the_facts_of_their_xml():
+    xml = members(FIXTURE_ROOT + "data.zip", ".xml")
+    v2 = members(FIXTURE_ROOT + "ctgov_v2.zip", ".json")
+    assert set(xml) == set(v2)
+    as_of = convert_data.AsOf(date(2018, 6, 1))
+    convert_data.set_fda_reg_dict()
+    for nct_id in xml:
+        expected = convert_data.parse_trial(xml[nct_id])
+        facts = convert_data.parse_document(nct_id + ".json", v2[nct_id])
+        assert facts == expected, nct_id
+        assert convert_data.csv_line(
+            convert_data.derive_row(facts, as_of)
+        ) == convert_data.csv_line(convert_data.derive_row(expected, as_of))
+
+
+def test_v2_values_read_as_in_the_xml():
+    assert ctgov_v2.parse_date("2018-03-01") == (date(2018, 3, 1), False)
+    assert ctgov_v2.parse_date("2018-02") == (date(2018, 2, 28), True)
+    assert ctgov_v2.parse_date(None) == (None, False)
+    assert ctgov_v2.legacy_date("2018-03-01") == "March 1, 2018"
+    assert ctgov_v2.legacy_date("2018-03") == "March 2018"
+    assert ctgov_v2.enum_text("DIETARY_SUPPLEMENT") == "Dietary Supplement"
+    assert ctgov_v2.one_or_list([]) is None
+    assert ctgov_v2.one_or_list(["a"]) == "a"
+    assert ctgov_v2.one_or_list(["a", "b"]) == ["a", "b"]
+
+
+def test_iter_rows_reads_the_v2_export():
+    def rows(name):
+        return [
+            convert_data.csv_line(row)
+            for row in convert_data.iter_rows(
+                FIXTURE_ROOT + name, processes=1, as_of=date(2018, 6, 1)
+            )
+        ]
+
+    assert rows("ctgov_v2.zip") == rows("data.zip")
+    [(name, trial)] = [
+        item
+        for item in convert_data.iter_trials(FIXTURE_ROOT + "ctgov_v2.zip", processes=1)
+        if item[0].endswith("NCT02413372.json")
+    ]
+    assert trial["protocolSection"]["identificationModule"]["nctId"] == "NCT02413372"
@@ -0,0 +1,35 @@
+"""Tests for executors.py"""
+
+import os
+
+import pytest
+
+import executors
+
+
+def square_all(batch):
+    return [(x * x, os.getpid()) for x in batch]
+
+
+@pytest.mark.parametrize("executor", executors.EXECUTORS)
+def test_results_come_back_in_order(executor):
+    batches = [[i, i + 1] for i in range(0, 20, 2)]
+    outputs = list(executors.imap(executor, square_all, batches, 2, max_pending=3))
+    assert [x for output in outputs for x, _ in output] == [i * i for i in range(20)]
+    pids = {pid for output in outputs for _, pid in output}
+    if executor == executors.PROCESS:
+        assert os.getpid() not in pids
+    else:
+        assert pids == {os.getpid()}
+
+
+def test_only_worker_processes_run_the_initializer():
+    calls = []
+    list(executors.imap(executors.THREAD, len, [[1]], 2, lambda: calls.append(1)))
+    list(executors.imap(executors.SERIAL, len, [[1]], 1, lambda: calls.append(1)))
+    assert calls == []
+
+
+def test_unknown_executor():
+    with pytest.raises(ValueError):
+        executors.imap("gpu", len, [], 1)
@@ -0,0 +1,85 @@
+"""Tests for log_pipeline.py"""
+
+import json
+import logging
+import multiprocessing
+import os
+
+import log_pipeline
+
+
+def make_record(level, msg="message"):
+    return logging.LogRecord("test", level, __file__, 1, msg, None, None)
+
+
+def test_sampler_keeps_an_even_fraction():
+    sampler = log_pipeline.Sampler({logging.DEBUG: 0.25})
+    kept = [sampler.filter(make_record(logging.DEBUG)) for _ in range(12)]
+    assert kept == [False, False, False, True] * 3
+    assert all(sampler.filter(make_record(logging.INFO)) for _ in range(5))
+    record = make_record(logging.DEBUG)
+    while not sampler.filter(record):
+        pass
+    assert record.sample_rate == 0.25
+
+
+def test_rate_limiter_reports_what_it_suppressed():
+    now = [0.0]
+    limiter = log_pipeline.RateLimiter(per_second=3, clock=lambda: now[0])
+    assert [limiter.filter(make_record(logging.INFO)) for _ in range(5)] == [
+        True,
+        True,
+        True,
+        False,
+        False,
+    ]
+    # Errors are never limited
+    assert limiter.filter(make_record(logging.ERROR))
+    now[0] = 1.0
+    record = make_record(logging.INFO)
+    assert limiter.filter(record)
+    assert record.suppressed == 2
+
+
+def test_times_always_have_microseconds():
+    record = make_record(logging.INFO)
+    record.created = 1577836800.0
+    entry = json.loads(log_pipeline.JSONFormatter().format(record))
+    assert entry["time"] == "2020-01-01T00:00:00.000000+00:00"
+
+
+def log_from_worker(n):
+    logging.getLogger("worker").info("trial %s", n)
+    logging.getLogger("worker").debug("hidden %s", n)
+    return os.getpid()
+
+
+def test_workers_log_through_the_listener(tmp_path):
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    path = str(tmp_path / "converter.log")
+    try:
+        log_pipeline.configure("INFO", path=path)
+        with multiprocessing.get_context("fork").Pool(2) as pool:
+            pids = set(pool.map(log_from_worker, range(4)))
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logging.getLogger("parent").exception("failed")
+        log_pipeline.shutdown()
+    finally:
+        root.handlers[:] = handlers
+        root.setLevel(level)
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    assert sorted(e["message"] for e in entries if e["logger"] == "worker") == [
+        "trial 0",
+        "trial 1",
+        "trial 2",
+        "trial 3",
+    ]
+    assert {e["process"] for e in entries if e["logger"] == "worker"} <= pids
+    [failure] = [e for e in entries if e["logger"] == "parent"]
+    assert failure["severity"] == "ERROR"
+    assert "ZeroDivisionError" in failure["message"]
+    assert failure["time"].endswith("+00:00")
@@ -0,0 +1,50 @@
+"""Tests for profiler.py"""
+
+import time
+
+import profiler
+
+
+def slow_worker(name, data):
+    time.sleep(len(data) / 1000)
+    profiler.mark("parse")
+    return name
+
+
+def profile_documents(options):
+    document_profiler = profiler.DocumentProfiler(options)
+    profiler.ACTIVE = document_profiler
+    try:
+        for name, size in [("a", 10), ("b", 50), ("c", 5), ("d", 30)]:
+            assert document_profiler.run(slow_worker, name, b"x" * size) == name
+    finally:
+        profiler.ACTIVE = None
+    return document_profiler
+
+
+def test_keeps_slowest_documents_with_phases():
+    report = profile_documents(profiler.Options(top_k=2)).report()
+    assert report["documents"] == 4
+    assert report["bytes"] == 10 + 50 + 5 + 30
+    assert [entry["name"] for entry in report["slowest"]] == ["b", "d"]
+    assert set(report["slowest"][0]["phases"]) == {"parse"}
+    assert "functions" not in report["slowest"][0]
+
+
+def test_captures_functions_of_slowest_documents():
+    options = profiler.Options(top_k=1, capture=True)
+    (entry,) = profile_documents(options).report()["slowest"]
+    assert entry["name"] == "b"
+    assert any("slow_worker" in function[0] for function in entry["functions"])
+
+
+def test_merges_worker_reports():
+    reports = [
+        profile_documents(profiler.Options(top_k=2, capture=True)).report()
+        for _ in range(2)
+    ]
+    merged = profiler.merge_reports(reports, top_k=3)
+    assert merged["documents"] == 8
+    assert len(merged["slowest"]) == 3
+    assert merged["slowest"][0]["name"] == "b"
+    assert any("sleep" in f["function"] for f in merged["hot_functions"])
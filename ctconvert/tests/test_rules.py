@@ -0,0 +1,97 @@
+"""Tests for rules.py"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from rules import Predicate, RulePlan, merge_stats
+
+
+def make_plan(calls, reorder_every=1000):
+    def predicate(name, func):
+        def counted(record):
+            calls.append(name)
+            return func(record)
+
+        return Predicate(name, counted, name)
+
+    return RulePlan(
+        [
+            predicate("positive", lambda n: n > 0),
+            predicate("even", lambda n: n % 2 == 0),
+            predicate("big", lambda n: n > 100),
+        ],
+        [("positive_even", ["positive", "even"]), ("big_even", ["even", "big"])],
+        reorder_every=reorder_every,
+    )
+
+
+def test_shared_predicates_are_evaluated_once():
+    calls = []
+    plan = make_plan(calls)
+    assert plan.evaluate(200) == {"positive_even": True, "big_even": True}
+    assert sorted(calls) == ["big", "even", "positive"]
+
+
+def test_known_failure_short_circuits_other_rules():
+    calls = []
+    plan = make_plan(calls)
+    assert plan.evaluate(3) == {"positive_even": False, "big_even": False}
+    assert calls == ["positive", "even"]
+
+
+def test_uncounted_evaluations_leave_stats_alone():
+    plan = make_plan([])
+    plan.evaluate(200)
+    with plan.uncounted():
+        assert plan.evaluate(200) == {"positive_even": True, "big_even": True}
+    assert plan.stats()["records"] == 1
+    assert plan.stats()["rules"]["big_even"] == {"hits": 1, "misses": 0}
+
+
+def test_reorders_by_selectivity_without_changing_results():
+    calls = []
+    plan = make_plan(calls, reorder_every=10)
+    results = [plan.evaluate(n) for n in range(1, 21)]
+    # "even" fails half the time; "positive" never does
+    assert plan.rules[0][1] == ["even", "positive"]
+    assert results == [
+        {"positive_even": n % 2 == 0, "big_even": False} for n in range(1, 21)
+    ]
+    assert plan.stats()["rules"]["positive_even"] == {"hits": 10, "misses": 10}
+
+
+def test_threads_share_a_plan():
+    plan = make_plan([], reorder_every=3)
+    numbers = list(range(-50, 250))
+    expected = [
+        {"positive_even": n > 0 and n % 2 == 0, "big_even": n > 100 and n % 2 == 0}
+        for n in numbers
+    ]
+    # Switch threads often, to interleave evaluations and reorderings
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            for _ in range(10):
+                assert list(executor.map(plan.evaluate, numbers)) == expected
+    finally:
+        sys.setswitchinterval(interval)
+    stats = plan.stats()
+    assert stats["records"] == 10 * len(numbers)
+    assert sum(stats["rules"]["big_even"].values()) == 10 * len(numbers)
+
+
+def test_merge_stats():
+    plan = make_plan([])
+    plan.evaluate(2)
+    stats = merge_stats([plan.stats(), plan.stats()])
+    assert stats["records"] == 2
+    assert stats["rules"]["positive_even"] == {"hits": 2, "misses": 0}
+    assert stats["predicates"]["big"] == {"evaluated": 2, "passed": 0}
+
+
+def test_rejects_unknown_predicates():
+    with pytest.raises(ValueError):
+        RulePlan([], [("rule", ["missing"])])
@@ -0,0 +1,48 @@
+"""Tests for sampling.py"""
+
+import random
+import zipfile
+
+import sampling
+
+FIXTURE_ROOT = "ctconvert/tests/fixtures/"
+
+
+def test_samples_are_deterministic_and_nested():
+    names = ["NCT{:08d}/NCT{:08d}.xml".format(i // 100, i) for i in range(20000)]
+    tenth = {n for n in names if sampling.in_sample(n, 0.1)}
+    assert 1800 < len(tenth) < 2200
+    # The same trial is chosen from any archive or format
+    v2_names = [n[:-4] + ".json" for n in names]
+    assert {n[:-5] for n in v2_names if sampling.in_sample(n, 0.1)} == {
+        n[:-4] for n in tenth
+    }
+    assert tenth <= {n for n in names if sampling.in_sample(n, 0.2)}
+    assert all(sampling.in_sample(n, 1) for n in names)
+
+
+def test_sample_archive_copies_sampled_members(tmp_path):
+    target = str(tmp_path / "sample.zip")
+    population, sampled = sampling.sample_archive(
+        FIXTURE_ROOT + "data.zip", target, 0.5, lambda name: name.endswith(".xml")
+    )
+    with zipfile.ZipFile(target) as sample:
+        names = sample.namelist()
+    assert population == 5
+    assert sampled == len(names)
+    assert names == [n for n in names if sampling.in_sample(n, 0.5)]
+
+
+def test_estimates_cover_the_population_count():
+    assert sampling.estimate(3, 10, 10) == (3, 3, 3)
+    assert sampling.estimate(0, 0, 10) == (None, 0, 10)
+    estimate, low, high = sampling.estimate(0, 100, 1000)
+    assert estimate == low == 0 and 0 < high < 100
+    rng = random.Random(1)
+    population = [i < 3000 for i in range(20000)]
+    covered = 0
+    for _ in range(200):
+        sample = rng.sample(population, 500)
+        estimate, low, high = sampling.estimate(sum(sample), 500, 20000)
+        covered += low <= 3000 <= high
+    assert covered >= 180
@@ -0,0 +1,37 @@
+"""Tests for scheduling.py"""
+
+from scheduling import Utilization, balanced_batches
+
+
+def test_balanced_batches_deal_largest_first():
+    sizes = [1, 100, 2, 3, 50, 4, 60, 5]
+    batches = balanced_batches(sizes, lambda size: size, 2)
+    assert len(batches) == 4
+    assert sorted(size for batch in batches for size in batch) == sorted(sizes)
+    # The largest items lead separate batches, the biggest batch first
+    assert [batch[0] for batch in batches] == [100, 60, 50, 5]
+    totals = [sum(batch) for batch in batches]
+    assert totals == sorted(totals, reverse=True)
+
+
+def test_balanced_batches_of_nothing():
+    assert balanced_batches([], len, 10) == []
+
+
+def test_utilization_reports_idle_tail():
+    utilization = Utilization(2)
+    utilization.add(0.0, 4.0)
+    utilization.add(0.0, 1.0)
+    utilization.add(1.0, 2.0)
+    summary = utilization.summary()
+    assert summary["seconds"] == 4.0
+    assert summary["utilization"] == 0.75
+    # Only one worker was busy from 2s to the end
+    assert summary["tail_seconds"] == 2.0
+    assert utilization.timeline() == [
+        (0.0, 2.0),
+        (1.0, 2.0),
+        (2.0, 1.0),
+        (3.0, 1.0),
+        (4.0, 0.0),
+    ]
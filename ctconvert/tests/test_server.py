@@ -0,0 +1,113 @@
+"""Tests for server.py"""
+
+import csv
+import json
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+import pytest
+
+import server
+
+FIXTURE_ROOT = "ctconvert/tests/fixtures/"
+
+
+@pytest.fixture
+def base_url(tmp_path):
+    httpd = server.make_server(
+        FIXTURE_ROOT + "data.zip", port=0, cache_size=2, index_dir=str(tmp_path)
+    )
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{}".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return response.read().decode("utf-8")
+
+
+def test_serves_single_and_batched_trials(base_url):
+    trial = json.loads(get(base_url + "/trials/NCT02413372.json"))
+    assert trial["clinical_study"]["id_info"]["nct_id"] == "NCT02413372"
+
+    rows = list(csv.DictReader(get(base_url + "/trials/NCT02413372.csv").splitlines()))
+    assert [row["nct_id"] for row in rows] == ["NCT02413372"]
+
+    batch = json.loads(get(base_url + "/trials.json?ids=NCT02413372,NCT99999999"))
+    assert batch["NCT99999999"] is None
+    assert batch["NCT02413372"] == trial
+
+    rows = list(
+        csv.DictReader(
+            get(base_url + "/trials.csv?ids=NCT01275365,NCT02251236").splitlines()
+        )
+    )
+    assert [row["nct_id"] for row in rows] == ["NCT01275365", "NCT02251236"]
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(base_url + "/trials/NCT99999999.json")
+    assert e.value.code == 404
+
+
+def test_reports_cache_hits(base_url):
+    for _ in range(3):
+        get(base_url + "/trials/NCT02413372.json")
+    stats = json.loads(get(base_url + "/stats"))
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["requests"] == 3
+    assert stats["latency_p50_ms"] is not None
+
+
+def test_converts_v2_export(tmp_path):
+    rows = []
+    for fixture in ("data.zip", "ctgov_v2.zip"):
+        archive = str(tmp_path / fixture)
+        shutil.copy(FIXTURE_ROOT + fixture, archive)
+        service = server.ConversionService(archive)
+        rows.append(service.get("NCT02413372")["csv"])
+        service.index.close()
+    assert rows[0] == rows[1]
+
+
+def test_rejects_bad_ids_and_reports_failures(base_url):
+    for path in (
+        "/trials/NCT0241337.json",
+        "/trials.json?ids=NCT02413372,NCT%D9%A0%D9%A1%D9%A2%D9%A3%D9%A4%D9%A5%D9%A6%D9%A7",
+    ):
+        with pytest.raises(urllib.error.HTTPError) as e:
+            get(base_url + path)
+        assert e.value.code == 400
+
+    with patch("convert_data.parse_document", side_effect=ValueError):
+        with pytest.raises(urllib.error.HTTPError) as e:
+            get(base_url + "/trials/NCT02251236.csv")
+    assert e.value.code == 500
+    # The server carries on
+    assert get(base_url + "/trials/NCT02251236.csv")
+
+
+def test_results_for_a_past_date_are_not_cached(tmp_path):
+    archive = str(tmp_path / "AllPublicXML.zip")
+    shutil.copy(FIXTURE_ROOT + "data.zip", archive)
+    service = server.ConversionService(archive)
+    parse_document = server.convert_data.parse_document
+
+    def parse_at_midnight(name, data):
+        # Another request sees the date change while this one converts
+        with service.lock:
+            service.as_of = None
+            service.cache.clear()
+        return parse_document(name, data)
+
+    with patch("convert_data.parse_document", parse_at_midnight):
+        assert service.get("NCT02413372") is not None
+    assert not service.cache
+    service.index.close()
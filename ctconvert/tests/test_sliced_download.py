@@ -0,0 +1,92 @@
+"""Tests for sliced_download.py"""
+
+import base64
+import hashlib
+import os
+
+import pytest
+
+import sliced_download
+
+
+class FakeBlob(object):
+    """Just enough of `google.cloud.storage.Blob` to serve ranges"""
+
+    def __init__(self, content, md5_hash=None):
+        self.name = "clinicaltrials/AllPublicXML.zip"
+        self.content = content
+        self.size = len(content)
+        self.generation = 1234
+        self.crc32c = None
+        self.md5_hash = md5_hash or base64.b64encode(
+            hashlib.md5(content).digest()
+        ).decode("ascii")
+        self.requested = []
+
+    def download_as_string(self, start, end):
+        self.requested.append((start, end))
+        return self.content[start : end + 1]
+
+    def reload(self):
+        pass
+
+
+def test_downloads_in_slices(tmp_path):
+    blob = FakeBlob(os.urandom(1000))
+    destination = str(tmp_path / "AllPublicXML.zip")
+    sliced_download.download_blob_sliced(blob, destination, slice_size=64)
+    with open(destination, "rb") as f:
+        assert f.read() == blob.content
+    assert len(blob.requested) == 16
+
+
+def test_reuses_a_finished_download(tmp_path):
+    blob = FakeBlob(os.urandom(1000))
+    destination = str(tmp_path / "AllPublicXML.zip")
+    sliced_download.download_blob_sliced(blob, destination, slice_size=64)
+    blob.requested = []
+    sliced_download.download_blob_sliced(blob, destination, slice_size=64)
+    assert blob.requested == []
+
+    # But not once the blob is replaced
+    blob.generation += 1
+    sliced_download.download_blob_sliced(blob, destination, slice_size=64)
+    assert len(blob.requested) == 16
+
+
+def test_resumes_missing_slices_only(tmp_path):
+    blob = FakeBlob(os.urandom(1000))
+    destination = str(tmp_path / "AllPublicXML.zip")
+    # Simulate an interrupted run that wrote the first two slices
+    with open(destination, "wb") as f:
+        f.write(blob.content[:200])
+    progress_path = destination + sliced_download.PROGRESS_SUFFIX
+    sliced_download.write_progress(progress_path, blob, {0, 1})
+
+    sliced_download.download_blob_sliced(blob, destination, slice_size=100)
+    with open(destination, "rb") as f:
+        assert f.read() == blob.content
+    assert (0, 99) not in blob.requested
+    assert len(blob.requested) == 8
+
+
+def test_checksum_mismatch_removes_file(tmp_path):
+    blob = FakeBlob(b"x" * 100, md5_hash="bm90IHRoZSByaWdodCBoYXNo")
+    destination = str(tmp_path / "AllPublicXML.zip")
+    with pytest.raises(sliced_download.ChecksumMismatch):
+        sliced_download.download_blob_sliced(blob, destination, slice_size=30)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + sliced_download.PROGRESS_SUFFIX)
+
+
+def test_replaced_blob_is_not_kept(tmp_path):
+    blob = FakeBlob(os.urandom(100))
+
+    def replaced():
+        blob.generation += 1
+
+    blob.reload = replaced
+    destination = str(tmp_path / "AllPublicXML.zip")
+    with pytest.raises(sliced_download.GenerationChanged):
+        sliced_download.download_blob_sliced(blob, destination, slice_size=30)
+    assert not os.path.exists(destination)
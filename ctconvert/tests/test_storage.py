@@ -0,0 +1,73 @@
+"""Tests for storage.py"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import date
+
+from storage import GCSStorage, LocalStorage, partitioned_name
+from tests.test_sliced_download import FakeBlob
+
+
+def test_local_storage_round_trip():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = LocalStorage(os.path.join(tmpdir, "store"))
+        source = os.path.join(tmpdir, "source.csv")
+        copy = os.path.join(tmpdir, "copy.csv")
+        with open(source, "w") as f:
+            f.write("nct_id\n")
+
+        assert storage.updated("clinicaltrials/index.csv") is None
+        assert not storage.download("clinicaltrials/index.csv", copy)
+
+        storage.upload(source, "clinicaltrials/index.csv")
+        assert storage.updated("clinicaltrials/index.csv") is not None
+        assert storage.download("clinicaltrials/index.csv", copy)
+        with open(copy) as f:
+            assert f.read() == "nct_id\n"
+
+
+class FakeBucket(object):
+    def __init__(self, blob):
+        self.blob = blob
+
+    def get_blob(self, name):
+        return self.blob if name == self.blob.name else None
+
+
+def test_gcs_download_to_partial_dir():
+    blob = FakeBlob(os.urandom(1000))
+    storage = GCSStorage.__new__(GCSStorage)
+    storage.bucket = FakeBucket(blob)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        partial_dir = os.path.join(tmpdir, "download")
+        destination = os.path.join(tmpdir, "AllPublicXML.zip")
+        assert not storage.download("missing.zip", destination, partial_dir)
+        assert storage.download(blob.name, destination, partial_dir)
+        # Kept where a restarted run would look for it
+        assert os.path.realpath(destination) == os.path.join(
+            os.path.realpath(partial_dir), "AllPublicXML.zip"
+        )
+        with open(destination, "rb") as f:
+            assert f.read() == blob.content
+
+
+def test_partitioned_name():
+    assert (
+        partitioned_name("clinicaltrials/raw_json/", date(2020, 1, 2), "trials.json")
+        == "clinicaltrials/raw_json/snapshot_date=2020-01-02/trials.json"
+    )
+
+
+def test_converter_does_not_import_cloud_sdks():
+    # In a fresh interpreter, as this one may have loaded them already
+    code = (
+        "import sys, convert_data; "
+        "print([m for m in sys.modules if m.startswith('google')])"
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    assert output.strip() == b"[]"
@@ -0,0 +1,60 @@
+"""Tests for worker_pool.py"""
+
+import os
+
+import pytest
+
+from worker_pool import LARGE, NORMAL, Limits, MemoryAwarePool
+
+
+def lengths(batch):
+    return [(name, len(data)) for name, data in batch]
+
+
+def die_on_poison(batch):
+    if any(name == "poison" for name, _ in batch):
+        os._exit(3)
+    return batch
+
+
+def make_batches(sizes, batch_size=3):
+    documents = [("doc{}".format(i), b"x" * size) for i, size in enumerate(sizes)]
+    return [
+        documents[i : i + batch_size] for i in range(0, len(documents), batch_size)
+    ]
+
+
+def test_recycles_workers_and_keeps_order():
+    sizes = [10, 20, 5000, 30, 40, 50, 6000, 60, 70, 80]
+    pool = MemoryAwarePool(
+        processes=2, limits=Limits(max_tasks=1, large_member_size=1000)
+    )
+    results = [
+        result
+        for batch in pool.imap(lengths, make_batches(sizes), max_pending=3)
+        for result in batch
+    ]
+    assert results == [("doc{}".format(i), size) for i, size in enumerate(sizes)]
+
+    report = pool.report()
+    large = [worker for worker in report if worker["lane"] == LARGE]
+    assert sum(worker["batches"] for worker in large) == 2
+    assert all(worker["recycled"] for worker in report if worker["batches"])
+    assert all(worker["peak_rss_mb"] > 0 for worker in report if worker["batches"])
+
+
+def test_recycles_workers_over_memory_limit():
+    pool = MemoryAwarePool(processes=2, limits=Limits(max_rss_mb=1))
+    results = list(pool.imap(lengths, make_batches([1] * 12), max_pending=4))
+    assert len(results) == 4
+    normal = [worker for worker in pool.report() if worker["lane"] == NORMAL]
+    # Every worker retires after its first batch
+    assert len(normal) >= 4
+    assert all(worker["batches"] <= 1 for worker in normal)
+
+
+def test_raises_if_a_worker_dies():
+    batches = [[("fine", b"")], [("poison", b"")], [("fine", b"")]]
+    pool = MemoryAwarePool(processes=2, limits=Limits())
+    with pytest.raises(RuntimeError):
+        list(pool.imap(die_on_poison, batches, max_pending=2))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""A process pool that keeps its workers' memory in check.
+
+Parsing leaves garbage behind in long-lived workers, and a single trial
+with an enormous results section can take a worker's memory far past
+the average. `MemoryAwarePool` therefore:
+
+* has each worker sample its resident set size after every batch, and
+  retire (to be replaced by a fresh process) once it exceeds
+  `Limits.max_rss_mb` or has run `Limits.max_tasks` batches;
+* sends members larger than `Limits.large_member_size` bytes, one at a
+  time, to a separate lane of `Limits.large_workers` processes, so that
+  only a few of them are ever being parsed at once;
+* records the memory high-water mark of every worker it started.
+
+Results are returned in the order the batches were submitted.
+
+"""
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+
+NORMAL = "normal"
+LARGE = "large"
+
+logger = logging.getLogger(__name__)
+
+
+class Limits(object):
+    def __init__(
+        self, max_rss_mb=None, max_tasks=None, large_member_size=None, large_workers=1
+    ):
+        self.max_rss_mb = max_rss_mb
+        self.max_tasks = max_tasks
+        self.large_member_size = large_member_size
+        self.large_workers = large_workers
+
+
+def rss_mb(pid="self"):
+    """Return the resident set size of process `pid`, or None if it
+    can't be read (e.g. the process has gone)
+
+    """
+    try:
+        with open("/proc/{}/statm".format(pid)) as f:
+            pages = int(f.read().split()[1])
+    except (IOError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def current_rss_mb():
+    rss = rss_mb()
+    return peak_rss_mb() if rss is None else rss
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Return the peak RSS of this process, or with `RUSAGE_CHILDREN`
+    that of its largest finished child
+
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_worker(func, initializer, tasks, results, limits):
+    """Apply `func` to batches from `tasks` until told to stop, or
+    until over a limit.
+
+    """
+    if initializer is not None:
+        initializer()
+    done = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, batch = task
+        output = func(batch)
+        done += 1
+        rss = current_rss_mb()
+        recycle = bool(
+            (limits.max_rss_mb and rss > limits.max_rss_mb)
+            or (limits.max_tasks and done >= limits.max_tasks)
+        )
+        results.put((seq, os.getpid(), output, peak_rss_mb(), recycle))
+        if recycle:
+            break
+
+
+class MemoryAwarePool(object):
+    def __init__(self, processes=None, initializer=None, limits=None):
+        self.processes = processes or os.cpu_count()
+        self.initializer = initializer
+        self.limits = limits or Limits()
+        self.tasks = {NORMAL: multiprocessing.Queue(), LARGE: multiprocessing.Queue()}
+        self.results = multiprocessing.Queue()
+        self.workers = {}
+        self.stats = collections.OrderedDict()
+
+    def start_worker(self, func, lane):
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(func, self.initializer, self.tasks[lane], self.results, self.limits),
+        )
+        process.daemon = True
+        process.start()
+        self.workers[process.pid] = (process, lane)
+        self.stats[process.pid] = {
+            "pid": process.pid,
+            "lane": lane,
+            "batches": 0,
+            "peak_rss_mb": 0,
+            "recycled": False,
+        }
+
+    def split(self, batches):
+        """Yield `(lane, batch)`, taking members over the size limit out
+        of their batches to be sent on their own.
+
+        """
+        size = self.limits.large_member_size
+        for batch in batches:
+            if not size:
+                yield NORMAL, batch
+                continue
+            small = []
+            for document in batch:
+                # The content is the last item of each document
+                if len(document[-1]) > size:
+                    if small:
+                        yield NORMAL, small
+                        small = []
+                    yield LARGE, [document]
+                else:
+                    small.append(document)
+            if small:
+                yield NORMAL, small
+
+    def imap(self, func, batches, max_pending):
+        """Yield `func(batch)` for each of `batches`, in order, with at
+        most `max_pending` batches submitted but not yet yielded.
+
+        """
+        for _ in range(self.processes):
+            self.start_worker(func, NORMAL)
+        if self.limits.large_member_size:
+            for _ in range(self.limits.large_workers):
+                self.start_worker(func, LARGE)
+        submitted = 0
+        next_seq = 0
+        done = {}
+        try:
+            for lane, batch in self.split(batches):
+                self.tasks[lane].put((submitted, batch))
+                submitted += 1
+                while submitted - next_seq >= max_pending:
+                    self.collect(func, done)
+                    while next_seq in done:
+                        yield done.pop(next_seq)
+                        next_seq += 1
+            while next_seq < submitted:
+                if next_seq not in done:
+                    self.collect(func, done)
+                    continue
+                yield done.pop(next_seq)
+                next_seq += 1
+            self.stop()
+        finally:
+            self.terminate()
+
+    def collect(self, func, done):
+        """Wait for one result and store it in `done`, replacing its
+        worker if it retired.
+
+        """
+        while True:
+            try:
+                seq, pid, output, peak, recycle = self.results.get(timeout=1)
+                break
+            except queue.Empty:
+                self.check_workers()
+        done[seq] = output
+        stats = self.stats[pid]
+        stats["batches"] += 1
+        stats["peak_rss_mb"] = round(max(stats["peak_rss_mb"], peak), 1)
+        if recycle:
+            process, lane = self.workers.pop(pid)
+            process.join()
+            stats["recycled"] = True
+            logger.info(
+                "Recycling %s worker %s after %s batches (peak RSS %sMB)",
+                lane,
+                pid,
+                stats["batches"],
+                stats["peak_rss_mb"],
+            )
+            self.start_worker(func, lane)
+
+    def check_workers(self):
+        """Raise if a worker died while it may have been holding a
+        batch, e.g. because the kernel killed it for using too much
+        memory. Workers that retired exit with 0.
+
+        """
+        for pid, (process, _) in self.workers.items():
+            if process.exitcode not in (None, 0):
+                raise RuntimeError(
+                    "Worker {} died with exit code {}".format(pid, process.exitcode)
+                )
+
+    def stop(self):
+        for process, lane in self.workers.values():
+            self.tasks[lane].put(None)
+        for process, _ in self.workers.values():
+            process.join()
+        self.workers = {}
+
+    def terminate(self):
+        for process, _ in self.workers.values():
+            process.terminate()
+        for process, _ in self.workers.values():
+            process.join()
+        self.workers = {}
+
+    def report(self):
+        """Return the memory high-water mark etc. of every worker"""
+        return list(self.stats.values())